@@ -1,246 +1,1248 @@
 import os
+import json
 import time
 import uuid
-import glob
 import base64
 import tempfile
-import subprocess
-import re
 import random
-from flask import Flask, request, jsonify
-from pydantic import BaseModel
-from typing import List
+import threading
+from flask import Flask, Response, g, request, jsonify, send_file
+from pydantic import ValidationError
+
+from compile_cost import CompileLanes, CostModel
+from compile_jobs import JobStore
+from compile_pool import CompileScheduler, CompileSlots, QueueFull, default_workers
+from embeddings import (EmbeddingCache, HashingEmbeddings, OpenAIEmbeddings, load_syllabus, retrieval_query,
+                        syllabus_queries)
+from exercise_render import (EXERCISE_PARTS, extract_definitions, extract_fragments, fragment_document, fragment_filename,
+                             page_document)
+from latex_compiler import (CompileError, document_body, render_batch, render_document, render_pdf, render_repaired,
+                            standalone_document, use_workspaces)
+from latex_format import PreambleFormatCache, split_preamble
+from latex_sanitizer import DEFAULT_SANITIZER, preflight
+from metrics import Metrics
+from rasterize import RenderOptions
+from render_cache import FailureCache, RenderCache, make_cache_key
+from request_timing import annotate, mark_error, stage, start_timer, stop_timer
+from static_janitor import StaticJanitor
+from stroke_geometry import (MSGPACK_MIMETYPES, STROKES_MIMETYPE, UnsupportedFormat, decode_elements,
+                             decode_msgpack, decode_strokes, symbols_json)
+from stroke_grouping import GeometryOptions, group_strokes, simplify
+from stroke_sessions import SessionCorrupt, SessionFull, SessionStore
+from uploads import UploadStore, UploadTooLarge, b64_chunks, stream_chunks
+from vector_index import VectorIndex, export_collection
+from workspaces import WorkspacePool, default_root
 
 # Inicializar Flask
 app = Flask(__name__)
 
+# Cache de renders en disco (LRU con límite de tamaño)
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ib_render_cache"))
+RENDER_CACHE_MAX_MB = int(os.environ.get("RENDER_CACHE_MAX_MB", 512))
+render_cache = RenderCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_MB * 1024 * 1024)
+
+# Formatos .fmt de los preámbulos más usados (se vuelcan al verlos N veces)
+PREAMBLE_FMT_DIR = os.environ.get("PREAMBLE_FMT_DIR", os.path.join(tempfile.gettempdir(), "ib_fmt_cache"))
+PREAMBLE_FMT_MIN_USES = int(os.environ.get("PREAMBLE_FMT_MIN_USES", 2))
+preamble_formats = None
+if os.environ.get("PREAMBLE_FMT_ENABLED", "1") == "1":
+    preamble_formats = PreambleFormatCache(PREAMBLE_FMT_DIR, min_uses=PREAMBLE_FMT_MIN_USES)
+
+# Pool fijo de compilación con cola de espera acotada
+COMPILE_WORKERS = max(1, int(os.environ.get("COMPILE_WORKERS", default_workers())))
+COMPILE_QUEUE_MAX = int(os.environ.get("COMPILE_QUEUE_MAX", COMPILE_WORKERS * 4))
+# Límite global entre procesos (gunicorn): como mucho COMPILE_GLOBAL_SLOTS pdflatex a la vez
+COMPILE_GLOBAL_SLOTS = int(os.environ.get("COMPILE_GLOBAL_SLOTS", 0))
+COMPILE_SLOTS_DIR = os.environ.get("COMPILE_SLOTS_DIR", os.path.join(tempfile.gettempdir(), "ib_compile_slots"))
+compile_slots = CompileSlots(COMPILE_SLOTS_DIR, COMPILE_GLOBAL_SLOTS) if COMPILE_GLOBAL_SLOTS > 0 else None
+# Con gunicorn (preload) los hilos se arrancan en cada worker, no en el maestro
+COMPILE_PRESTART = os.environ.get("COMPILE_PRESTART", "1") == "1"
+compile_scheduler = CompileScheduler(COMPILE_WORKERS, COMPILE_QUEUE_MAX, compile_slots, prestart=COMPILE_PRESTART)
+
+# Carril pesado: lo que el estimador de coste (compile_cost) da por encima de
+# COMPILE_HEAVY_THRESHOLD segundos compila aparte, con sus hilos, su cola y un
+# timeout que crece con la estimación (hasta COMPILE_HEAVY_TIMEOUT). Sus huecos
+# globales son COMPILE_HEAVY_GLOBAL_SLOTS de los COMPILE_GLOBAL_SLOTS (los
+# mismos slot-i.lock): el tope total no cambia. El carril rápido es compile_scheduler
+COMPILE_HEAVY_THRESHOLD = float(os.environ.get("COMPILE_HEAVY_THRESHOLD", 2.0))
+COMPILE_HEAVY_WORKERS = int(os.environ.get("COMPILE_HEAVY_WORKERS", max(1, COMPILE_WORKERS // 4)))
+COMPILE_HEAVY_QUEUE_MAX = int(os.environ.get("COMPILE_HEAVY_QUEUE_MAX", COMPILE_HEAVY_WORKERS * 4))
+COMPILE_HEAVY_GLOBAL_SLOTS = int(os.environ.get("COMPILE_HEAVY_GLOBAL_SLOTS", max(1, COMPILE_GLOBAL_SLOTS // 4)))
+COMPILE_FAST_TIMEOUT = int(os.environ.get("COMPILE_FAST_TIMEOUT", 15))
+COMPILE_HEAVY_TIMEOUT = int(os.environ.get("COMPILE_HEAVY_TIMEOUT", 60))
+heavy_slots = None
+if compile_slots is not None:
+    heavy_slots = compile_slots.subset(COMPILE_HEAVY_GLOBAL_SLOTS)
+heavy_scheduler = CompileScheduler(COMPILE_HEAVY_WORKERS, COMPILE_HEAVY_QUEUE_MAX, heavy_slots,
+                                   prestart=COMPILE_PRESTART)
+compile_lanes = CompileLanes(compile_scheduler, heavy_scheduler, CostModel(), COMPILE_HEAVY_THRESHOLD,
+                             COMPILE_FAST_TIMEOUT, COMPILE_HEAVY_TIMEOUT)
+
+# Directorios de trabajo de pdflatex/poppler: en RAM (/dev/shm) y reciclados,
+# uno por hilo de compilación. Por debajo de COMPILE_WORKSPACE_MIN_FREE_MB
+# libres se vuelve a un directorio temporal en disco
+COMPILE_WORKSPACE_DIR = os.environ.get("COMPILE_WORKSPACE_DIR") or default_root()
+COMPILE_WORKSPACE_POOL = int(os.environ.get("COMPILE_WORKSPACE_POOL", COMPILE_WORKERS + COMPILE_HEAVY_WORKERS))
+COMPILE_WORKSPACE_MIN_FREE_MB = int(os.environ.get("COMPILE_WORKSPACE_MIN_FREE_MB", 16))
+compile_workspaces = WorkspacePool(COMPILE_WORKSPACE_DIR, COMPILE_WORKSPACE_POOL,
+                                   COMPILE_WORKSPACE_MIN_FREE_MB * 1024 * 1024)
+use_workspaces(compile_workspaces)
+
+# Trabajos asíncronos: los resultados se guardan JOB_RESULT_TTL segundos.
+# Compilan en su propio pool (JOB_COMPILE_WORKERS hilos) y como mucho en
+# JOB_GLOBAL_SLOTS de los huecos globales, así no quitan sitio a /compile.
+# Con la cola de jobs llena se reintenta JOB_QUEUE_RETRIES veces y luego el
+# job falla con 503
+JOB_RESULTS_DIR = os.environ.get("JOB_RESULTS_DIR", os.path.join(tempfile.gettempdir(), "ib_compile_jobs"))
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", 3600))
+JOB_MAX_PENDING = int(os.environ.get("JOB_MAX_PENDING", 256))
+JOB_COMPILE_WORKERS = max(1, int(os.environ.get("JOB_COMPILE_WORKERS", max(1, COMPILE_WORKERS // 4))))
+JOB_COMPILE_QUEUE_MAX = int(os.environ.get("JOB_COMPILE_QUEUE_MAX", JOB_COMPILE_WORKERS * 4))
+JOB_GLOBAL_SLOTS = int(os.environ.get("JOB_GLOBAL_SLOTS", max(1, COMPILE_GLOBAL_SLOTS // 4)))
+JOB_QUEUE_RETRIES = int(os.environ.get("JOB_QUEUE_RETRIES", 5))
+job_scheduler = CompileScheduler(JOB_COMPILE_WORKERS, JOB_COMPILE_QUEUE_MAX,
+                                 compile_slots.subset(JOB_GLOBAL_SLOTS) if compile_slots is not None else None,
+                                 prestart=COMPILE_PRESTART)
+# Mismo modelo de coste y timeouts que las peticiones, pero un solo pool para los dos carriles
+job_lanes = CompileLanes(job_scheduler, job_scheduler, compile_lanes.model, COMPILE_HEAVY_THRESHOLD,
+                         COMPILE_FAST_TIMEOUT, COMPILE_HEAVY_TIMEOUT)
+compile_jobs = JobStore(JOB_RESULTS_DIR, JOB_RESULT_TTL, JOB_MAX_PENDING,
+                        workers=JOB_COMPILE_WORKERS + JOB_COMPILE_QUEUE_MAX)
+
+# Pre-flight: rechazar en microsegundos lo que pdflatex no va a poder compilar
+PREFLIGHT_ENABLED = os.environ.get("PREFLIGHT_ENABLED", "1") == "1"
+
+# Reparación automática: reintentos con arreglos dirigidos al error del log
+# (paquete que falta, librería TikZ, imagen inexistente). 0 = desactivada
+LATEX_REPAIR_ATTEMPTS = int(os.environ.get("LATEX_REPAIR_ATTEMPTS", 0))
+
+# Cache negativa: un documento que ya falló (mismo fuente) falla sin compilar
+NEGATIVE_CACHE_DIR = os.environ.get("NEGATIVE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ib_failed_docs"))
+NEGATIVE_CACHE_TTL = int(os.environ.get("NEGATIVE_CACHE_TTL", 86400))
+NEGATIVE_CACHE_MAX = int(os.environ.get("NEGATIVE_CACHE_MAX", 10000))
+failed_documents = None
+if NEGATIVE_CACHE_TTL > 0:
+    failed_documents = FailureCache(NEGATIVE_CACHE_DIR, NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_MAX,
+                                    namespace=f"repairs={LATEX_REPAIR_ATTEMPTS}")
+
+# Sesiones de /parse_strokes: el lienzo vive en el servidor y el cliente manda deltas
+STROKE_SESSION_TTL = int(os.environ.get("STROKE_SESSION_TTL", 900))
+STROKE_SESSION_MAX = int(os.environ.get("STROKE_SESSION_MAX", 1000))
+STROKE_SESSION_MAX_POINTS = int(os.environ.get("STROKE_SESSION_MAX_POINTS", 500000))
+# Log de cada sesión en disco: un delta puede caer en cualquier worker de gunicorn
+STROKE_SESSION_DIR = os.environ.get("STROKE_SESSION_DIR", os.path.join(tempfile.gettempdir(), "ib_stroke_sessions"))
+stroke_sessions = SessionStore(STROKE_SESSION_TTL, STROKE_SESSION_MAX, STROKE_SESSION_MAX_POINTS,
+                               root=STROKE_SESSION_DIR)
+
+# static/: archivos por hash de contenido que caducan en segundo plano
+STATIC_TTL = int(os.environ.get("STATIC_TTL", 3600))
+STATIC_MAX_MB = int(os.environ.get("STATIC_MAX_MB", 1024))
+STATIC_MAX_FILES = int(os.environ.get("STATIC_MAX_FILES", 10000))
+static_janitor = StaticJanitor("static", ttl=STATIC_TTL, max_bytes=STATIC_MAX_MB * 1024 * 1024, max_files=STATIC_MAX_FILES)
+
+# /upload: tamaño máximo por archivo (las subidas no caducan, pero se deduplican por hash)
+UPLOAD_MAX_MB = int(os.environ.get("UPLOAD_MAX_MB", 20))
+uploads = UploadStore("static", UPLOAD_MAX_MB * 1024 * 1024)
+
+# Tiempos por etapa (header Server-Timing) y métricas Prometheus en /metrics.
+# Con varios procesos METRICS_DIR es el directorio donde cada uno deja las
+# suyas para sumarlas (gunicorn.conf.py lo define). SLOW_REQUEST_MS > 0
+# escribe en el log las peticiones más lentas con sus etapas.
+SERVER_TIMING_ENABLED = os.environ.get("SERVER_TIMING_ENABLED", "1") == "1"
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 0))
+metrics = Metrics(snapshot_dir=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL)
+
 # ==========================================================
 # 0. UTILIDADES DE LIMPIEZA LATEX
 # ==========================================================
 def sanitize_latex(latex_code):
     """
     Limpia alucinaciones comunes de la IA y corrige errores de sintaxis
-    antes de compilar.
+    antes de compilar. Las reglas están registradas en latex_sanitizer.RULES
+    y se aplican todas en una sola pasada.
     """
-    # 1. Eliminar paquetes conflictivos
-    latex_code = re.sub(r'\\usepackage(\[.*\])?\{microtype\}', '', latex_code)
-    # latex_code = re.sub(r'\\usepackage(\[.*\])?\{tcolorbox\}', '', latex_code) # YA NO LO BORRES si lo usas en el template
-
-    # 2. CORRECCIÓN CRÍTICA: EL ERROR DE "MATH MODE" vs "ESPACIO VERTICAL"
-    # La IA escribe \[2mm] pensando que es espacio. LaTeX cree que es una ecuación.
-    # Buscamos \[ seguido de dígitos y unidades (mm, cm, pt, ex, em) y cerramos el corchete
-    # Reemplazamos \[2mm] por \\[2mm]
-    latex_code = re.sub(r'\\\[\s*(\d+[a-z]{2})\]', r'\\\\[\1]', latex_code)
-
-    # 3. Corrección de saltos de línea mal formados al inicio
-    latex_code = re.sub(r'^\s*\\\\\[', r'\\[', latex_code, flags=re.MULTILINE)
-
-    # 4. Corrección de formas geométricas (Diamantes -> Círculos)
-    latex_code = latex_code.replace(", diamond", ", circle")
-    latex_code = latex_code.replace("diamond,", "circle,")
-    latex_code = latex_code.replace("[diamond]", "[circle]")
-
-    # 5. Desempaquetado de seguridad (Solo si la caja está duplicada o mal formada)
-    # Si ves que tienes \begin{tcolorbox} dentro de otro, habilita esto. 
-    # Por ahora, con el template fijo, déjalo comentado o úsalo solo para limpiar "inner boxes".
-    
-    return latex_code
+    return DEFAULT_SANITIZER.sanitize(latex_code)[0]
+
+
+def preflight_error(clean_latex, require_document=True):
+    """Respuesta 400 si el documento va a fallar seguro, o None."""
+    if not PREFLIGHT_ENABLED:
+        return None
+    issues = preflight(clean_latex, require_document=require_document)
+    if not issues:
+        return None
+    return jsonify({"error": "LaTeX pre-flight check failed", "issues": issues}), 400
+
+
+@app.before_request
+def start_request_timer():
+    g.timer, g.timer_token = start_timer()
+
+
+@app.after_request
+def static_headers(response):
+    # En static/ hay subidas de los clientes: que el navegador no adivine el tipo
+    if request.endpoint == "static":
+        response.headers["X-Content-Type-Options"] = "nosniff"
+    return response
+
+
+@app.after_request
+def finish_request_timer(response):
+    timer = g.get("timer")
+    if timer is None:
+        return response
+    total = timer.elapsed()
+    endpoint = request.endpoint or "unknown"
+    if SERVER_TIMING_ENABLED:
+        response.headers["Server-Timing"] = timer.header(total)
+    metrics.observe_request(endpoint, request.method, response.status_code, timer, total)
+
+    if SLOW_REQUEST_MS and total * 1000 >= SLOW_REQUEST_MS:
+        print("⚠️ Slow request " + json.dumps({
+            "endpoint": endpoint,
+            "status": response.status_code,
+            "ms": round(total * 1000, 1),
+            "stages": {name: round(seconds * 1000, 2) for name, seconds in timer.stages.items()},
+            **timer.info,
+        }))
+    return response
+
+
+@app.teardown_request
+def stop_request_timer(exc):
+    token = g.pop("timer_token", None)
+    if token is not None:
+        stop_timer(token)
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 # ==========================================================
 # 1. VECTOR PARSER (Strokes → Geometry)
 # ==========================================================
-class Stroke(BaseModel):
-    id: str
-    points: List[List[float]]
-    strokeWidth: float = None
-    strokeColor: str = None
-    groupIds: List[str] = []
-    frameId: str = None
-    seed: int = None
-
-class ParseRequest(BaseModel):
-    elements: List[Stroke]
-
-class Symbol(BaseModel):
-    id: str
-    bbox: List[float]
-    points: List[List[float]]
-
-def compute_bbox(points):
-    if not points: return [0,0,0,0]
-    xs = [p[0] for p in points]
-    ys = [p[1] for p in points]
-    return [min(xs), min(ys), max(xs), max(ys)]
+# Los puntos van directos a arrays de numpy (stroke_geometry) en vez de
+# validarse uno a uno con pydantic. Los puntos solo se devuelven si se
+# piden con ?points=1 (o "points": true en el JSON).
+# Además del JSON se aceptan el formato binario (Content-Type
+# application/x-ib-strokes, ver stroke_geometry) y MessagePack.
+# Opciones (campo "options" o query string, ver GeometryOptions):
+#   group=1      -> agrupa trazos en símbolos/líneas/filas (groups, lines, rows)
+#   simplify=eps -> simplifica los puntos devueltos con Ramer–Douglas–Peucker
+def _flag(value):
+    return str(value).lower() in ("1", "true", "yes")
+
+
+def read_strokes():
+    """(StrokeBatch, flag de puntos, opciones de geometría) según el Content-Type."""
+    query = {k: request.args[k] for k in GeometryOptions.model_fields if k in request.args}
+    if request.mimetype == STROKES_MIMETYPE:
+        return decode_strokes(request.get_data()), _flag(request.args.get("points")), GeometryOptions(**query)
+    if request.mimetype in MSGPACK_MIMETYPES:
+        return decode_msgpack(request.get_data()), _flag(request.args.get("points")), GeometryOptions(**query)
+
+    # force=True permite leer JSON aunque el header esté mal
+    payload = request.get_json(force=True)
+    if isinstance(payload, list):
+        if not payload:
+            raise ValueError("Empty list received")
+        payload = payload[0]
+    if not isinstance(payload, dict):
+        raise ValueError("Expected a JSON object with 'elements'")
+    options = payload.get("options") or {}
+    # Un "options" que no es objeto llega tal cual a pydantic (ValidationError -> 400)
+    options = GeometryOptions.model_validate({**options, **query} if isinstance(options, dict) else options)
+    return (decode_elements(payload.get("elements")),
+            _flag(request.args.get("points") or payload.get("points")), options)
+
 
 @app.post("/parse_strokes")
 def parse_strokes_endpoint():
     try:
-        # force=True permite leer JSON aunque el header esté mal
-        payload = request.get_json(force=True)
-        if isinstance(payload, list):
-            if not payload:
-                return jsonify({"error": "Empty list received"}), 400
-            payload = payload[0]
-
-        req = ParseRequest(**payload)
-
-        symbols = []
-        for el in req.elements:
-            if not el.points:
-                continue
-            bbox = compute_bbox(el.points)
-            symbols.append(Symbol(
-                id=el.id,
-                bbox=bbox,
-                points=el.points
-            ))
+        with stage("decode"):
+            batch, include_points, options = read_strokes()
+        annotate(strokes=len(batch), points=int(batch.offsets[-1]))
+        simplified = None
+        if options.simplify:
+            with stage("simplify"):
+                simplified = simplify(batch, options.simplify)
+        with stage("symbols"):
+            symbols = symbols_json(batch, include_points, simplified)
 
-        return jsonify({
+        result = {
             "count": len(symbols),
-            "symbols": [s.dict() for s in symbols]
-        })
+            "symbols": symbols
+        }
+        if simplified is not None:
+            result["points_in"] = int(batch.offsets[-1])
+            result["points_out"] = int(simplified.offsets[-1])
+        if options.group:
+            with stage("group"):
+                result.update(group_strokes(batch, options.gap, options.line_gap))
+        with stage("serialize"):
+            return jsonify(result)
+
+    except ValidationError as e:
+        return jsonify({"error": "Invalid geometry options", "details": str(e)}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except UnsupportedFormat as e:
+        return jsonify({"error": str(e)}), 415
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- Sesiones incrementales ----------
+# POST   /parse_strokes/sessions        {"elements": [...]} -> session_id + todos los símbolos
+# POST   /parse_strokes/sessions/<id>   {"added": [...], "changed": [...], "removed": [ids]}
+#                                       -> solo los símbolos nuevos/cambiados y los ids borrados
+# GET    /parse_strokes/sessions/<id>   -> todos los símbolos (para resincronizar)
+# DELETE /parse_strokes/sessions/<id>
+@app.post("/parse_strokes/sessions")
+def create_stroke_session():
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        session = stroke_sessions.create(data.get("elements") or [])
+        with session.lock:
+            symbols = session.symbols(_flag(request.args.get("points") or data.get("points")))
+            return jsonify({
+                "session_id": session.id,
+                "version": session.version,
+                "count": len(symbols),
+                "symbols": symbols
+            }), 201
 
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except SessionFull as e:
+        return jsonify({"error": str(e)}), 413
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.post("/parse_strokes/sessions/<session_id>")
+def stroke_session_delta(session_id):
+    try:
+        data = request.get_json(force=True)
+        added, changed = data.get("added") or [], data.get("changed") or []
+        if not isinstance(added, list) or not isinstance(changed, list):
+            return jsonify({"error": "'added' and 'changed' must be lists"}), 400
+        elements = added + changed
+        with stroke_sessions.locked(session_id) as session:
+            if session is None:
+                return jsonify({"error": "Session not found or expired"}), 404
+            updated, removed = stroke_sessions.apply(session, elements, data.get("removed") or [])
+            include_points = _flag(request.args.get("points") or data.get("points"))
+            return jsonify({
+                "session_id": session.id,
+                "version": session.version,
+                "count": session.count,
+                "updated": [session.symbol(stroke_id, include_points) for stroke_id in updated],
+                "removed": removed
+            })
+
+    except SessionCorrupt as e:
+        return jsonify({"error": f"{e}; create a new session"}), 410
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except SessionFull as e:
+        return jsonify({"error": str(e)}), 413
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.get("/parse_strokes/sessions/<session_id>")
+def stroke_session_state(session_id):
+    try:
+        with stroke_sessions.locked(session_id) as session:
+            if session is None:
+                return jsonify({"error": "Session not found or expired"}), 404
+            symbols = session.symbols(_flag(request.args.get("points")))
+            return jsonify({"session_id": session.id, "version": session.version,
+                            "count": len(symbols), "symbols": symbols})
+    except SessionCorrupt as e:
+        return jsonify({"error": f"{e}; create a new session"}), 410
+
+
+@app.delete("/parse_strokes/sessions/<session_id>")
+def delete_stroke_session(session_id):
+    if not stroke_sessions.delete(session_id):
+        return jsonify({"error": "Session not found or expired"}), 404
+    return "", 204
+
+
+@app.get("/parse_strokes/sessions")
+def stroke_session_stats():
+    return jsonify(stroke_sessions.stats())
+
+
 # ==========================================================
 # 2. COMPILE LATEX (ROBUSTO)
 # ==========================================================
+def parse_render_options(data):
+    """Opciones de render del campo 'options' (ValidationError si no son válidas)."""
+    return RenderOptions.model_validate(data.get("options") or {})
+
+
+def render_or_fail(source, cache_key, render):
+    """
+    render_cache.get_or_render con la cache negativa delante: si este mismo
+    fuente ya falló, se relanza su error sin compilar.
+    """
+    if failed_documents is not None:
+        failure = failed_documents.get(source)
+        if failure is not None:
+            raise failure
+    try:
+        return render_cache.get_or_render(cache_key, render)
+    except CompileError as e:
+        if failed_documents is not None:
+            failed_documents.put(source, e)
+        raise
+
+
+def render_cached(clean_latex, options, lanes=None):
+    """
+    Devuelve ({nombre: ruta}, hit): busca en la cache (hash del LaTeX
+    sanitizado + opciones de render) y si no está compila en el pool
+    (`lanes`, por defecto compile_lanes).
+    """
+    lanes = lanes or compile_lanes
+    cache_key = make_cache_key(clean_latex, options.model_dump())
+    annotate(doc=cache_key)
+    return render_or_fail(clean_latex, cache_key, lambda: lanes.run(
+        clean_latex, render_repaired, render_document, clean_latex, preamble_formats, options,
+        attempts=LATEX_REPAIR_ATTEMPTS
+    ))
+
+
+def publish_static(path):
+    """
+    Publica la imagen en static/ (nombre por hash de contenido, hard link si
+    se puede) y devuelve su URL pública. La limpieza la hace static_janitor.
+    """
+    with stage("publish"):
+        output_filename = static_janitor.publish(path, ext=path.rsplit(".", 1)[1])
+    return static_url(output_filename)
+
+
+def static_url(filename):
+    # Nota: En Render, request.host suele ser correcto, pero si usas HTTPS asegúrate de que el esquema sea https
+    scheme = "https" if request.is_secure or request.headers.get("X-Forwarded-Proto") == "https" else "http"
+    return f"{scheme}://{request.host}/static/{filename}"
+
+
+# Modos de salida de /compile:
+#   json      -> pdf_base64 + png_base64 + png_url (por defecto, compatible)
+#   png_only  -> png_base64 + png_url, sin leer ni codificar el PDF
+#   url       -> solo png_url
+#   png / pdf -> bytes crudos transmitidos desde disco ("png" devuelve la
+#                imagen en el formato pedido en las opciones)
+#   multipart -> multipart/mixed con la imagen y el PDF
+# Con format jpeg/svg las claves png_* pasan a llamarse image_*.
+OUTPUT_MODES = ("json", "png_only", "url", "png", "pdf", "multipart")
+
+
+def _read_b64(path):
+    with stage("encode"), open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode()
+
+
+def artifact_json(entry, mode, options):
+    """Cuerpo JSON de un render según el modo de salida (json/png_only/url)."""
+    image = entry[f"doc.{options.ext}"]
+    key = "png" if options.format == "png" else "image"
+
+    result = {}
+    if options.format != "png":
+        result["format"] = options.format
+    if mode == "json":
+        result["pdf_base64"] = _read_b64(entry["doc.pdf"])
+    if mode in ("json", "png_only"):
+        result[f"{key}_base64"] = _read_b64(image)
+    result[f"{key}_url"] = publish_static(image)
+
+    if options.pages == "all":
+        n_pages = sum(1 for name in entry if name.startswith("page-"))
+        result["pages"] = [publish_static(entry[f"page-{n}.{options.ext}"]) for n in range(1, n_pages + 1)]
+    if "thumb.png" in entry:
+        result["thumbnail_url"] = publish_static(entry["thumb.png"])
+    if "repairs.json" in entry:
+        with open(entry["repairs.json"], encoding="utf-8") as f:
+            result["repairs"] = json.load(f)
+    return result
+
+
+def _multipart_response(entry, options):
+    boundary = uuid.uuid4().hex
+    # Abrir ya los archivos: si la cache desaloja la entrada mientras se
+    # transmite, los descriptores abiertos siguen siendo válidos
+    parts = [(name, mimetype, open(entry[name], "rb"), os.path.getsize(entry[name]))
+             for name, mimetype in ((f"doc.{options.ext}", options.mimetype), ("doc.pdf", "application/pdf"))]
+
+    def generate():
+        for name, mimetype, f, size in parts:
+            yield (f"--{boundary}\r\n"
+                   f"Content-Type: {mimetype}\r\n"
+                   f"Content-Disposition: attachment; filename=\"{name}\"\r\n"
+                   f"Content-Length: {size}\r\n\r\n").encode()
+            with f:
+                while True:
+                    chunk = f.read(64 * 1024)
+                    if not chunk:
+                        break
+                    yield chunk
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    return Response(generate(), mimetype=f"multipart/mixed; boundary={boundary}")
+
+
+def _compile_error_class(e):
+    return {400: "latex", 408: "latex_timeout"}.get(e.status, "render")
+
+
 @app.route("/compile", methods=["POST"])
 def compile_tex():
     try:
-        data = request.get_json(force=True)
+        with stage("parse"):
+            data = request.get_json(force=True)
         latex_b64 = data.get("latex_base64", "")
 
         if not latex_b64:
             return jsonify({"error": "Missing 'latex_base64'"}), 400
 
         # Decodificar y SANITIZAR el código LaTeX
-        raw_latex = base64.b64decode(latex_b64).decode('utf-8')
-        clean_latex = sanitize_latex(raw_latex)
-        
-        # Volver a bytes para escribir el archivo
-        latex_bytes = clean_latex.encode('utf-8')
-
-        with tempfile.TemporaryDirectory() as tmp:
-            tex_path = os.path.join(tmp, "doc.tex")
-            pdf_path = os.path.join(tmp, "doc.pdf")
-            png_prefix = os.path.join(tmp, "doc")
-
-            # Escribir el archivo .tex
-            with open(tex_path, "wb") as f:
-                f.write(latex_bytes)
-
-            # 1. Ejecutar PDFLATEX con TIMEOUT
+        with stage("decode"):
+            raw_latex = base64.b64decode(latex_b64).decode('utf-8')
+        with stage("sanitize"):
+            clean_latex, fired_rules = DEFAULT_SANITIZER.sanitize(raw_latex)
+
+        with stage("preflight"):
+            rejected = preflight_error(clean_latex)
+        if rejected:
+            mark_error("preflight")
+            return rejected
+
+        output_mode = request.args.get("output") or data.get("output") or "json"
+        if output_mode not in OUTPUT_MODES:
+            return jsonify({"error": f"Unknown output mode '{output_mode}'", "modes": list(OUTPUT_MODES)}), 400
+
+        options = parse_render_options(data)
+        entry, cache_hit = render_cached(clean_latex, options)
+        cache_header = {"X-Render-Cache": "HIT" if cache_hit else "MISS"}
+        if fired_rules:
+            cache_header["X-Sanitizer-Rules"] = ",".join(f"{name}={n}" for name, n in sorted(fired_rules.items()))
+        if "repairs.json" in entry:
+            with open(entry["repairs.json"], encoding="utf-8") as f:
+                cache_header["X-LaTeX-Repairs"] = ",".join(r["repair"] for r in json.load(f))
+
+        # Modos binarios: se transmite el archivo de la cache tal cual
+        if output_mode == "png":
+            response = send_file(entry[f"doc.{options.ext}"], mimetype=options.mimetype)
+        elif output_mode == "pdf":
+            response = send_file(entry["doc.pdf"], mimetype="application/pdf")
+        elif output_mode == "multipart":
+            response = _multipart_response(entry, options)
+        else:
+            # Guardar en static para acceso público
+            result = artifact_json(entry, output_mode, options)
+            result["cached"] = cache_hit
+            with stage("serialize"):
+                response = jsonify(result)
+
+        response.headers.update(cache_header)
+        return response
+
+    except ValidationError as e:
+        mark_error("invalid_options")
+        return jsonify({"error": "Invalid render options", "details": str(e)}), 400
+    except CompileError as e:
+        mark_error(_compile_error_class(e))
+        return jsonify(e.payload), e.status
+    except QueueFull as e:
+        mark_error("queue_full")
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
+    except Exception as e:
+        mark_error("internal")
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- Lotes (hojas de ejercicios) ----------
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 50))
+# pdflatex por preámbulo como mucho al partir un lote que falla
+BATCH_MAX_ROUNDS = int(os.environ.get("BATCH_MAX_ROUNDS", 8))
+
+
+def _batch_item(item, shared_preamble):
+    """Devuelve (preámbulo, cuerpo, documento individual) de un ítem del lote."""
+    if item.get("latex_base64"):
+        clean_latex = sanitize_latex(base64.b64decode(item["latex_base64"]).decode('utf-8'))
+        parts = split_preamble(clean_latex)
+        if parts is None:
+            raise ValueError("Document has no \\documentclass/\\begin{document}")
+        return parts[0], document_body(parts[1]), clean_latex
+
+    if "body" in item:
+        if not shared_preamble:
+            raise ValueError("Item has 'body' but the batch has no 'preamble'")
+        body = sanitize_latex(item["body"])
+        return shared_preamble, body, standalone_document(shared_preamble, body)
+
+    raise ValueError("Item needs 'latex_base64' or 'body'")
+
+
+@app.post("/compile_batch")
+def compile_batch():
+    try:
+        data = request.get_json(force=True)
+        items = data.get("items") or []
+        if not items:
+            return jsonify({"error": "Missing 'items'"}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({"error": f"Too many items (max {BATCH_MAX_ITEMS})"}), 400
+
+        options = parse_render_options(data)
+        shared_preamble = data.get("preamble")
+        if shared_preamble:
+            shared_preamble = sanitize_latex(shared_preamble)
+
+        results = [None] * len(items)
+        entries = {}
+        groups = {}  # preámbulo -> [(índice, cuerpo, clave)]
+        for i, item in enumerate(items):
             try:
-                process = subprocess.run(
-                    ["pdflatex", "-interaction=nonstopmode", "doc.tex"],
-                    cwd=tmp,  # Ejecutar DENTRO del temp para que los logs queden ahí
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    timeout=15  # Matar si tarda más de 15s
-                )
-            except subprocess.TimeoutExpired:
-                return jsonify({"error": "Compilation timed out (infinite loop in LaTeX)"}), 408
-
-            # Verificar errores de LaTeX
-            if process.returncode != 0:
-                log_file = os.path.join(tmp, "doc.log")
-                latex_log = "Log not found."
-                if os.path.exists(log_file):
-                    # Latin-1 es necesario porque los logs de error de LaTeX suelen tener caracteres raros
-                    with open(log_file, "r", encoding="latin-1", errors="replace") as log:
-                        latex_log = log.read()
-                
-                # Devolver el log truncado para no saturar la respuesta
-                return jsonify({"error": "LaTeX compilation failed", "log": latex_log[-2000:]}), 400
-
-            # 2. Ejecutar PDFTOPPM (Convertir PDF a PNG)
+                preamble, body, single_doc = _batch_item(item, shared_preamble)
+            except Exception as e:
+                results[i] = {"index": i, "ok": False, "error": str(e)}
+                continue
+
+            issues = preflight(single_doc) if PREFLIGHT_ENABLED else []
+            if issues:
+                results[i] = {"index": i, "ok": False, "status": 400,
+                              "error": "LaTeX pre-flight check failed", "issues": issues}
+                continue
+
+            # Ya falló suelto en /compile (los fallos del lote no se guardan: sus
+            # líneas son relativas al cuerpo del ítem)
+            failure = failed_documents.get(single_doc) if failed_documents is not None else None
+            if failure is not None:
+                results[i] = {"index": i, "ok": False, "status": failure.status, **failure.payload}
+                continue
+
+            # Vale lo que /compile ya tenga del documento suelto, pero lo del lote
+            # se guarda aparte: comparte documento con los demás ítems (\label,
+            # contadores de paquetes...) y no debe servirse como render suelto
+            entry = render_cache.get(make_cache_key(single_doc, options.model_dump()))
+            batch_key = make_cache_key(single_doc, {**options.model_dump(), "batch": True})
+            if entry is None:
+                entry = render_cache.get(batch_key)
+            if entry is not None:
+                entries[i] = (entry, True)
+            else:
+                groups.setdefault(preamble, []).append((i, body, batch_key))
+
+        # Un pdflatex + un pdftoppm por preámbulo distinto; si hay que partir
+        # el lote, cada pasada va al carril que le toque por su propio coste
+        for preamble, group in groups.items():
+            bodies = [body for _, body, _ in group]
+            rendered = render_batch(preamble, bodies, preamble_formats, options,
+                                    run=compile_lanes.run, max_rounds=BATCH_MAX_ROUNDS)
+            for (i, _, key), result in zip(group, rendered):
+                if isinstance(result, CompileError):
+                    results[i] = {"index": i, "ok": False, "status": result.status, **result.payload}
+                else:
+                    entries[i] = (render_cache.put(key, result), False)
+
+        output_mode = data.get("output", "json")
+        if output_mode not in ("json", "png_only", "url"):
+            output_mode = "json"
+
+        for i, (entry, cache_hit) in entries.items():
+            results[i] = {"index": i, "ok": True, **artifact_json(entry, output_mode, options), "cached": cache_hit}
+
+        return jsonify({
+            "count": len(results),
+            "failed": sum(1 for r in results if not r["ok"]),
+            "results": results
+        })
+
+    except ValidationError as e:
+        return jsonify({"error": "Invalid render options", "details": str(e)}), 400
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- Ejercicios estructurados (question / diagram / answer) ----------
+# Los fragmentos solo guardan el PDF: su clave no choca con la de /compile
+FRAGMENT_CACHE_OPTIONS = {"fragment": "pdf"}
+
+
+def render_fragment(picture, definitions=""):
+    """Devuelve ({nombre: ruta}, hit) del PDF de un tikzpicture."""
+    source = fragment_document(picture, definitions)
+    return render_or_fail(source, make_cache_key(source, FRAGMENT_CACHE_OPTIONS), lambda: compile_lanes.run(
+        source, render_repaired, render_pdf, source, preamble_formats, attempts=LATEX_REPAIR_ATTEMPTS
+    ))
+
+
+@app.post("/render_exercise")
+def render_exercise():
+    try:
+        data = request.get_json(force=True)
+        if not any(data.get(name) for name in EXERCISE_PARTS):
+            return jsonify({"error": "Missing 'question', 'diagram' or 'answer'"}), 400
+
+        options = parse_render_options(data)
+        output_mode = data.get("output", "json")
+        if output_mode not in ("json", "png_only", "url"):
+            output_mode = "json"
+
+        clean_parts = {}
+        for name in EXERCISE_PARTS:
+            text = data.get(name)
+            if not text:
+                continue
+            clean_parts[name] = sanitize_latex(text)
+            issues = preflight(clean_parts[name], require_document=False) if PREFLIGHT_ENABLED else []
+            if issues:
+                return jsonify({"error": "LaTeX pre-flight check failed", "part": name, "issues": issues}), 400
+
+        # Las macros definidas en el texto (\newcommand, \tikzset...) van
+        # también al preámbulo de cada fragmento (y a su hash)
+        definitions = "".join(extract_definitions(text) for text in clean_parts.values())
+        parts = {}
+        fragments = {}
+        for name, clean in clean_parts.items():
+            parts[name], found = extract_fragments(clean, definitions)
+            fragments.update(found)
+
+        # 1. Cada tikzpicture es un PDF cacheado por el hash de su contenido.
+        # Si uno no compila suelto (algo del texto que no se ve desde fuera)
+        # se compila el ejercicio entero como un solo documento
+        files = {}
+        fragment_info = []
+        fallback = None
+        for digest, picture in fragments.items():
             try:
-                subprocess.run(
-                    ["pdftoppm", "-png", "-singlefile", "-r", "300", "doc.pdf", "doc"],
-                    cwd=tmp,
-                    check=True,
-                    timeout=15
-                )
-            except subprocess.CalledProcessError:
-                return jsonify({"error": "Failed to convert PDF to Image"}), 500
-
-            # Leer resultado
-            generated_png = png_prefix + ".png"
-            if not os.path.exists(generated_png):
-                 return jsonify({"error": "PNG file was not generated"}), 500
-
-            pdf_b64_out = base64.b64encode(open(pdf_path, "rb").read()).decode()
-            png_b64_out = base64.b64encode(open(generated_png, "rb").read()).decode()
-
-            # Guardar en static para acceso público (limpieza automática simple)
-            os.makedirs("static", exist_ok=True)
-            
-            # Limpiar archivos viejos (> 1 hora)
-            now = time.time()
-            for f in glob.glob("static/exercise_*.png"):
-                try:
-                    if now - os.path.getmtime(f) > 3600:
-                        os.remove(f)
-                except: pass
-
-            unique_id = uuid.uuid4().hex[:8]
-            output_filename = f"exercise_{unique_id}.png"
-            output_path = os.path.join("static", output_filename)
-            
-            with open(output_path, "wb") as f:
-                f.write(base64.b64decode(png_b64_out))
-
-            # Construir URL pública
-            # Nota: En Render, request.host suele ser correcto, pero si usas HTTPS asegúrate de que el esquema sea https
-            scheme = "https" if request.is_secure or request.headers.get("X-Forwarded-Proto") == "https" else "http"
-            png_url = f"{scheme}://{request.host}/static/{output_filename}"
+                entry, hit = render_fragment(picture, definitions)
+            except CompileError as e:
+                fallback = {"fragment": digest, "error": e.payload.get("error")}
+                break
+            files[fragment_filename(digest)] = entry["doc.pdf"]
+            fragment_info.append({"hash": digest, "cached": hit})
 
-            return jsonify({
-                "pdf_base64": pdf_b64_out,
-                "png_base64": png_b64_out,
-                "png_url": png_url
-            })
+        # 2. La página solo referencia los fragmentos por nombre (que incluye
+        # su hash), así que su clave cambia si cambia cualquier pieza
+        if fallback is None:
+            page = page_document(parts)
+        else:
+            page, files, fragment_info = page_document(clean_parts, tikz=True), {}, []
+        entry, cache_hit = render_or_fail(
+            page, make_cache_key(page, options.model_dump()),
+            lambda: compile_lanes.run(page, render_repaired, render_document, page, preamble_formats, options, files,
+                                      attempts=LATEX_REPAIR_ATTEMPTS)
+        )
 
+        result = artifact_json(entry, output_mode, options)
+        result["cached"] = cache_hit
+        result["fragments"] = fragment_info
+        if fallback is not None:
+            result["fallback"] = fallback
+        if data.get("metadata"):
+            result["metadata"] = data["metadata"]
+        return jsonify(result)
+
+    except ValidationError as e:
+        return jsonify({"error": "Invalid render options", "details": str(e)}), 400
+    except CompileError as e:
+        return jsonify(e.payload), e.status
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.get("/cache/stats")
+def cache_stats():
+    stats = render_cache.stats()
+    stats["static"] = static_janitor.stats()
+    if preamble_formats is not None:
+        stats["preamble_formats"] = preamble_formats.stats()
+    if failed_documents is not None:
+        stats["failed_documents"] = failed_documents.stats()
+    return jsonify(stats)
+
+
+@app.get("/compile/stats")
+def compile_stats():
+    stats = compile_scheduler.stats()
+    stats["heavy"] = {**heavy_scheduler.stats(), **compile_lanes.stats()}
+    stats["jobs"] = {**compile_jobs.stats(), "scheduler": job_scheduler.stats()}
+    stats["workspaces"] = compile_workspaces.stats()
+    return jsonify(stats)
+
+
+# ---------- Trabajos asíncronos ----------
+def _render_job(clean_latex, options):
+    # En un job no hay cliente esperando: si la cola está llena, reintentar
+    # unas cuantas veces y luego fallar (QueueFull -> 503 en el job)
+    for attempt in range(JOB_QUEUE_RETRIES + 1):
+        try:
+            return render_cached(clean_latex, options, lanes=job_lanes)
+        except QueueFull as e:
+            if attempt == JOB_QUEUE_RETRIES:
+                raise
+            time.sleep(e.retry_after)
+
+
+@app.post("/compile/jobs")
+def submit_compile_job():
+    try:
+        data = request.get_json(force=True)
+        latex_b64 = data.get("latex_base64", "")
+
+        if not latex_b64:
+            return jsonify({"error": "Missing 'latex_base64'"}), 400
+
+        clean_latex = sanitize_latex(base64.b64decode(latex_b64).decode('utf-8'))
+        rejected = preflight_error(clean_latex)
+        if rejected:
+            return rejected
+        options = parse_render_options(data)
+
+        job = compile_jobs.submit(lambda: _render_job(clean_latex, options))
+        if job is None:
+            return jsonify({"error": "Too many pending jobs"}), 503, {"Retry-After": "5"}
+
+        return jsonify({
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": f"/compile/jobs/{job.id}"
+        }), 202
+
+    except ValidationError as e:
+        return jsonify({"error": "Invalid render options", "details": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.get("/compile/jobs/<job_id>")
+def compile_job_status(job_id):
+    job = compile_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+
+    data = job.to_dict()
+    if job.status == "done":
+        for name in job.files:
+            stem, ext = name.rsplit(".", 1)
+            if stem == "doc":
+                data[f"{ext}_url"] = f"/compile/jobs/{job.id}/result?format={ext}"
+        data["urls"] = {name: f"/compile/jobs/{job.id}/result?name={name}" for name in sorted(job.files)}
+    elif job.status == "failed":
+        data["error_status"] = job.error_status
+    return jsonify(data)
+
+
+@app.get("/compile/jobs/<job_id>/result")
+def compile_job_result(job_id):
+    job = compile_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+    if job.status == "failed":
+        return jsonify(job.error), job.error_status
+    if job.status != "done":
+        return jsonify({"error": "Job not finished", "status": job.status}), 409, {"Retry-After": "1"}
+
+    # ?name=page-2.png elige un artefacto concreto; ?format=pdf|png|jpg|svg la página principal
+    name = request.args.get("name") or f"doc.{request.args.get('format', 'png')}"
+    path = job.files.get(name)
+    if path is None:
+        return jsonify({"error": f"Unknown artifact '{name}'", "artifacts": sorted(job.files)}), 400
+
+    # send_file transmite desde disco por bloques (el mimetype sale de la extensión)
+    return send_file(path)
+
+
 # ==========================================================
 # 3. UPLOAD IMAGE
 # ==========================================================
+# Tres formas de subir un archivo:
+#   - JSON {"base64": "...", "filename": "..."} (data-URL o base64 pelado)
+#   - multipart/form-data con el archivo en el campo "file"
+#   - el archivo tal cual en el cuerpo (image/*, application/pdf,
+#     application/octet-stream), nombre opcional en ?filename=
+# Se guarda en static/ con nombre por hash de contenido: "filename" solo
+# aporta la extensión si no se reconoce por los primeros bytes.
+RAW_UPLOAD_MIMETYPES = ("application/octet-stream", "application/pdf")
+
+
+def _upload_limit(mimetype):
+    # Tope del cuerpo antes de leerlo: base64 ocupa 4/3 y multipart lleva cabeceras
+    if mimetype == "multipart/form-data":
+        return uploads.max_bytes + 64 * 1024
+    if mimetype.startswith("image/") or mimetype in RAW_UPLOAD_MIMETYPES:
+        return uploads.max_bytes
+    return uploads.max_bytes * 4 // 3 + 64 * 1024
+
+
 @app.route("/upload", methods=["POST"])
 def upload():
+    try:
+        mimetype = request.mimetype or ""
+        if request.content_length is not None and request.content_length > _upload_limit(mimetype):
+            raise UploadTooLarge(f"Upload exceeds {uploads.max_bytes} bytes")
+
+        if mimetype == "multipart/form-data":
+            with stage("parse"):
+                file = request.files.get("file")
+            if file is None:
+                return jsonify({"error": "Missing 'file'"}), 400
+            chunks = stream_chunks(file.stream)
+        elif mimetype.startswith("image/") or mimetype in RAW_UPLOAD_MIMETYPES:
+            chunks = stream_chunks(request.stream)
+        else:
+            # force=True permite leer JSON aunque el header esté mal
+            with stage("parse"):
+                data = request.get_json(force=True)
+            file_b64 = data.get("base64")
+            if not file_b64:
+                return jsonify({"error": "Missing 'base64'"}), 400
+            chunks = b64_chunks(file_b64)
+
+        # Decodificar/leer y escribir van intercalados, trozo a trozo
+        with stage("write"):
+            name, size, deduplicated = uploads.save(chunks)
+        annotate(bytes=size)
+
+        return jsonify({"url": static_url(name), "filename": name, "bytes": size, "deduplicated": deduplicated})
+
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        # binascii.Error (base64 inválido) también es ValueError
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        mark_error("internal")
+        return jsonify({"error": str(e)}), 500
+
+
+# ==========================================================
+# 4. RAG RETRIEVAL (Robust Chroma Load + Randomized Logic)
+# ==========================================================
+# chromadb y openai son opcionales: sin ellos /retrieve devuelve lista vacía
+try:
+    from chromadb import PersistentClient
+except ImportError:
+    PersistentClient = None
+try:
+    from chromadb.api.client import SharedSystemClient
+except ImportError:
+    SharedSystemClient = None
+try:
+    from openai import OpenAI
+except ImportError:
+    OpenAI = None
+
+# Configuración segura de clientes
+chroma_enabled = False
+embedding_provider = None
+embedding_cache = None
+
+# Constante para la "Ventana Estocástica"
+# Buscamos 15 candidatos para elegir 3 al azar.
+SEARCH_POOL_SIZE = 15
+
+# Programa -> colección
+SYLLABUS_MAP = {
+    "IB": "ib_questions",
+    "AQA": None,
+    "CAMBRIDGE": None
+}
+
+# Colecciones exportadas a numpy (una carpeta por colección, abierta con mmap)
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR", os.path.join(os.getcwd(), "ib_index"))
+vector_indexes = {}
+
+# Proveedor de embeddings: "openai" (por defecto si hay API KEY) o "local"
+# (hashing, sin red: para pruebas offline y de carga)
+EMBEDDING_PROVIDER = os.environ.get("EMBEDDING_PROVIDER", "openai" if os.environ.get("OPENAI_API_KEY") else "")
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-embedding-3-large")
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", os.path.join(tempfile.gettempdir(), "ib_embeddings.sqlite"))
+EMBEDDING_CACHE_ITEMS = int(os.environ.get("EMBEDDING_CACHE_ITEMS", 4096))
+# Archivo JSON con el temario para precalcular sus embeddings al arrancar.
+# Con EMBEDDING_WARMUP_BLOCKING=1 (gunicorn con preload) se hace antes de
+# arrancar los workers en vez de en un hilo: un fork con ese hilo a medias
+# dejaría sus locks tomados en los hijos.
+EMBEDDING_WARMUP_FILE = os.environ.get("EMBEDDING_WARMUP_FILE")
+EMBEDDING_WARMUP_BLOCKING = os.environ.get("EMBEDDING_WARMUP_BLOCKING", "0") == "1"
+
+if EMBEDDING_PROVIDER == "openai" and OpenAI is not None and os.environ.get("OPENAI_API_KEY"):
+    embedding_provider = OpenAIEmbeddings(OpenAI(api_key=os.environ.get("OPENAI_API_KEY")), EMBEDDING_MODEL)
+elif EMBEDDING_PROVIDER == "local":
+    embedding_provider = HashingEmbeddings(int(os.environ.get("EMBEDDING_DIM", 3072)))
+
+# Intentar inicializar solo si hay proveedor de embeddings
+if embedding_provider is not None:
+    embedding_cache = EmbeddingCache(embedding_provider, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_ITEMS)
+
+    chroma_enabled = PersistentClient is not None
+
+# Cliente de Chroma de cada proceso: por dentro usa SQLite e hilos, que no
+# se pueden usar tras el fork de gunicorn (preload). Se crea en el primer
+# uso dentro del worker, nunca al importar.
+CHROMA_DB_PATH = os.path.join(os.getcwd(), "ib_store")
+_chroma_clients = {}
+_chroma_lock = threading.Lock()
+
+
+def _forget_chroma_clients():
+    """
+    Olvida los clientes abiertos. chromadb guarda un System por ruta a nivel
+    de clase: sin vaciar esa cache un PersistentClient nuevo tras el fork
+    reutilizaría el del maestro.
+    """
+    _chroma_clients.clear()
+    if SharedSystemClient is not None and hasattr(SharedSystemClient, "clear_system_cache"):
+        SharedSystemClient.clear_system_cache()
+
+
+def get_chroma_client():
+    if not chroma_enabled:
+        return None
+    with _chroma_lock:
+        client = _chroma_clients.get(os.getpid())
+        if client is None:
+            if _chroma_clients:
+                # Heredado del maestro por el fork
+                _forget_chroma_clients()
+            client = _chroma_clients[os.getpid()] = PersistentClient(path=CHROMA_DB_PATH)
+            try:
+                # Intentar obtener o crear la colección silenciosamente
+                client.get_or_create_collection("ib_questions")
+            except Exception as e:
+                print(f"⚠️ ChromaDB Warning: {e}")
+        return client
+
+
+def load_vector_index(name, rebuild=False):
+    """Abre el índice exportado de una colección (exportándolo desde Chroma si falta)."""
+    path = os.path.join(VECTOR_INDEX_DIR, name)
+    if rebuild or not os.path.exists(os.path.join(path, "manifest.json")):
+        if not chroma_enabled:
+            return None
+        os.makedirs(VECTOR_INDEX_DIR, exist_ok=True)
+        export_collection(get_chroma_client().get_collection(name), path)
+    vector_indexes[name] = VectorIndex(path)
+    return vector_indexes[name]
+
+
+if embedding_provider is not None:
+    for name in filter(None, SYLLABUS_MAP.values()):
+        try:
+            load_vector_index(name)
+        except Exception as e:
+            print(f"⚠️ Vector index for '{name}' not available: {e}")
+    # Si para exportar un índice hubo que abrir Chroma aquí (en el maestro con
+    # preload), no dejar su cliente ni su System para los workers
+    with _chroma_lock:
+        if _chroma_clients:
+            _forget_chroma_clients()
+
+    if EMBEDDING_WARMUP_FILE:
+        def _warm_from_file():
+            try:
+                n = embedding_cache.warm(load_syllabus(EMBEDDING_WARMUP_FILE))
+                print(f"ℹ️ Embedding cache warmed with {n} syllabus queries")
+            except Exception as e:
+                print(f"⚠️ Embedding warm-up failed: {e}")
+
+        if EMBEDDING_WARMUP_BLOCKING:
+            _warm_from_file()
+        else:
+            # En segundo plano: el arranque no espera a la API de embeddings
+            threading.Thread(target=_warm_from_file, name="embedding-warmup", daemon=True).start()
+
+
+def _collection_for(program_raw):
+    for key, col_name in SYLLABUS_MAP.items():
+        if key in (program_raw or "").upper():
+            return col_name
+    return None
+
+
+def _pick_examples(candidates, k):
+    # Si encontramos menos candidatos que el Pool, usamos lo que haya.
+    # Elegimos 'k' al azar de este grupo de candidatos relevantes.
+    return random.sample(candidates, min(k, len(candidates)))
+
+
+def _index_candidates(index, embeddings, filters):
+    """Pool de candidatos del índice numpy para un lote de consultas con los mismos filtros."""
+    hits = index.search(embeddings, SEARCH_POOL_SIZE, index.mask(filters))
+    return [[{"id": index.ids[row], "text": index.documents[row]} for row, _ in rows] for rows in hits]
+
+
+@app.route("/retrieve", methods=["POST"])
+def retrieve():
+    try:
+        # 1. COMPROBAR CONFIGURACIÓN
+        if embedding_cache is None or not (vector_indexes or chroma_enabled):
+            print("⚠️ DB not initialized. Returning empty list.")
+            return jsonify({"examples": []})
+
+        # 2. OBTENER DATOS
+        data = request.get_json(force=True)
+        topic = data.get("topic")
+        archetype_description = data.get("archetype_description")
+
+        program_raw = data.get("syllabus", "")
+        k = int(data.get("k", 3)) # Cantidad final de ejemplos que la IA necesita
+        # Filtros de metadatos: {"topic", "archetype", "difficulty"} (ver VectorIndex.mask)
+        filters = data.get("filters")
+
+        if not topic:
+            return jsonify({"error": "Missing topic"}), 400
+
+        # 3. LÓGICA DE SELECCIÓN DE COLECCIÓN
+        target_collection_name = _collection_for(program_raw)
+        if not target_collection_name:
+            print(f"ℹ️ No database found for program: {program_raw}. Skipping retrieval.")
+            return jsonify({"examples": []})
+
+        # 4. BÚSQUEDA VECTORIAL (POOL GRANDE)
+        # El texto sale de un temario finito: casi siempre está en la cache
+        query_text = retrieval_query(topic, archetype_description)
+        with stage("embed"):
+            emb = embedding_cache.embed([query_text])
+
+        index = vector_indexes.get(target_collection_name)
+        if index is not None:
+            # Índice numpy en memoria compartida: sin pasar por el cliente de Chroma
+            with stage("search"):
+                all_candidates = _index_candidates(index, emb, filters)[0]
+        else:
+            try:
+                active_collection = get_chroma_client().get_collection(target_collection_name)
+            except Exception:
+                print(f"⚠️ Collection '{target_collection_name}' not found in DB.")
+                return jsonify({"examples": []})
+
+            # (los filtros solo se aplican con el índice numpy)
+            with stage("search"):
+                results = active_collection.query(
+                    query_embeddings=[emb[0].tolist()],
+                    n_results=SEARCH_POOL_SIZE  # Traemos 15 candidatos, no k
+                )
+            documents = results.get("documents", [[]])[0]
+            ids = results.get("ids", [[]])[0]
+            all_candidates = [{"id": qid, "text": doc} for doc, qid in zip(documents, ids)]
+
+        # 5. LÓGICA ESTOCÁSTICA (SHUFFLE & SLICE)
+        return jsonify({"examples": _pick_examples(all_candidates, k)})
+
+    except Exception as e:
+        # Se responde 200 con lista vacía: el error solo se ve en las métricas
+        mark_error("retrieval")
+        print(f"Error in retrieve: {e}")
+        return jsonify({"examples": []})
+
+
+@app.post("/retrieve/batch")
+def retrieve_batch():
+    """
+    Varias consultas en una petición: {"syllabus", "queries": [{"topic",
+    "archetype_description", "k", "filters"}]}. Las que comparten filtros
+    se resuelven con un solo producto de matrices.
+    """
     try:
         data = request.get_json(force=True)
-        file_b64 = data.get("base64")
-        filename = data.get("filename", "uploaded.png")
+        queries = data.get("queries") or []
+        if not queries:
+            return jsonify({"error": "Missing 'queries'"}), 400
+        if any(not isinstance(q, dict) or not q.get("topic") for q in queries):
+            return jsonify({"error": "Every query needs a 'topic'"}), 400
 
-        if not file_b64:
-            return jsonify({"error": "Missing 'base64'"}), 400
+        index = vector_indexes.get(_collection_for(data.get("syllabus", "")))
+        if embedding_cache is None or index is None:
+            return jsonify({"results": [{"examples": []} for _ in queries]})
 
-        if "," in file_b64:
-            file_b64 = file_b64.split(",")[1]
+        with stage("embed"):
+            embs = embedding_cache.embed([retrieval_query(q["topic"], q.get("archetype_description")) for q in queries])
 
-        os.makedirs("static", exist_ok=True)
-        file_path = os.path.join("static", filename)
+        by_filters = {}
+        for i, q in enumerate(queries):
+            by_filters.setdefault(json.dumps(q.get("filters"), sort_keys=True), []).append(i)
 
-        with open(file_path, "wb") as f:
-            f.write(base64.b64decode(file_b64))
-        
-        scheme = "https" if request.is_secure or request.headers.get("X-Forwarded-Proto") == "https" else "http"
-        return jsonify({"url": f"{scheme}://{request.host}/static/{filename}"})
+        results = [None] * len(queries)
+        with stage("search"):
+            for key, idxs in by_filters.items():
+                for i, candidates in zip(idxs, _index_candidates(index, embs[idxs], json.loads(key))):
+                    results[i] = {"examples": _pick_examples(candidates, int(queries[i].get("k", 3)))}
+        return jsonify({"results": results})
 
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.post("/retrieve/reindex")
+def retrieve_reindex():
+    """
+    Vuelve a exportar las colecciones desde Chroma. Otros procesos siguen
+    con el índice que tenían abierto hasta que se reinicien.
+    """
+    if not chroma_enabled:
+        return jsonify({"error": "ChromaDB not initialized"}), 503
+    try:
+        rebuilt = {name: load_vector_index(name, rebuild=True).stats()
+                   for name in filter(None, SYLLABUS_MAP.values())}
+        return jsonify({"indexes": rebuilt})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.post("/retrieve/warmup")
+def retrieve_warmup():
+    """Precalcula los embeddings de una lista de temas: {"items": [{"topic", "archetype_description"}]}."""
+    if embedding_cache is None:
+        return jsonify({"error": "No embedding provider configured"}), 503
+    try:
+        data = request.get_json(force=True)
+        queries = syllabus_queries(data.get("items") or [])
+        if not queries:
+            return jsonify({"error": "Missing 'items'"}), 400
+
+        started = time.time()
+        warmed = embedding_cache.warm(queries)
+        return jsonify({"warmed": warmed, "seconds": round(time.time() - started, 3), **embedding_cache.stats()})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.get("/retrieve/stats")
+def retrieve_stats():
+    if embedding_cache is None:
+        return jsonify({"error": "No embedding provider configured"}), 503
+    stats = embedding_cache.stats()
+    stats["indexes"] = {name: index.stats() for name, index in vector_indexes.items()}
+    return jsonify(stats)
+
 
 # ==========================================================
 # 5. START SERVER
 # ==========================================================
+# Producción: gunicorn -c gunicorn.conf.py app:app (ver Dockerfile).
+# app.run es el servidor de desarrollo de Flask (un solo proceso).
 if __name__ == "__main__":
     # En Render, PORT viene como variable de entorno
     port = int(os.environ.get("PORT", 8080))
@@ -0,0 +1,118 @@
+"""
+Micro-benchmark de /parse_strokes: la versión original (pydantic por punto
++ compute_bbox en listas + Symbol.dict()) contra el camino de numpy de
+stroke_geometry, con y sin devolver los puntos, y el formato binario
+compacto (tamaño del cuerpo y tiempo de decodificación). Incluye el
+json.loads del cuerpo, que es parte del coste real de la petición.
+
+    python bench/bench_parse_strokes.py [--strokes 100,1000,5000] [--points 50] [--repeat 5]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from typing import List
+
+from pydantic import BaseModel
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stroke_geometry import decode_elements, decode_strokes, encode_strokes, symbols_json  # noqa: E402
+
+
+# ---------- Copia literal de la versión original ----------
+class Stroke(BaseModel):
+    id: str
+    points: List[List[float]]
+    strokeWidth: float = None
+    strokeColor: str = None
+    groupIds: List[str] = []
+    frameId: str = None
+    seed: int = None
+
+class ParseRequest(BaseModel):
+    elements: List[Stroke]
+
+class Symbol(BaseModel):
+    id: str
+    bbox: List[float]
+    points: List[List[float]]
+
+def compute_bbox(points):
+    if not points: return [0,0,0,0]
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def legacy_parse(body):
+    req = ParseRequest(**json.loads(body))
+    symbols = []
+    for el in req.elements:
+        if not el.points:
+            continue
+        symbols.append(Symbol(id=el.id, bbox=compute_bbox(el.points), points=el.points))
+    return [s.dict() for s in symbols]
+
+
+def fast_parse(body, include_points=False):
+    return symbols_json(decode_elements(json.loads(body)["elements"]), include_points)
+
+
+def binary_parse(data):
+    return symbols_json(decode_strokes(data))
+
+
+# ---------- Datos sintéticos ----------
+def make_payload(n_strokes, n_points, seed=0):
+    """Trazos de pizarra: paseos aleatorios cortos repartidos por el lienzo."""
+    rng = random.Random(seed)
+    elements = []
+    for i in range(n_strokes):
+        x, y = rng.uniform(0, 2000), rng.uniform(0, 1500)
+        points = []
+        for _ in range(n_points):
+            x += rng.uniform(-3, 3)
+            y += rng.uniform(-3, 3)
+            points.append([round(x, 2), round(y, 2)])
+        elements.append({"id": f"s{i}", "points": points, "strokeWidth": 2,
+                         "strokeColor": "#1e1e1e", "groupIds": [], "seed": i})
+    return json.dumps({"elements": elements})
+
+
+def best_of(fn, arg, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--strokes", default="100,1000,5000")
+    parser.add_argument("--points", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'strokes':>8} {'points':>9} {'MB':>6} {'bin MB':>7} {'legacy ms':>10} {'numpy ms':>9} "
+          f"{'+points ms':>11} {'binary ms':>10} {'speedup':>8} {'Mpts/s':>7} {'same bbox':>10}")
+    for n in map(int, args.strokes.split(",")):
+        body = make_payload(n, args.points)
+        data = encode_strokes(json.loads(body)["elements"])
+        legacy = best_of(legacy_parse, body, args.repeat)
+        fast = best_of(fast_parse, body, args.repeat)
+        with_points = best_of(lambda b: fast_parse(b, True), body, args.repeat)
+        binary = best_of(binary_parse, data, args.repeat)
+        same = [s["bbox"] for s in legacy_parse(body)] == [s["bbox"] for s in fast_parse(body)]
+        total = n * args.points
+        print(f"{n:>8} {total:>9} {len(body) / 1e6:>6.1f} {len(data) / 1e6:>7.2f} {legacy * 1000:>10.1f} "
+              f"{fast * 1000:>9.1f} {with_points * 1000:>11.1f} {binary * 1000:>10.1f} {legacy / fast:>7.2f}x "
+              f"{total / fast / 1e6:>7.2f} {str(same):>10}")
+
+if __name__ == "__main__":
+    main()
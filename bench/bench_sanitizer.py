@@ -0,0 +1,79 @@
+"""
+Micro-benchmark del sanitizador: la versión secuencial original
+(varios re.sub / str.replace) contra el motor de una sola pasada de
+latex_sanitizer, más el coste del pre-flight.
+
+    python bench/bench_sanitizer.py [--sizes 10,100,1000] [--repeat 20]
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from latex_sanitizer import DEFAULT_SANITIZER, preflight  # noqa: E402
+
+
+def legacy_sanitize_latex(latex_code):
+    """Copia literal de sanitize_latex antes del motor de reglas."""
+    latex_code = re.sub(r'\\usepackage(\[.*\])?\{microtype\}', '', latex_code)
+    latex_code = re.sub(r'\\\[\s*(\d+[a-z]{2})\]', r'\\\\[\1]', latex_code)
+    latex_code = re.sub(r'^\s*\\\\\[', r'\\[', latex_code, flags=re.MULTILINE)
+    latex_code = latex_code.replace(", diamond", ", circle")
+    latex_code = latex_code.replace("diamond,", "circle,")
+    latex_code = latex_code.replace("[diamond]", "[circle]")
+    return latex_code
+
+
+def make_document(n_exercises):
+    """Documento grande estilo IA a partir de request.json y doc.tex."""
+    with open(os.path.join(ROOT, "request.json"), encoding="utf-8") as f:
+        exercise = json.load(f)
+    with open(os.path.join(ROOT, "doc.tex"), encoding="utf-8") as f:
+        tikz = f.read().split("\\begin{document}")[1].split("\\end{document}")[0]
+
+    # Las alucinaciones típicas que corrige el sanitizador
+    noise = "Texto \\[2mm] más texto\n\\node[diamond] at (0,0) {};\n\\\\[ x^2 \\]\n"
+    parts = ["\\documentclass[12pt]{article}\n\\usepackage{amsmath}\n\\usepackage{tikz}\n"
+             "\\usepackage[protrusion=true]{microtype}\n\\begin{document}\n"]
+    for i in range(n_exercises):
+        parts.append(f"\\section*{{Exercise {i + 1}}}\n")
+        parts.append(exercise["question"] + "\n\n" + exercise["answer"] + "\n")
+        parts.append(exercise["diagram"] + "\n" + tikz + "\n" + noise)
+    parts.append("\\end{document}\n")
+    return "".join(parts)
+
+
+def best_of(fn, arg, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1,10,100,1000")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'exercises':>9} {'KB':>8} {'legacy ms':>10} {'engine ms':>10} {'speedup':>8} "
+          f"{'preflight ms':>13} {'same output':>12}")
+    for n in map(int, args.sizes.split(",")):
+        doc = make_document(n)
+        legacy = best_of(legacy_sanitize_latex, doc, args.repeat)
+        engine = best_of(DEFAULT_SANITIZER.sanitize, doc, args.repeat)
+        check = best_of(preflight, doc, args.repeat)
+        same = legacy_sanitize_latex(doc) == DEFAULT_SANITIZER.sanitize(doc)[0]
+        print(f"{n:>9} {len(doc) / 1024:>8.1f} {legacy * 1000:>10.3f} {engine * 1000:>10.3f} "
+              f"{legacy / engine:>7.2f}x {check * 1000:>13.3f} {str(same):>12}")
+
+
+if __name__ == "__main__":
+    main()
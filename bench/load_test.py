@@ -0,0 +1,375 @@
+"""
+Prueba de carga reproducible de /compile, /render_exercise, /parse_strokes
+y /upload con un corpus fijo: doc.tex, el ejercicio de request.json (como
+documento y como /render_exercise), trazos sintéticos de tamaño creciente
+(JSON y binario) y output.png. Cada escenario se lanza con N clientes a la
+vez (bucle cerrado) y se mide p50/p95/p99, throughput, pico de RSS del
+servidor (proceso + hijos: pdflatex incluido) y la media de cada etapa del
+header Server-Timing.
+
+    python bench/load_test.py [--mode inprocess|http] [--url http://localhost:8080]
+                              [--server-pid PID] [--scenarios compile_doc,parse_strokes_1000]
+                              [--concurrency 1,4,16] [--requests 50] [--warmup 2]
+                              [--out results.json] [--baseline results_main.json] [--tolerance 0.10]
+
+Los escenarios *_cold añaden un comentario único por petición: siempre
+fallan en la cache de renders y miden la compilación completa. Con
+--baseline se compara contra otro resultado y el código de salida es 1 si
+algún escenario empeora más de --tolerance.
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import base64
+import platform
+import argparse
+import threading
+import subprocess
+import http.client
+from itertools import count
+from urllib.parse import urlsplit
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_parse_strokes import make_payload  # noqa: E402
+from exercise_render import EXERCISE_PARTS, PAGE_PREAMBLE, TIKZ_PREAMBLE  # noqa: E402
+from stroke_geometry import STROKES_MIMETYPE, encode_strokes  # noqa: E402
+
+
+# ---------- Corpus ----------
+def _read(name, mode="r"):
+    with open(os.path.join(ROOT, name), mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+        return f.read()
+
+
+def exercise_document(exercise):
+    """El ejercicio de request.json como documento completo (tikz incluido)."""
+    body = "\n\\par\\medskip\n".join(exercise[name] for name in EXERCISE_PARTS if exercise.get(name))
+    return f"{PAGE_PREAMBLE}{TIKZ_PREAMBLE}\\begin{{document}}\n{body}\n\\end{{document}}\n"
+
+
+def _json(path, payload):
+    return lambda i: ("POST", path, {"Content-Type": "application/json"}, json.dumps(payload).encode())
+
+
+def _compile(latex, cold, run_id, options=None):
+    nonce = count()
+
+    def build(i):
+        source = latex
+        if cold:
+            # Comentario único en toda la ejecución: misma compilación, clave de cache distinta
+            end = source.rfind("\\end{document}")
+            source = f"{source[:end]}% bench {run_id} {next(nonce)}\n{source[end:]}"
+        payload = {"latex_base64": base64.b64encode(source.encode("utf-8")).decode(), "output": "url"}
+        if options:
+            payload["options"] = options
+        return "POST", "/compile", {"Content-Type": "application/json"}, json.dumps(payload).encode()
+    return build
+
+
+def build_scenarios(run_id):
+    """{nombre: función(i) -> (método, ruta, headers, cuerpo)}; todo determinista salvo run_id."""
+    doc = _read("doc.tex")
+    exercise = json.loads(_read("request.json"))
+    exercise_doc = exercise_document(exercise)
+    png_b64 = base64.b64encode(_read("output.png", "rb")).decode()
+
+    scenarios = {
+        "compile_doc": _compile(doc, False, run_id),
+        "compile_doc_cold": _compile(doc, True, run_id),
+        "compile_exercise": _compile(exercise_doc, False, run_id),
+        "compile_exercise_cold": _compile(exercise_doc, True, run_id),
+        "render_exercise": _json("/render_exercise", {**exercise, "output": "url"}),
+        "upload": _json("/upload", {"base64": png_b64, "filename": "bench_upload.png"}),
+    }
+    for n in (100, 1000, 5000):
+        body = make_payload(n, 50).encode()
+        scenarios[f"parse_strokes_{n}"] = \
+            lambda i, body=body: ("POST", "/parse_strokes", {"Content-Type": "application/json"}, body)
+    binary = encode_strokes(json.loads(make_payload(1000, 50))["elements"])
+    scenarios["parse_strokes_1000_binary"] = \
+        lambda i: ("POST", "/parse_strokes", {"Content-Type": STROKES_MIMETYPE}, binary)
+    return scenarios
+
+
+# ---------- Clientes ----------
+class InProcessClient:
+    """Llama a la app Flask directamente (sin red): mide solo el servidor."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers, body):
+        response = self.client.open(path, method=method, headers=headers, data=body)
+        response.get_data()
+        status, timing = response.status_code, response.headers.get("Server-Timing")
+        response.close()
+        return status, timing
+
+
+class HTTPClient:
+    """Una conexión keep-alive por cliente; se reabre si el servidor la cierra."""
+
+    def __init__(self, url, timeout=300):
+        parts = urlsplit(url)
+        cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.connect = lambda: cls(parts.hostname, parts.port, timeout=timeout)
+        self.prefix = parts.path.rstrip("/")
+        self.conn = self.connect()
+
+    def request(self, method, path, headers, body):
+        for attempt in (0, 1):
+            try:
+                self.conn.request(method, self.prefix + path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                response.read()
+                return response.status, response.getheader("Server-Timing")
+            except (http.client.HTTPException, ConnectionError):
+                self.conn.close()
+                self.conn = self.connect()
+                if attempt:
+                    raise
+
+
+# ---------- RSS ----------
+def tree_rss(pid):
+    """RSS en bytes de pid y todos sus descendientes (/proc, solo Linux) o None."""
+    total, stack, seen = 0, [pid], False
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        seen = True
+            for task in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{task}/children") as f:
+                    stack.extend(int(c) for c in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total if seen else None
+
+
+class RSSSampler:
+    """Muestrea tree_rss(pid) en segundo plano y guarda el máximo."""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while True:
+            rss = tree_rss(self.pid)
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        if self.pid:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+# ---------- Ejecución ----------
+def percentile(ordered, q):
+    """Percentil por rango más cercano sobre una lista ya ordenada."""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def parse_server_timing(value):
+    stages = {}
+    for part in (value or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.startswith("dur="):
+            try:
+                stages[name] = float(params[4:])
+            except ValueError:
+                pass
+    return stages
+
+
+def run_scenario(name, build, make_client, concurrency, n_requests, warmup, pid):
+    """Lanza n_requests peticiones con `concurrency` clientes y devuelve el resumen."""
+    client = make_client()
+    for i in range(warmup):
+        client.request(*build(i))
+
+    lock = threading.Lock()
+    latencies, statuses, stage_ms = [], Counter(), defaultdict(list)
+    failures = []
+    ticket = count(warmup)
+    last = warmup + n_requests
+
+    def worker():
+        client = make_client()
+        while True:
+            i = next(ticket)
+            if i >= last:
+                return
+            request = build(i)
+            started = time.perf_counter()
+            try:
+                status, timing = client.request(*request)
+            except Exception as e:
+                status, timing = "exception", None
+                failures.append(str(e))
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(status)] += 1
+                for stage, ms in parse_server_timing(timing).items():
+                    stage_ms[stage].append(ms)
+
+    with RSSSampler(pid) as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            for _ in range(concurrency):
+                pool.submit(worker)
+        wall = time.perf_counter() - started
+
+    ordered = sorted(latencies)
+    ok = sum(n for status, n in statuses.items() if status.startswith("2"))
+    ms = lambda s: round(s * 1000, 2) if s is not None else None  # noqa: E731
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "ok": ok,
+        "statuses": dict(statuses),
+        "p50_ms": ms(percentile(ordered, 0.50)),
+        "p95_ms": ms(percentile(ordered, 0.95)),
+        "p99_ms": ms(percentile(ordered, 0.99)),
+        "mean_ms": ms(sum(ordered) / len(ordered)) if ordered else None,
+        "max_ms": ms(ordered[-1]) if ordered else None,
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "peak_rss_mb": round(sampler.peak / 2 ** 20, 1) if sampler.peak else None,
+        "stages_mean_ms": {stage: round(sum(v) / len(v), 2) for stage, v in stage_ms.items()},
+        "errors": failures[:5],
+    }
+
+
+# ---------- Comparación ----------
+# (métrica, True si más alto es peor)
+COMPARED = (("p50_ms", True), ("p95_ms", True), ("p99_ms", True), ("throughput_rps", False))
+
+
+def compare(results, baseline, tolerance):
+    """Imprime la diferencia con la línea base y devuelve los empeoramientos."""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\n{'scenario':<28} {'conc':>4} " + " ".join(f"{metric:>16}" for metric, _ in COMPARED))
+    for r in results:
+        old = previous.get((r["scenario"], r["concurrency"]))
+        if old is None:
+            continue
+        cells = []
+        for metric, higher_is_worse in COMPARED:
+            if not old.get(metric) or r.get(metric) is None:
+                cells.append(f"{'-':>16}")
+                continue
+            change = r[metric] / old[metric] - 1
+            worse = change > tolerance if higher_is_worse else change < -tolerance
+            if worse:
+                regressions.append({"scenario": r["scenario"], "concurrency": r["concurrency"],
+                                    "metric": metric, "baseline": old[metric], "current": r[metric]})
+            cells.append(f"{change * 100:>+14.1f}%{'!' if worse else ' '}")
+        print(f"{r['scenario']:<28} {r['concurrency']:>4} " + " ".join(cells))
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("inprocess", "http"), default="inprocess")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--server-pid", type=int, help="pid del servidor (http) para medir su RSS")
+    parser.add_argument("--scenarios", help="lista separada por comas (por defecto todos)")
+    parser.add_argument("--concurrency", default="1,4")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--out")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:12]
+    scenarios = build_scenarios(run_id)
+    names = args.scenarios.split(",") if args.scenarios else list(scenarios)
+    unknown = [n for n in names if n not in scenarios]
+    if unknown:
+        parser.error(f"unknown scenarios {unknown}; available: {', '.join(scenarios)}")
+
+    if args.mode == "inprocess":
+        from app import app  # importar aquí: el modo http no necesita las dependencias de la app
+        make_client = lambda: InProcessClient(app)  # noqa: E731
+        pid = os.getpid()
+    else:
+        make_client = lambda: HTTPClient(args.url)  # noqa: E731
+        pid = args.server_pid
+
+    results = []
+    print(f"{'scenario':<28} {'conc':>4} {'n':>5} {'ok':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'req/s':>8} {'peak MB':>8}")
+    for name in names:
+        for concurrency in map(int, args.concurrency.split(",")):
+            r = run_scenario(name, scenarios[name], make_client, concurrency, args.requests, args.warmup, pid)
+            results.append(r)
+            print(f"{name:<28} {concurrency:>4} {r['requests']:>5} {r['ok']:>5} {r['p50_ms'] or 0:>9.1f} "
+                  f"{r['p95_ms'] or 0:>9.1f} {r['p99_ms'] or 0:>9.1f} {r['throughput_rps'] or 0:>8.1f} "
+                  f"{r['peak_rss_mb'] or 0:>8.1f}")
+
+    report = {
+        "meta": {
+            "mode": args.mode,
+            "url": args.url if args.mode == "http" else None,
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) above {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+El motor de reglas tiene que dar lo mismo que el sanitize_latex original
+salvo en los casos a propósito de test_differs_from_legacy, y el pre-flight
+solo puede rechazar lo que va a fallar seguro.
+
+    python -m pytest bench
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_sanitizer import legacy_sanitize_latex, make_document  # noqa: E402
+from latex_sanitizer import DEFAULT_SANITIZER, preflight  # noqa: E402
+
+
+def _document(body):
+    return "\\documentclass{article}\n\\begin{document}\n" + body + "\n\\end{document}\n"
+
+
+@pytest.mark.parametrize("latex_code", [
+    make_document(3),
+    "\\usepackage[protrusion=true]{microtype}\n\\usepackage{microtype}",
+    "Texto \\[2mm] más \\[ 10pt] y \\[x^2\\]",
+    "  \\\\[ x^2 \\]\n\\\\[\n\\node[diamond] at (0,0) {};",
+    "\\node[draw, diamond, fill] {}; \\node[diamond,draw] {}; \\tikzset{s/.style={shape=diamond}}",
+    "\\node[diamond, diamond] {}; [diamond], diamond,",
+    "a \\\\\\[2mm] b",              # \\\[2mm]: \\ y luego un \[ que sí abre ecuación
+    "a\n \\\\[diamond] b",
+    "a\n\n\t  \\\\[ x \\]",
+    "a\n   \n\\[ 3pt] b",
+    "\n\n\\[2mm]",
+    "",
+])
+def test_same_output_as_legacy(latex_code):
+    assert DEFAULT_SANITIZER.sanitize(latex_code)[0] == legacy_sanitize_latex(latex_code)
+
+
+@pytest.mark.parametrize("latex_code, expected", [
+    # La versión vieja convertía un \\[2mm] correcto en \\\[2mm] (ecuación sin cerrar)
+    ("a \\\\[2mm] b", "a \\\\[2mm] b"),
+    # Con [.*] borraba también los paquetes de delante en la misma línea
+    ("\\usepackage[a]{amsmath}\\usepackage[b]{microtype}", "\\usepackage[a]{amsmath}"),
+    # Cada pasada veía lo que dejaba la anterior: al borrar microtype la línea
+    # vacía se la comía la regla de inicio de línea. En una pasada no se ve
+    ("\\usepackage{microtype}\n\\\\[ x", "\n\\[ x"),
+])
+def test_differs_from_legacy(latex_code, expected):
+    assert DEFAULT_SANITIZER.sanitize(latex_code)[0] == expected
+    assert legacy_sanitize_latex(latex_code) != expected
+
+
+@pytest.mark.parametrize("body", [
+    "\\verb|{|",
+    "\\verb*+}+ y \\verb!\\end{itemize}!",
+    "\\lstinline|{| \\lstinline[language=C]{if (x) { y; }}",
+    "\\begin{verbatim}\n{ \\begin{itemize}\n\\end{verbatim}",
+    "\\% \\{ 50\\% % comentario con { sin cerrar",
+    "\\\\[2mm] línea",
+    "\\url{http://example.com/a%20b} \\href{http://x.org/%7E}{50\\%}",
+    "\\usepackage{pythontex,sagetex,svg,shellesc}\n\\immediate\\write18{ls}",
+])
+def test_preflight_accepts(body):
+    assert preflight(_document("\\usepackage{epstopdf}\n" + body)) == []
+
+
+@pytest.mark.parametrize("body, kind", [
+    ("{", "brace"),
+    ("}", "brace"),
+    ("\\begin{itemize}", "environment"),
+    ("\\end{center}", "environment"),
+    ("\\[ x", "display_math"),
+    ("\\usepackage{minted}", "banned_package"),
+])
+def test_preflight_rejects(body, kind):
+    assert kind in [issue["type"] for issue in preflight(_document(body))]
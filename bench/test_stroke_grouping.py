@@ -0,0 +1,93 @@
+"""
+stroke_grouping contra las versiones directas: búsqueda de pares por
+fuerza bruta y RDP recursivo.
+
+    python -m pytest bench
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stroke_geometry import decode_elements  # noqa: E402
+from stroke_grouping import proximity_pairs, simplify  # noqa: E402
+
+
+def brute_force_pairs(bboxes, gap):
+    pairs = []
+    for i in range(len(bboxes)):
+        for j in range(i + 1, len(bboxes)):
+            a, b = bboxes[i], bboxes[j]
+            dx = max(0.0, max(a[0], b[0]) - min(a[2], b[2]))
+            dy = max(0.0, max(a[1], b[1]) - min(a[3], b[3]))
+            if np.hypot(dx, dy) <= gap:
+                pairs.append((i, j))
+    return pairs
+
+
+def recursive_rdp(points, epsilon):
+    if len(points) < 3:
+        return points
+    a, b = points[0], points[-1]
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    norm = np.hypot(dx, dy)
+    inner = points[1:-1]
+    if norm > 0:
+        dist = np.abs(dx * (inner[:, 1] - a[1]) - dy * (inner[:, 0] - a[0])) / norm
+    else:
+        dist = np.hypot(inner[:, 0] - a[0], inner[:, 1] - a[1])
+    k = int(np.argmax(dist))
+    if dist[k] <= epsilon:
+        return np.array([a, b])
+    left = recursive_rdp(points[:k + 2], epsilon)
+    right = recursive_rdp(points[k + 1:], epsilon)
+    return np.concatenate([left[:-1], right])
+
+
+def random_boxes(rng, n, dots=0.5):
+    xy = rng.uniform(0, 1000, (n, 2))
+    wh = rng.exponential(20, (n, 2)) * (rng.random((n, 1)) >= dots)
+    return np.hstack([xy, xy + wh])
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("gap", [0.0, 5.0, 40.0])
+def test_pairs_match_brute_force(seed, gap):
+    rng = np.random.default_rng(seed)
+    bboxes = random_boxes(rng, int(rng.integers(2, 120)))
+    if seed % 4 == 0:
+        # Una caja que cubre casi todo el lienzo (más celdas que MAX_CELLS_PER_BOX)
+        bboxes[0] = [0, 0, 950, 950]
+    found = sorted(map(tuple, proximity_pairs(bboxes, gap).tolist()))
+    assert found == brute_force_pairs(bboxes, gap)
+
+
+def test_pairs_of_dots_without_gap():
+    # Mediana de tamaño 0 y gap 0: la celda no puede bajar de lienzo / MAX_GRID_SIDE
+    rng = np.random.default_rng(0)
+    xy = rng.uniform(0, 5000, (20000, 2))
+    xy[1] = xy[0]
+    pairs = proximity_pairs(np.hstack([xy, xy]), 0.0)
+    assert [0, 1] in pairs.tolist()
+
+
+@pytest.mark.parametrize("epsilon", [0.5, 2.0, 10.0])
+def test_simplify_matches_recursive_rdp(epsilon):
+    rng = np.random.default_rng(1)
+    elements = []
+    for i in range(40):
+        n = int(rng.integers(0, 200))
+        walk = np.cumsum(rng.normal(0, 3, (n, 2)), axis=0)
+        if i % 10 == 0 and n:
+            walk[-1] = walk[0]   # trazo cerrado: extremos iguales
+        elements.append({"id": str(i), "points": walk.tolist()})
+    batch = decode_elements(elements)
+
+    simplified = simplify(batch, epsilon)
+    for i in range(len(batch)):
+        expected = recursive_rdp(batch.points(i), epsilon)
+        assert np.array_equal(simplified.points(i), expected), batch.ids[i]
@@ -0,0 +1,243 @@
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from latex_compiler import CompileError
+from request_timing import annotate, stage
+
+
+# ==========================================================
+# COSTE ESTIMADO DE UNA COMPILACIÓN
+# ==========================================================
+_TIKZPICTURE = re.compile(r"\\begin\{tikzpicture\}")
+_AXIS = re.compile(r"\\begin\{(?:axis|semilogxaxis|semilogyaxis|loglogaxis|polaraxis)\}")
+_ADDPLOT = re.compile(r"\\addplot(3?)\b")
+# Operación plot de TikZ (\draw ... plot (\x, {f(\x)}), plot coordinates, plot function)
+_TIKZ_PLOT = re.compile(r"(?<![\w\\])plot\b\s*(?:\[[^\]]*\])?\s*(?:\(|\{|coordinates\b|function\b|file\b)")
+_DOMAIN = re.compile(r"\bdomain\s*=")
+_SAMPLES = re.compile(r"\bsamples(?:\s+y)?\s*=\s*\{?\s*(\d+)")
+_FOREACH_TOKENS = re.compile(r"\\foreach\b|[{};]")
+
+# pgfplots y TikZ usan 25 muestras si no se indica otra cosa
+DEFAULT_SAMPLES = 25
+
+# Segundos de pdflatex por unidad de cada rasgo (medidos a ojo en un core;
+# CostModel corrige la escala con los tiempos observados)
+WEIGHTS = {
+    "base": 0.4,
+    "per_100k_chars": 0.5,
+    "tikzpicture": 0.25,
+    "axis": 0.6,
+    "sample": 0.006,
+    "foreach": 0.3,
+}
+
+
+def _foreach_depth(latex_code):
+    """
+    Anidamiento máximo de \\foreach. El cuerpo puede ir entre llaves
+    (termina en su "}") o sin ellas (termina en el ";" del comando).
+    """
+    depth = 0
+    open_bodies = []     # [profundidad de llave del cuerpo o None si va sin llaves]
+    expect = None        # "list" tras \foreach, "in_list" dentro de su lista, "body" tras ella
+    list_depth = 0
+    deepest = 0
+    for m in _FOREACH_TOKENS.finditer(latex_code):
+        token = m.group()
+        if token == "\\foreach":
+            open_bodies.append(None)
+            deepest = max(deepest, len(open_bodies))
+            expect = "list"
+        elif token == "{":
+            depth += 1
+            if expect == "list":
+                expect, list_depth = "in_list", depth
+            elif expect == "body":
+                open_bodies[-1] = depth
+                expect = None
+        elif token == "}":
+            if expect == "in_list" and depth == list_depth:
+                expect = "body"
+            depth -= 1
+            while open_bodies and open_bodies[-1] is not None and open_bodies[-1] > depth:
+                open_bodies.pop()
+        else:
+            # ";" cierra los cuerpos sin llaves abiertos al final
+            while open_bodies and open_bodies[-1] is None and expect != "in_list":
+                open_bodies.pop()
+            if expect != "in_list":
+                expect = None
+    return deepest
+
+
+def features(latex_code):
+    """Rasgos que más pesan en el tiempo de pdflatex."""
+    plots = _ADDPLOT.findall(latex_code)
+    axes = len(_AXIS.findall(latex_code))
+    samples = [int(n) for n in _SAMPLES.findall(latex_code)]
+    # Caminos con domain= que no son de pgfplots (ni de un \addplot ni de las opciones de un axis)
+    domain_paths = max(0, len(_DOMAIN.findall(latex_code)) - len(plots) - axes)
+    tikz_plots = max(len(_TIKZ_PLOT.findall(latex_code)), domain_paths)
+    return {
+        "chars": len(latex_code),
+        "tikzpictures": len(_TIKZPICTURE.findall(latex_code)),
+        "axes": axes,
+        "plots": len(plots) + tikz_plots,
+        "plots_3d": sum(1 for dim in plots if dim),
+        "max_samples": max(samples, default=DEFAULT_SAMPLES),
+        "foreach_depth": _foreach_depth(latex_code),
+    }
+
+
+def static_cost(f, weights=WEIGHTS):
+    """Segundos estimados a partir de los rasgos (sin haber compilado nunca el documento)."""
+    samples = f["max_samples"]
+    # Una superficie 3D evalúa samples x samples puntos
+    points = (f["plots"] - f["plots_3d"]) * samples + f["plots_3d"] * samples * samples
+    cost = weights["base"] + weights["per_100k_chars"] * f["chars"] / 100000
+    cost += weights["tikzpicture"] * f["tikzpictures"] + weights["axis"] * f["axes"]
+    cost += weights["sample"] * points
+    if f["foreach_depth"]:
+        cost += weights["foreach"] * 4 ** (f["foreach_depth"] - 1)
+    return cost
+
+
+class CostModel:
+    """
+    Estimación en segundos de compilar un documento. Si ya se compiló (hash
+    del fuente sanitizado) se usa la media móvil (EWMA) de lo observado;
+    si no, static_cost() por un factor de escala que se ajusta con los
+    documentos cuya estimación pasa de `calibrate_above` segundos (en los
+    baratos manda el arranque de pdflatex, no los rasgos). Vive en memoria
+    de cada proceso: cada worker aprende de lo que compila él.
+    """
+
+    def __init__(self, alpha=0.3, max_entries=10000, weights=WEIGHTS, calibrate_above=1.0):
+        self.alpha = alpha
+        self.max_entries = max_entries
+        self.weights = weights
+        self.calibrate_above = calibrate_above
+        self._lock = threading.Lock()
+        self._observed = OrderedDict()   # hash -> segundos (EWMA)
+        self._scale = 1.0
+        self.observations = 0
+
+    @staticmethod
+    def key(latex_code):
+        return hashlib.sha256(latex_code.encode("utf-8")).hexdigest()
+
+    def estimate(self, latex_code):
+        """(segundos, "observed" | "static")"""
+        key = self.key(latex_code)
+        with self._lock:
+            seconds = self._observed.get(key)
+            if seconds is not None:
+                self._observed.move_to_end(key)
+                return seconds, "observed"
+            scale = self._scale
+        return static_cost(features(latex_code), self.weights) * scale, "static"
+
+    def observe(self, latex_code, seconds, timed_out=False):
+        """
+        Apunta un tiempo de compilación. Con `timed_out` es solo una cota
+        (tardó al menos eso): sube la estimación del documento de golpe y no
+        toca la escala global.
+        """
+        key = self.key(latex_code)
+        predicted = None if timed_out else static_cost(features(latex_code), self.weights)
+        with self._lock:
+            previous = self._observed.pop(key, None)
+            if previous is None:
+                self._observed[key] = seconds
+            elif timed_out:
+                self._observed[key] = max(previous, seconds)
+            else:
+                self._observed[key] = previous + self.alpha * (seconds - previous)
+            while len(self._observed) > self.max_entries:
+                self._observed.popitem(last=False)
+            if predicted is not None and predicted >= self.calibrate_above:
+                ratio = min(8.0, max(0.25, seconds / predicted))
+                self._scale += self.alpha * (ratio - self._scale)
+            self.observations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "documents": len(self._observed),
+                "observations": self.observations,
+                "scale": round(self._scale, 3),
+            }
+
+
+# ==========================================================
+# CARRILES RÁPIDO / PESADO
+# ==========================================================
+class CompileLanes:
+    """
+    Dos CompileScheduler: "fast" para lo barato y "heavy" para lo que el
+    CostModel estima en `threshold` segundos o más, cada uno con sus hilos,
+    su cola y su timeout. Así un pgfplots con samples=200 no deja detrás de
+    él a los documentos de solo texto.
+
+    El carril rápido tiene un timeout fijo (`fast_timeout`); en el pesado
+    es `timeout_factor` veces lo estimado, entre fast_timeout y
+    `heavy_timeout`. Un timeout cuenta como observación, así que el mismo
+    documento la siguiente vez va al carril pesado con más margen.
+    """
+
+    def __init__(self, fast, heavy, model, threshold=2.0, fast_timeout=15, heavy_timeout=60, timeout_factor=3):
+        self.fast = fast
+        self.heavy = heavy
+        self.model = model
+        self.threshold = threshold
+        self.fast_timeout = fast_timeout
+        self.heavy_timeout = heavy_timeout
+        self.timeout_factor = timeout_factor
+
+    def plan(self, latex_code):
+        """(carril, segundos estimados, origen de la estimación, timeout)"""
+        with stage("cost"):
+            estimate, source = self.model.estimate(latex_code)
+        if estimate < self.threshold:
+            return "fast", estimate, source, self.fast_timeout
+        timeout = min(self.heavy_timeout, max(self.fast_timeout, self.timeout_factor * estimate))
+        return "heavy", estimate, source, timeout
+
+    def run(self, latex_code, fn, *args, **kwargs):
+        """
+        fn(*args, timeout=..., **kwargs) en el carril que toque según el
+        coste de `latex_code`, y apunta lo que tardó.
+        """
+        lane, estimate, source, timeout = self.plan(latex_code)
+        annotate(lane=lane, cost=round(estimate, 2), cost_source=source)
+        scheduler = self.heavy if lane == "heavy" else self.fast
+
+        elapsed = []
+
+        def timed():
+            started = time.monotonic()
+            try:
+                return fn(*args, timeout=timeout, **kwargs)
+            finally:
+                elapsed.append(time.monotonic() - started)
+
+        try:
+            result = scheduler.run(timed)
+        except CompileError as e:
+            # Los errores de LaTeX paran enseguida (-halt-on-error): su tiempo no dice nada
+            if e.status == 408 and elapsed:
+                self.model.observe(latex_code, max(elapsed[0], timeout, self.threshold), timed_out=True)
+            raise
+        self.model.observe(latex_code, elapsed[0])
+        return result
+
+    def stats(self):
+        return {
+            "threshold": self.threshold,
+            "fast_timeout": self.fast_timeout,
+            "heavy_timeout": self.heavy_timeout,
+            "cost_model": self.model.stats(),
+        }
@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ==========================================================
+# TRABAJOS DE COMPILACIÓN ASÍNCRONOS (submit / poll / fetch)
+# ==========================================================
+class Job:
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = "queued"   # queued -> running -> done | failed
+        self.created_at = time.time()
+        self.finished_at = None
+        self.files = {}          # nombre -> ruta dentro del directorio del job
+        self.error = None        # payload JSON del error
+        self.error_status = None
+        self.cached = False
+        self.pid = os.getpid()   # proceso que lo ejecuta
+
+    def to_dict(self):
+        data = {"job_id": self.id, "status": self.status, "created_at": self.created_at}
+        if self.status == "done":
+            data["cached"] = self.cached
+            data["artifacts"] = sorted(self.files)
+        elif self.status == "failed":
+            data["error"] = self.error
+        return data
+
+    def save(self, job_dir):
+        """Estado en job.json para que cualquier proceso del servidor pueda leerlo."""
+        state = {"id": self.id, "status": self.status, "created_at": self.created_at,
+                 "finished_at": self.finished_at, "files": sorted(self.files), "error": self.error,
+                 "error_status": self.error_status, "cached": self.cached, "pid": self.pid}
+        tmp = os.path.join(job_dir, f"job.json.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, os.path.join(job_dir, "job.json"))
+
+    @classmethod
+    def load(cls, job_dir):
+        with open(os.path.join(job_dir, "job.json")) as f:
+            state = json.load(f)
+        job = cls(state["id"])
+        job.status = state["status"]
+        job.created_at = state["created_at"]
+        job.finished_at = state["finished_at"]
+        job.files = {name: os.path.join(job_dir, name) for name in state["files"]}
+        job.error = state["error"]
+        job.error_status = state["error_status"]
+        job.cached = state["cached"]
+        job.pid = state.get("pid")
+        return job
+
+    def orphaned(self):
+        """Sin terminar y su proceso ya no existe (p.ej. worker reciclado por max_requests)."""
+        if self.finished_at is not None or self.pid is None:
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def mark_lost(self, job_dir):
+        self.status = "failed"
+        self.error = {"error": "Job lost: the worker running it exited"}
+        self.error_status = 500
+        self.finished_at = time.time()
+        self.save(job_dir)
+
+
+class JobStore:
+    """
+    Ejecuta renders en segundo plano y guarda sus resultados durante `ttl`
+    segundos. Los artefactos se enlazan (hard link) desde la cache de renders
+    al directorio del job, así que siguen disponibles aunque la cache los
+    desaloje antes de que el cliente los descargue.
+
+    El estado de cada job se escribe también en su directorio (job.json):
+    con varios procesos el sondeo puede caer en uno que no lanzó el job.
+    Cada `sweep_interval` segundos se barre el disco: se borran los jobs
+    caducados de cualquier proceso y los que se quedaron a medias porque
+    su worker murió pasan a "failed".
+    """
+
+    def __init__(self, root, ttl, max_pending, workers, sweep_interval=60):
+        self.root = root
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()   # job_id -> Job (por orden de creación)
+        self._pending = 0
+        self.sweep_interval = sweep_interval
+        self._swept_at = time.monotonic()
+
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def _purge_locked(self):
+        now = time.time()
+        # Los terminados están ordenados por hora de fin; los pendientes
+        # (como mucho max_pending) se saltan
+        for job in list(self._jobs.values()):
+            if job.finished_at is None:
+                continue
+            if now - job.finished_at < self.ttl:
+                break
+            del self._jobs[job.id]
+            shutil.rmtree(self._job_dir(job.id), ignore_errors=True)
+
+    def _maybe_sweep(self):
+        with self._lock:
+            if time.monotonic() - self._swept_at < self.sweep_interval:
+                return
+            self._swept_at = time.monotonic()
+        self.sweep()
+
+    def sweep(self):
+        """Borra del disco los jobs caducados y marca como fallidos los huérfanos."""
+        now = time.time()
+        for job_id in os.listdir(self.root):
+            job_dir = self._job_dir(job_id)
+            try:
+                job = Job.load(job_dir)
+            except (OSError, ValueError, KeyError):
+                # Sin job.json legible: recién creado o roto
+                try:
+                    if now - os.path.getmtime(job_dir) > self.ttl:
+                        shutil.rmtree(job_dir, ignore_errors=True)
+                except OSError:
+                    pass
+                continue
+            if job.orphaned():
+                job.mark_lost(job_dir)
+            elif job.finished_at is not None and now - job.finished_at >= self.ttl:
+                shutil.rmtree(job_dir, ignore_errors=True)
+
+    def submit(self, render):
+        """
+        Encola render() -> ({nombre: ruta}, hit) y devuelve el Job, o None si
+        ya hay demasiados trabajos pendientes.
+        """
+        self._maybe_sweep()
+        with self._lock:
+            self._purge_locked()
+            if self._pending >= self.max_pending:
+                return None
+            self._pending += 1
+            job = Job(uuid.uuid4().hex)
+            self._jobs[job.id] = job
+
+        os.makedirs(self._job_dir(job.id), exist_ok=True)
+        job.save(self._job_dir(job.id))
+        self._executor.submit(self._run, job, render)
+        return job
+
+    def _run(self, job, render):
+        job_dir = self._job_dir(job.id)
+        job.status = "running"
+        job.save(job_dir)
+        try:
+            entry, job.cached = render()
+            files = {}
+            for name, src in entry.items():
+                dst = os.path.join(job_dir, name)
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copyfile(src, dst)
+                files[name] = dst
+            job.files = files
+            job.status = "done"
+        except Exception as e:
+            job.error = getattr(e, "payload", {"error": str(e)})
+            job.error_status = getattr(e, "status", 500)
+            job.status = "failed"
+        finally:
+            with self._lock:
+                job.finished_at = time.time()
+                self._pending -= 1
+                # Mover al final para que el TTL cuente desde que terminó
+                self._jobs.move_to_end(job.id)
+            job.save(job_dir)
+
+    def get(self, job_id):
+        with self._lock:
+            self._purge_locked()
+            job = self._jobs.get(job_id)
+        if job is not None or not re.fullmatch(r"[0-9a-f]{32}", job_id):
+            return job
+
+        # Job de otro proceso
+        self._maybe_sweep()
+        try:
+            job = Job.load(self._job_dir(job_id))
+        except (OSError, ValueError, KeyError):
+            return None
+        if job.orphaned():
+            job.mark_lost(self._job_dir(job_id))
+        if job.finished_at is not None and time.time() - job.finished_at >= self.ttl:
+            return None
+        return job
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {"pending": self._pending, "max_pending": self.max_pending, "ttl": self.ttl, "jobs": counts}
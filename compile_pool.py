@@ -0,0 +1,197 @@
+import os
+import math
+import time
+import fcntl
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from request_timing import record
+
+
+# ==========================================================
+# PLANIFICADOR DE COMPILACIONES (pool fijo + cola acotada)
+# ==========================================================
+def default_workers():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class QueueFull(Exception):
+    """La cola de espera está llena; el cliente debe reintentar más tarde."""
+    status = 503
+
+    def __init__(self, retry_after):
+        super().__init__("Compile queue is full")
+        self.retry_after = retry_after
+
+
+class CompileSlots:
+    """
+    Límite global de compilaciones simultáneas entre procesos: N archivos
+    slot-i.lock en un directorio compartido y cada compilación retiene uno
+    con flock. Si el proceso muere, el kernel suelta el lock.
+
+    Con `indices` solo se usan esos archivos del conjunto (ver subset()).
+    """
+
+    def __init__(self, root, slots, poll=0.02, indices=None):
+        self.root = root
+        self.slots = slots
+        self.poll = poll
+        self.indices = list(indices) if indices is not None else list(range(slots))
+        os.makedirs(self.root, exist_ok=True)
+
+    def subset(self, count):
+        """
+        Los `count` últimos huecos de este mismo conjunto: lo que compile
+        con ellos sigue contando para el límite global de `slots`.
+        """
+        count = max(1, min(count, len(self.indices)))
+        return CompileSlots(self.root, self.slots, self.poll, self.indices[-count:])
+
+    @contextmanager
+    def acquire(self):
+        start = os.getpid() % len(self.indices)
+        delay = self.poll
+        while True:
+            for i in range(len(self.indices)):
+                index = self.indices[(start + i) % len(self.indices)]
+                path = os.path.join(self.root, f"slot-{index}.lock")
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    continue
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    os.close(fd)
+                return
+            # Todos ocupados: esperar un poco (con tope) y volver a mirar
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CompileScheduler:
+    """
+    Limita cuántos pdflatex corren a la vez. Hay `workers` hilos fijos (con
+    `prestart`, ya arrancados al crear el pool) y como mucho `max_queue`
+    trabajos esperando; por encima de eso se rechaza al momento con QueueFull
+    en vez de dejar que la petición muera por timeout.
+
+    Con `slots` (CompileSlots) además cada compilación espera un hueco del
+    límite global compartido por todos los procesos del servidor. Los hilos
+    no sobreviven a un fork: si el pool se crea en el proceso maestro
+    (preload) conviene prestart=False, y cada worker arranca los suyos en su
+    primer uso.
+    """
+
+    def __init__(self, workers, max_queue, slots=None, prestart=True):
+        if workers < 1:
+            raise ValueError(f"CompileScheduler needs at least 1 worker (got {workers})")
+        self.workers = workers
+        self.max_queue = max_queue
+        self.slots = slots
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self._waits = deque(maxlen=1024)     # segundos en cola
+        self._runtimes = deque(maxlen=1024)  # segundos de ejecución
+        self._slot_waits = deque(maxlen=1024)
+
+        if prestart:
+            self._ensure_executor()
+
+    def _ensure_executor(self):
+        if self._executor_pid == os.getpid():
+            return self._executor
+        with self._lock:
+            if self._executor_pid != os.getpid():
+                executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="latex")
+                # Arrancar todos los hilos ahora para no pagar su creación bajo carga
+                barrier = threading.Barrier(self.workers + 1)
+                for _ in range(self.workers):
+                    executor.submit(barrier.wait)
+                barrier.wait()
+                self._executor = executor
+                self._executor_pid = os.getpid()
+        return self._executor
+
+    def _retry_after(self):
+        avg = sum(self._runtimes) / len(self._runtimes) if self._runtimes else 1.0
+        return max(1, math.ceil(avg * (self._queued + 1) / self.workers))
+
+    def run(self, fn, *args, **kwargs):
+        """Ejecuta fn en el pool y bloquea hasta tener el resultado."""
+        with self._lock:
+            if self._queued >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(self._retry_after())
+            self._queued += 1
+            self.submitted += 1
+
+        enqueued_at = time.monotonic()
+
+        def task():
+            started_at = time.monotonic()
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._waits.append(started_at - enqueued_at)
+            record("queue", started_at - enqueued_at)
+            try:
+                if self.slots is None:
+                    return fn(*args, **kwargs)
+                with self.slots.acquire():
+                    slot_wait = time.monotonic() - started_at
+                    self._slot_waits.append(slot_wait)
+                    record("slot", slot_wait)
+                    return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self.completed += 1
+                    self._runtimes.append(time.monotonic() - started_at)
+
+        # Con el contexto de la petición: las etapas de fn van a su Server-Timing
+        context = contextvars.copy_context()
+        return self._ensure_executor().submit(context.run, task).result()
+
+    def stats(self):
+        with self._lock:
+            waits = list(self._waits)
+            slot_waits = list(self._slot_waits)
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "queue_depth": self._queued,
+                "max_queue": self.max_queue,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "wait_ms_p50": round(_percentile(waits, 0.50) * 1000, 2),
+                "wait_ms_p95": round(_percentile(waits, 0.95) * 1000, 2),
+                "wait_ms_max": round(max(waits, default=0.0) * 1000, 2),
+                "global_slots": self.slots.slots if self.slots is not None else None,
+                "slot_wait_ms_p95": round(_percentile(slot_waits, 0.95) * 1000, 2),
+            }
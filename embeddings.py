@@ -0,0 +1,216 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# ==========================================================
+# PROVEEDORES DE EMBEDDINGS
+# ==========================================================
+class EmbeddingProvider:
+    """
+    Interfaz: `model` identifica los vectores (forma parte de la clave de
+    cache) y embed(textos) devuelve un array (n, dim) float32.
+    """
+    model = None
+
+    def embed(self, texts):
+        raise NotImplementedError
+
+
+class OpenAIEmbeddings(EmbeddingProvider):
+    """Embeddings remotos de OpenAI (una llamada por lote de textos)."""
+
+    def __init__(self, client, model="text-embedding-3-large"):
+        self.client = client
+        self.model = model
+
+    def embed(self, texts):
+        data = self.client.embeddings.create(model=self.model, input=list(texts)).data
+        return np.array([d.embedding for d in sorted(data, key=lambda d: d.index)], np.float32)
+
+
+_WORD = re.compile(r"\w+")
+
+
+class HashingEmbeddings(EmbeddingProvider):
+    """
+    Proveedor local sin red: feature hashing de palabras y bigramas,
+    normalizado. Sirve para ejecutar y hacer pruebas de carga offline; sus
+    vectores no son comparables con los de OpenAI guardados en ib_store.
+    """
+
+    def __init__(self, dim=3072):
+        self.dim = dim
+        self.model = f"local-hashing-{dim}"
+
+    def _vector(self, text):
+        words = _WORD.findall(text.lower())
+        vec = np.zeros(self.dim, np.float32)
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            vec[h % self.dim] += 1.0 if h >> 63 else -1.0
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def embed(self, texts):
+        return np.array([self._vector(t) for t in texts], np.float32).reshape(len(texts), self.dim)
+
+
+# ==========================================================
+# CACHE DE EMBEDDINGS (memoria LRU + SQLite)
+# ==========================================================
+def text_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Embeddings por (modelo, texto): primero un LRU en memoria, luego una
+    tabla SQLite que sobrevive a reinicios y solo lo que falte en ambos se
+    pide al proveedor, en una sola llamada por lote.
+    """
+
+    def __init__(self, provider, path=None, max_items=4096):
+        self.provider = provider
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()   # (modelo, hash del texto) -> vector
+
+        self.path = path
+        self._db = None
+        self._db_pid = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.provider_calls = 0
+
+    def _conn_locked(self):
+        """Conexión SQLite de este proceso (una conexión no se puede usar tras un fork)."""
+        if not self.path:
+            return None
+        if self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings ("
+                             "model TEXT NOT NULL, key TEXT NOT NULL, dim INTEGER NOT NULL, "
+                             "vector BLOB NOT NULL, PRIMARY KEY (model, key))")
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _remember_locked(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _load_locked(self, model, keys):
+        db = self._conn_locked()
+        if db is None or not keys:
+            return {}
+        found = {}
+        # SQLite limita el número de parámetros por consulta
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = db.execute(
+                f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(chunk))})",
+                [model, *chunk])
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, np.float32)
+        return found
+
+    def embed(self, texts):
+        """Array (n, dim) float32 con el embedding de cada texto."""
+        model = self.provider.model
+        keys = [text_key(t) for t in texts]
+        vectors = {}
+
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get((model, key))
+                if vector is not None:
+                    self._memory.move_to_end((model, key))
+                    vectors[key] = vector
+                    self.memory_hits += 1
+            missing = list(dict.fromkeys(k for k in keys if k not in vectors))
+            for key, vector in self._load_locked(model, missing).items():
+                vectors[key] = vector
+                self._remember_locked((model, key), vector)
+                self.disk_hits += 1
+
+        todo = {k: t for k, t in zip(keys, texts) if k not in vectors}
+        if todo:
+            # La llamada al proveedor va fuera del lock
+            fresh = self.provider.embed(list(todo.values()))
+            self.provider_calls += 1
+            with self._lock:
+                self.misses += len(todo)
+                for key, vector in zip(todo, fresh):
+                    vectors[key] = vector
+                    self._remember_locked((model, key), vector)
+                db = self._conn_locked()
+                if db is not None:
+                    db.executemany(
+                        "INSERT OR REPLACE INTO embeddings (model, key, dim, vector) VALUES (?, ?, ?, ?)",
+                        [(model, key, len(v), np.asarray(v, np.float32).tobytes()) for key, v in zip(todo, fresh)])
+                    db.commit()
+
+        return np.stack([vectors[k] for k in keys]) if keys else np.zeros((0, 0), np.float32)
+
+    def warm(self, texts, batch_size=256):
+        """Calcula (o carga) los embeddings de todos los textos por lotes. Devuelve cuántos."""
+        texts = list(dict.fromkeys(texts))
+        for start in range(0, len(texts), batch_size):
+            self.embed(texts[start:start + batch_size])
+        return len(texts)
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "model": self.provider.model,
+                "memory_items": len(self._memory),
+                "max_items": self.max_items,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "provider_calls": self.provider_calls,
+            }
+            db = self._conn_locked()
+            if db is not None:
+                stats["disk_items"] = db.execute(
+                    "SELECT COUNT(*) FROM embeddings WHERE model = ?", (self.provider.model,)).fetchone()[0]
+            return stats
+
+
+# ==========================================================
+# CONSULTAS DE RETRIEVAL
+# ==========================================================
+def retrieval_query(topic, archetype_description=None):
+    """Texto que se embebe para buscar ejemplos (mismo formato que /retrieve)."""
+    return f"Topic: {topic}\nSkill: {archetype_description or ''}"
+
+
+def syllabus_queries(items):
+    """
+    Consultas de una lista de temario: strings (temas) u objetos
+    {"topic", "archetype_description"}.
+    """
+    queries = []
+    for item in items:
+        if isinstance(item, str):
+            queries.append(retrieval_query(item))
+        elif isinstance(item, dict) and item.get("topic"):
+            queries.append(retrieval_query(item["topic"], item.get("archetype_description")))
+    return queries
+
+
+def load_syllabus(path):
+    """Consultas de un archivo JSON de temario (ver syllabus_queries)."""
+    with open(path, encoding="utf-8") as f:
+        return syllabus_queries(json.load(f))
@@ -0,0 +1,178 @@
+import re
+import hashlib
+
+
+# ==========================================================
+# EJERCICIOS ESTRUCTURADOS (fragmentos TikZ + página)
+# ==========================================================
+# Cada tikzpicture se compila sola como PDF recortado (standalone) y la
+# página final la incluye con \includegraphics. Así la página no carga TikZ
+# y editar el texto no vuelve a ejecutar un plot de 200 muestras.
+EXERCISE_PARTS = ("question", "diagram", "answer")
+
+# TikZ con pgfplots y las librerías habituales: un fragmento tiene que
+# compilar igual que dentro del documento completo
+TIKZ_PREAMBLE = (
+    "\\usepackage{tikz}\n"
+    "\\usepackage{pgfplots}\n"
+    "\\pgfplotsset{compat=1.18}\n"
+    "\\usetikzlibrary{arrows.meta, calc, positioning, patterns, angles, quotes, intersections,\n"
+    "  shapes.geometric, decorations.pathreplacing, decorations.markings, decorations.pathmorphing}\n"
+)
+
+FRAGMENT_PREAMBLE = (
+    "\\documentclass[border=2pt]{standalone}\n"
+    "\\usepackage{amsmath}\n"
+    "\\usepackage{amssymb}\n"
+    "\\usepackage{gensymb}\n"
+    "\\usepackage{lmodern}\n"
+    + TIKZ_PREAMBLE
+)
+
+PAGE_PREAMBLE = (
+    "\\documentclass[12pt]{article}\n"
+    "\\usepackage[margin=2cm]{geometry}\n"
+    "\\usepackage{amsmath}\n"
+    "\\usepackage{amssymb}\n"
+    "\\usepackage{gensymb}\n"
+    "\\usepackage{lmodern}\n"
+    "\\usepackage{graphicx}\n"
+    "\\pagestyle{empty}\n"
+)
+
+_TIKZPICTURE = re.compile(r"\\begin\{tikzpicture\}.*?\\end\{tikzpicture\}", re.DOTALL)
+
+# Definiciones del texto del ejercicio que un tikzpicture puede usar:
+# comando -> (forma del nombre, grupos {...} que cierran la definición)
+DEFINITIONS = {
+    "newcommand": ("name", 1), "renewcommand": ("name", 1), "providecommand": ("name", 1),
+    "DeclareMathOperator": ("name", 1), "def": ("def", 1),
+    "tikzset": (None, 1), "pgfplotsset": (None, 1), "definecolor": (None, 3), "colorlet": (None, 2),
+}
+_DEFINITION = re.compile(r"\\(" + "|".join(DEFINITIONS) + r")\*?(?![a-zA-Z@])")
+_CONTROL_SEQUENCE = re.compile(r"\\(?:[a-zA-Z@]+|.)")
+
+
+def _group_end(text, i):
+    """Posición tras el grupo {...} que empieza en i, o None si no se cierra."""
+    depth = 0
+    while i < len(text):
+        c = text[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if not depth:
+                return i + 1
+        i += 1
+    return None
+
+
+def _definition_end(text, pos, shape, groups):
+    i = pos
+    if shape is not None:
+        while i < len(text) and text[i].isspace():
+            i += 1
+        if text.startswith("{", i):
+            i = _group_end(text, i)
+        else:
+            m = _CONTROL_SEQUENCE.match(text, i)
+            i = m.end() if m else None
+        if i is None:
+            return None
+        if shape == "def":
+            # Parámetros (#1#2...) hasta el cuerpo
+            i = text.find("{", i)
+            if i < 0:
+                return None
+    while groups:
+        while i < len(text) and text[i].isspace():
+            i += 1
+        if text.startswith("[", i):
+            close = text.find("]", i)
+            if close < 0:
+                return None
+            i = close + 1
+        elif text.startswith("{", i):
+            i = _group_end(text, i)
+            if i is None:
+                return None
+            groups -= 1
+        else:
+            return None
+    return i
+
+
+def extract_definitions(text):
+    """\\newcommand, \\def, \\tikzset, \\definecolor... de text, en orden y una por línea."""
+    found = []
+    pos = 0
+    while True:
+        m = _DEFINITION.search(text, pos)
+        if m is None:
+            break
+        end = _definition_end(text, m.end(), *DEFINITIONS[m.group(1)])
+        if end is None:
+            pos = m.end()
+            continue
+        found.append(text[m.start():end] + "\n")
+        pos = end
+    return "".join(found)
+
+
+def fragment_document(picture, definitions=""):
+    """
+    Documento standalone que compila un solo tikzpicture, con las
+    definiciones del texto del ejercicio en el preámbulo.
+    """
+    return f"{FRAGMENT_PREAMBLE}{definitions}\\begin{{document}}\n{picture}\n\\end{{document}}\n"
+
+
+def fragment_hash(picture, definitions=""):
+    return hashlib.sha256(fragment_document(picture, definitions).encode("utf-8")).hexdigest()
+
+
+def fragment_filename(digest):
+    return f"frag-{digest[:32]}.pdf"
+
+
+def extract_fragments(text, definitions=""):
+    """
+    Sustituye cada tikzpicture de text por su \\includegraphics. Devuelve
+    (texto, {hash: tikzpicture}) con los fragmentos en orden de aparición.
+    """
+    fragments = {}
+
+    def replace(m):
+        digest = fragment_hash(m.group(0), definitions)
+        fragments[digest] = m.group(0)
+        return f"\\includegraphics{{{fragment_filename(digest)}}}"
+
+    return _TIKZPICTURE.sub(replace, text), fragments
+
+
+def page_document(parts, tikz=False):
+    """
+    Página final con las partes en orden fijo. Normalmente ya sin
+    tikzpictures; con `tikz` (documento completo, si falla un fragmento)
+    se compilan dentro de la página.
+    """
+    body = []
+    for name in EXERCISE_PARTS:
+        text = parts.get(name)
+        if not text:
+            continue
+        if name == "question":
+            body.append("\\noindent\\textbf{Question}\\par\\medskip\n")
+        elif name == "answer":
+            body.append("\\bigskip\n\\noindent\\textbf{Answer}\\par\\medskip\n")
+        body.append(f"{text}\n\\par\\medskip\n")
+
+    preamble = PAGE_PREAMBLE
+    # \tikz suelto fuera de un tikzpicture: entonces la página sí necesita TikZ
+    if tikz or any("\\tikz" in text for text in parts.values() if text):
+        preamble += TIKZ_PREAMBLE
+    return f"{preamble}\\begin{{document}}\n{''.join(body)}\\end{{document}}\n"
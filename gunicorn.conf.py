@@ -0,0 +1,55 @@
+import os
+import glob
+import tempfile
+
+from compile_pool import default_workers
+
+
+# ==========================================================
+# SERVIDOR DE PRODUCCIÓN (gunicorn -c gunicorn.conf.py app:app)
+# ==========================================================
+# Varios procesos (sin el tope de un solo GIL) con varios hilos cada uno:
+# mientras unos hilos esperan a pdflatex, otros atienden /parse_strokes.
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", max(2, default_workers())))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# Cargar app.py una sola vez en el maestro antes del fork: el índice
+# vectorial (mmap), el índice de la cache de renders y los .fmt se
+# comparten copy-on-write entre workers.
+preload_app = True
+
+# Parada ordenada: con SIGTERM los workers dejan de aceptar y terminan las
+# peticiones en curso (compilaciones incluidas) durante graceful_timeout
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 180))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+# Reciclar workers de vez en cuando acota fugas de memoria
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 200))
+
+accesslog = "-"
+errorlog = "-"
+
+# app.py lee esto al importarse (en el maestro, por preload_app):
+# - un solo límite de pdflatex simultáneos para todos los workers
+# - el precalentado de embeddings se hace antes del fork, no en un hilo
+os.environ.setdefault("COMPILE_GLOBAL_SLOTS", str(default_workers()))
+os.environ.setdefault("EMBEDDING_WARMUP_BLOCKING", "1")
+# Cada worker no necesita más hilos de compilación que el límite global
+# (COMPILE_GLOBAL_SLOTS=0 es sin límite global: los hilos por defecto)
+_global_slots = int(os.environ["COMPILE_GLOBAL_SLOTS"])
+os.environ.setdefault("COMPILE_WORKERS", str(_global_slots if _global_slots > 0 else default_workers()))
+# Los hilos de compilación que arrancase el maestro se pierden en el fork
+os.environ.setdefault("COMPILE_PRESTART", "0")
+
+# Cada worker deja sus métricas en METRICS_DIR y /metrics suma las de todos
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "ib_metrics"))
+
+
+def on_starting(server):
+    # Los contadores empiezan de cero con cada arranque del servidor
+    for path in glob.glob(os.path.join(os.environ["METRICS_DIR"], "metrics-*")):
+        os.remove(path)
@@ -0,0 +1,383 @@
+import os
+import re
+import json
+import subprocess
+
+from latex_errors import parse_log, repair
+from latex_format import BEGIN_DOCUMENT
+from rasterize import DEFAULT_OPTIONS, build_artifacts, page_count, rasterize
+from request_timing import stage
+from workspaces import WorkspacePool
+
+
+# ==========================================================
+# COMPILADOR LATEX (pdflatex + poppler)
+# ==========================================================
+class CompileError(Exception):
+    """
+    Error de compilación con el código HTTP y el payload JSON que
+    el endpoint debe devolver tal cual.
+    """
+    def __init__(self, message, status=500, **extra):
+        super().__init__(message)
+        self.status = status
+        self.payload = {"error": message, **extra}
+
+
+# Directorios de trabajo reciclados (en /dev/shm si existe). app.py lo
+# reemplaza con use_workspaces() según su configuración.
+_workspaces = WorkspacePool()
+
+
+def use_workspaces(pool):
+    global _workspaces
+    _workspaces = pool
+
+
+# Documentos sueltos: parar en el primer error (no seguir en nonstopmode
+# hasta el final) y con errores "archivo:línea:" fáciles de parsear
+FAIL_FAST_ARGS = ("-halt-on-error", "-file-line-error")
+
+
+def _run_pdflatex(tmp, fmt_path=None, timeout=15, extra_args=()):
+    cmd = ["pdflatex", "-interaction=nonstopmode", *extra_args]
+    if fmt_path:
+        # El .fmt se enlaza dentro del temp: kpathsea busca formatos en "."
+        link = os.path.join(tmp, "pre.fmt")
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(fmt_path, link)
+        cmd.append("-fmt=pre")
+    cmd.append("doc.tex")
+
+    try:
+        return subprocess.run(
+            cmd,
+            cwd=tmp,  # Ejecutar DENTRO del temp para que los logs queden ahí
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=timeout  # Matar si tarda demasiado (15s por documento)
+        )
+    except subprocess.TimeoutExpired:
+        raise CompileError("Compilation timed out (infinite loop in LaTeX)", 408)
+
+
+def _compile(tmp, latex_code, formats=None, timeout=15, extra_args=()):
+    """
+    Escribe doc.tex en tmp y ejecuta pdflatex. Si se pasa un
+    PreambleFormatCache y el preámbulo tiene .fmt, se compila contra ese
+    formato; si esa compilación falla se repite de la forma normal.
+    """
+    fmt_path = formats.format_for(latex_code) if formats is not None else None
+
+    # Escribir el archivo .tex
+    with open(os.path.join(tmp, "doc.tex"), "wb") as f:
+        f.write(latex_code.encode('utf-8'))
+
+    with stage("pdflatex"):
+        process = _run_pdflatex(tmp, fmt_path, timeout, extra_args)
+    if fmt_path:
+        fell_back = process.returncode != 0
+        if fell_back:
+            with stage("pdflatex"):
+                process = _run_pdflatex(tmp, None, timeout, extra_args)
+            # El documento compila sin el formato: el .fmt es el problema,
+            # salvo que otro worker lo haya desalojado a mitad (fallo de caché)
+            if process.returncode == 0:
+                if os.path.exists(fmt_path):
+                    formats.mark_broken(fmt_path)
+                else:
+                    formats.forget(fmt_path)
+        formats.record_run(fell_back)
+    return process
+
+
+def _read_log(tmp):
+    log_file = os.path.join(tmp, "doc.log")
+    if not os.path.exists(log_file):
+        return "Log not found."
+    # Latin-1 es necesario porque los logs de error de LaTeX suelen tener caracteres raros
+    with open(log_file, "r", encoding="latin-1", errors="replace") as log:
+        return log.read()
+
+
+def _latex_failure(tmp):
+    log = _read_log(tmp)
+    # Log truncado para no saturar la respuesta; los errores ya van parseados
+    return CompileError("LaTeX compilation failed", 400, errors=parse_log(log), log=log[-2000:])
+
+
+def _link_files(tmp, files):
+    # Archivos auxiliares (p.ej. fragmentos PDF para \includegraphics)
+    for name, path in (files or {}).items():
+        os.symlink(os.path.abspath(path), os.path.join(tmp, name))
+
+
+def render_pdf(latex_code, formats=None, files=None, timeout=15):
+    """Solo pdflatex: devuelve {"doc.pdf": bytes} (fragmentos, sin rasterizar)."""
+    with _workspaces.acquire() as tmp:
+        _link_files(tmp, files)
+        process = _compile(tmp, latex_code, formats, timeout, FAIL_FAST_ARGS)
+        if process.returncode != 0:
+            raise _latex_failure(tmp)
+
+        with open(os.path.join(tmp, "doc.pdf"), "rb") as f:
+            return {"doc.pdf": f.read()}
+
+
+def render_document(latex_code, formats=None, options=DEFAULT_OPTIONS, files=None, timeout=15):
+    """
+    Compila el documento en un directorio de trabajo y devuelve los artefactos
+    generados como {nombre: bytes}. Lanza CompileError si algo falla.
+    `timeout` (segundos) vale para pdflatex y para cada llamada a poppler.
+    """
+    with _workspaces.acquire() as tmp:
+        _link_files(tmp, files)
+
+        # 1. Ejecutar PDFLATEX con TIMEOUT (con el formato precompilado si existe)
+        process = _compile(tmp, latex_code, formats, timeout, FAIL_FAST_ARGS)
+
+        # Verificar errores de LaTeX
+        if process.returncode != 0:
+            raise _latex_failure(tmp)
+
+        # 2. Rasterizar con poppler según las opciones (PNG a 300 DPI por defecto)
+        try:
+            with stage("rasterize"):
+                last = page_count(tmp, timeout) if options.pages == "all" else 1
+                images = rasterize(tmp, options, 1, last, timeout)
+                thumb = rasterize(tmp, options, 1, 1, timeout, box=options.thumbnail, root="thumb") \
+                    if options.thumbnail else None
+        except subprocess.CalledProcessError:
+            raise CompileError("Failed to convert PDF to Image", 500)
+        except subprocess.TimeoutExpired:
+            # Igual que un timeout de pdflatex: 408 y cuenta para el modelo de coste
+            raise CompileError("PDF to image conversion timed out", 408)
+
+        # Leer resultado
+        if not images or (options.thumbnail and not thumb):
+            raise CompileError("Image file was not generated", 500)
+
+        with open(os.path.join(tmp, "doc.pdf"), "rb") as f:
+            pdf_bytes = f.read()
+
+        return build_artifacts(options, pdf_bytes, images, thumb[0] if thumb else None)
+
+
+def render_repaired(render, latex_code, *args, attempts=0, **kwargs):
+    """
+    render(latex_code, *args) y, si falla con errores que latex_errors sabe
+    reparar, reintenta con el fuente arreglado (como mucho `attempts` veces).
+    Si hubo arreglos se añaden como artefacto "repairs.json"; si al final
+    falla, el error lleva los arreglos intentados en "repairs".
+    """
+    applied = []
+    for attempt in range(attempts + 1):
+        try:
+            artifacts = render(latex_code, *args, **kwargs)
+        except CompileError as e:
+            fixed, repairs = (repair(latex_code, e.payload.get("errors") or [])
+                              if attempt < attempts and e.status == 400 else (latex_code, []))
+            if not repairs:
+                if applied:
+                    e.payload["repairs"] = applied
+                raise
+            latex_code = fixed
+            applied.extend(repairs)
+            continue
+        if applied:
+            artifacts["repairs.json"] = json.dumps(applied).encode("utf-8")
+        return artifacts
+
+
+# ==========================================================
+# COMPILACIÓN EN LOTE (una hoja de ejercicios = un pdflatex)
+# ==========================================================
+END_DOCUMENT = "\\end{document}"
+
+# Contador de páginas enviadas: cada ítem deja una marca IBITEM en el log con
+# las páginas emitidas antes de empezar, así se sabe qué páginas son suyas.
+_BATCH_SETUP = (
+    "\\newcount\\ibbatchpages\n"
+    "\\AddToHook{shipout/after}{\\global\\advance\\ibbatchpages by 1\\relax}\n"
+    "\\def\\ibresetcounter#1#2{\\ifcsname c@#1\\endcsname\\setcounter{#1}{#2}\\fi}\n"
+    "\\def\\ibresetcounters{\\ibresetcounter{page}{1}%s}\n" % "".join(
+        "\\ibresetcounter{%s}{0}" % name for name in (
+            "part", "chapter", "section", "subsection", "subsubsection", "paragraph", "subparagraph",
+            "equation", "figure", "table", "footnote", "mpfootnote", "enumi", "enumii", "enumiii", "enumiv"))
+)
+_ITEM_MARK = re.compile(r"^IBITEM (\d+|END) (\d+)\s*$", re.MULTILINE)
+_ERROR_LINE = re.compile(r"^\./doc\.tex:(\d+): (.*)$", re.MULTILINE)
+
+
+def document_body(latex_code):
+    """Contenido entre \\begin{document} y \\end{document}."""
+    start = latex_code.find(BEGIN_DOCUMENT)
+    body = latex_code[start + len(BEGIN_DOCUMENT):] if start >= 0 else latex_code
+    end = body.rfind(END_DOCUMENT)
+    return body[:end] if end >= 0 else body
+
+
+def standalone_document(preamble, body):
+    """El documento individual equivalente a un ítem del lote."""
+    return f"{preamble}{BEGIN_DOCUMENT}\n{body}\n{END_DOCUMENT}\n"
+
+
+def _assemble_batch(preamble, bodies):
+    """Devuelve (fuente, líneas donde empieza cada ítem, línea de inicio del cuerpo)."""
+    parts = [preamble, BEGIN_DOCUMENT, "\n", _BATCH_SETUP]
+    line = preamble.count("\n") + 1 + _BATCH_SETUP.count("\n") + 1
+    body_start = line
+    starts = []
+    for i, body in enumerate(bodies):
+        # \begingroup no deshace los contadores (son globales): cada ítem
+        # empieza con los de LaTeX a cero, como en su documento suelto
+        mark = f"\\clearpage\\typeout{{IBITEM {i} \\the\\ibbatchpages}}\\ibresetcounters\n\\begingroup\n"
+        starts.append(line)
+        parts.append(mark)
+        parts.append(body)
+        parts.append("\n\\endgroup\n")
+        line += mark.count("\n") + body.count("\n") + 2
+    parts.append("\\clearpage\\typeout{IBITEM END \\the\\ibbatchpages}\n")
+    parts.append(END_DOCUMENT + "\n")
+    return "".join(parts), starts, body_start
+
+
+def _item_for_line(starts, line):
+    item = None
+    for i, start in enumerate(starts):
+        if line >= start:
+            item = i
+    return item
+
+
+def _render_batch_once(preamble, bodies, formats, options, timeout=15):
+    """
+    Un solo pdflatex + un solo pdftoppm para todos los ítems. Devuelve
+    (artefactos por ítem, None) o (None, {índice: CompileError}) con los
+    ítems a los que se pudieron atribuir los errores del log.
+    """
+    source, starts, body_start = _assemble_batch(preamble, bodies)
+
+    with _workspaces.acquire() as tmp:
+        # El timeout crece con el lote, pero con tope
+        timeout = min(120, timeout + 3 * len(bodies))
+        process = _compile(tmp, source, formats, timeout, ("-file-line-error",))
+        latex_log = _read_log(tmp)
+
+        if process.returncode != 0:
+            bad = {}
+            for m in _ERROR_LINE.finditer(latex_log):
+                line = int(m.group(1))
+                # Error en el preámbulo compartido: fallan todos
+                item = _item_for_line(starts, line) if line >= body_start else None
+                if item is None:
+                    error = CompileError("LaTeX compilation failed", 400, log=latex_log[-2000:])
+                    return None, {i: error for i in range(len(bodies))}
+                excerpt = latex_log[m.start():m.start() + 500]
+                errors = parse_log(excerpt, max_errors=1)
+                for error in errors:
+                    # Línea dentro del cuerpo del ítem (tras las dos líneas de la marca)
+                    error["line"] = line - starts[item] - 1
+                bad.setdefault(item, CompileError("LaTeX compilation failed", 400, errors=errors, log=excerpt))
+            return None, bad
+
+        marks = {}
+        for m in _ITEM_MARK.finditer(latex_log):
+            marks[m.group(1)] = int(m.group(2))
+
+        # Rasterizar todas las páginas de una vez
+        try:
+            with stage("rasterize"):
+                total = marks.get("END", 0)
+                images = rasterize(tmp, options, 1, total, timeout) if total else []
+                thumbs = rasterize(tmp, options, 1, total, timeout, box=options.thumbnail, root="thumb") \
+                    if options.thumbnail and total else None
+                subprocess.run(["pdfseparate", "doc.pdf", "sep-%d.pdf"], cwd=tmp, check=True, timeout=timeout)
+        except subprocess.CalledProcessError:
+            raise CompileError("Failed to convert PDF to Image", 500)
+        except subprocess.TimeoutExpired:
+            raise CompileError("PDF to image conversion timed out", 408)
+
+        results = []
+        for i in range(len(bodies)):
+            first = marks.get(str(i))
+            last = marks.get(str(i + 1), marks.get("END"))
+            if first is None or last is None or last <= first or last > len(images):
+                results.append(CompileError("Item produced no pages", 400))
+                continue
+
+            pages = [os.path.join(tmp, f"sep-{p + 1}.pdf") for p in range(first, last)]
+            if len(pages) == 1:
+                item_pdf = pages[0]
+            else:
+                item_pdf = os.path.join(tmp, f"item-{i}.pdf")
+                try:
+                    subprocess.run(["pdfunite", *pages, item_pdf], cwd=tmp, check=True, timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    raise CompileError("PDF to image conversion timed out", 408)
+
+            with open(item_pdf, "rb") as f:
+                pdf_bytes = f.read()
+            thumb = thumbs[first] if thumbs else None
+            results.append(build_artifacts(options, pdf_bytes, images[first:last], thumb))
+
+        return results, None
+
+
+def render_batch(preamble, bodies, formats=None, options=DEFAULT_OPTIONS, timeout=15, run=None, max_rounds=8):
+    """
+    Compila varios cuerpos que comparten preámbulo como páginas de un mismo
+    documento. Devuelve una lista con, por ítem, {nombre: bytes} o la
+    CompileError de ese ítem: un ejercicio roto no tumba el lote. Los ítems
+    con errores localizados en el log se apartan y el resto se recompila;
+    si el error no se puede atribuir, el lote se parte en dos.
+
+    Cada pasada es un pdflatex distinto: `run(fuente, fn, *args)` decide
+    dónde y con qué timeout se ejecuta (CompileLanes.run con la fuente de
+    esa pasada, no la del lote entero). Tras `max_rounds` pasadas lo que
+    quede sin resolver falla en vez de seguir partiendo.
+    """
+    if run is None:
+        def run(_source, fn, *args):
+            return fn(*args, timeout=timeout)
+
+    results = [None] * len(bodies)
+    pending = [list(range(len(bodies)))]
+    rounds = 0
+
+    while pending:
+        idxs = pending.pop()
+        if rounds >= max_rounds:
+            error = CompileError("LaTeX compilation failed; batch too broken to split, compile items separately", 400)
+            for i in idxs:
+                results[i] = error
+            continue
+        rounds += 1
+
+        sub = [bodies[i] for i in idxs]
+        try:
+            artifacts, bad = run(standalone_document(preamble, "\n".join(sub)),
+                                 _render_batch_once, preamble, sub, formats, options)
+        except CompileError as e:
+            artifacts, bad = None, ({0: e} if len(idxs) == 1 else {})
+
+        if artifacts is not None:
+            for i, item in zip(idxs, artifacts):
+                results[i] = item
+            continue
+
+        for j, error in bad.items():
+            results[idxs[j]] = error
+        rest = [i for j, i in enumerate(idxs) if j not in bad]
+        if not rest:
+            continue
+        if bad:
+            pending.append(rest)
+        elif len(rest) == 1:
+            results[rest[0]] = CompileError("LaTeX compilation failed", 400)
+        else:
+            mid = len(rest) // 2
+            pending.extend([rest[:mid], rest[mid:]])
+
+    return results
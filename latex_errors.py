@@ -0,0 +1,199 @@
+import re
+
+
+# ==========================================================
+# ERRORES ESTRUCTURADOS A PARTIR DE doc.log
+# ==========================================================
+# Con -file-line-error cada error empieza por "./doc.tex:48: mensaje"; sin
+# él, por "! mensaje" (y la línea sale del contexto "l.48 ..."). El contexto
+# "l.N texto" muestra lo que TeX había leído al fallar: el comando culpable
+# suele ser el último de ese texto.
+_ERROR_START = re.compile(r"^(?:(?P<file>[^\s:!][^:\n]*?):(?P<line>\d+): |! )(?P<message>.*)$", re.MULTILINE)
+_CONTEXT = re.compile(r"^l\.(?P<line>\d+) (?P<before>.*)$", re.MULTILINE)
+_LAST_COMMAND = re.compile(r"(\\(?:[A-Za-z@]+|.))\s*$")
+
+# TeX corta las líneas del log a este ancho (max_print_line)
+_LOG_WIDTH = 79
+
+# Mensajes que solo acompañan al error real
+_SECONDARY = ("Emergency stop", "==> Fatal error occurred", "Job aborted")
+
+# (patrón del mensaje, tipo, grupo con el comando o None = último comando del contexto)
+ERROR_TYPES = [
+    (re.compile(r"Undefined control sequence"), "undefined_command", None),
+    (re.compile(r"LaTeX Error: Environment (\S+) undefined"), "undefined_environment", 1),
+    (re.compile(r"(?:LaTeX Error: )?File [`'](.+?)' not found|File (\S+) not found"), "missing_file", 1),
+    (re.compile(r"LaTeX Error: \\begin\{(\S+?)\} on input line \d+ ended by"), "mismatched_environment", 1),
+    (re.compile(r"LaTeX Error: Not allowed in LR mode"), "not_allowed_in_lr_mode", None),
+    (re.compile(r"LaTeX Error: There's no line here to end"), "no_line_to_end", None),
+    (re.compile(r"LaTeX Error: Lonely \\item"), "lonely_item", None),
+    (re.compile(r"Missing \$ inserted"), "missing_dollar", None),
+    (re.compile(r"Missing (\S+) inserted"), "missing_delimiter", 1),
+    (re.compile(r"Extra \}, or forgotten (\S+)"), "extra_brace", 1),
+    (re.compile(r"Extra alignment tab|Misplaced alignment tab"), "alignment_tab", None),
+    (re.compile(r"Double (?:super|sub)script"), "double_script", None),
+    (re.compile(r"Paragraph ended before (\S+) was complete"), "paragraph_ended", 1),
+    (re.compile(r"Runaway argument"), "runaway_argument", None),
+    (re.compile(r"Illegal unit of measure"), "illegal_unit", None),
+    (re.compile(r"Dimension too large"), "dimension_too_large", None),
+    (re.compile(r"TeX capacity exceeded"), "capacity_exceeded", None),
+    (re.compile(r"I do not know the key '/tikz/([^']+)'"), "unknown_key", 1),
+    (re.compile(r"Unknown arrow tip kind '([^']+)'"), "unknown_arrow_tip", 1),
+    (re.compile(r"No shape named [`']?([^'\s]+)'? is known"), "unknown_shape", 1),
+    (re.compile(r"Package (\S+) Error"), "package_error", None),
+    (re.compile(r"LaTeX Error"), "latex_error", None),
+]
+
+
+def _classify(message, before):
+    for pattern, kind, group in ERROR_TYPES:
+        m = pattern.search(message)
+        if m:
+            if group is not None:
+                return kind, m.group(group) or next((g for g in m.groups() if g), None)
+            command = _LAST_COMMAND.search(before or "")
+            return kind, command.group(1) if command else None
+    command = _LAST_COMMAND.search(before or "")
+    return "tex_error", command.group(1) if command else None
+
+
+def parse_log(log, max_errors=5, source="doc.tex"):
+    """
+    Lista de errores {"line", "type", "message", "command", "context"}
+    (más "file" si el error es de otro archivo, p.ej. un .sty), en orden y
+    sin repetir los que TeX vuelve a emitir al recuperarse.
+    """
+    starts = [m for m in _ERROR_START.finditer(log)
+              if not m.group("message").startswith(_SECONDARY)]
+    errors = []
+    seen = set()
+    for k, m in enumerate(starts):
+        end = starts[k + 1].start() if k + 1 < len(starts) else len(log)
+        message = m.group("message").strip()
+        # Mensaje partido por el ancho del log
+        if len(m.group(0)) == _LOG_WIDTH:
+            next_line = log[m.end() + 1:log.find("\n", m.end() + 1)]
+            message += next_line.strip()
+
+        context = _CONTEXT.search(log, m.end(), end)
+        before = context.group("before") if context else None
+        line = int(m.group("line")) if m.group("line") else (int(context.group("line")) if context else None)
+        kind, command = _classify(message, before)
+
+        error = {"line": line, "type": kind, "message": message, "command": command,
+                 "context": before.strip() if before else None}
+        file = m.group("file")
+        if file and file.lstrip("./") != source:
+            error["file"] = file
+
+        signature = (line, kind, message)
+        if signature in seen:
+            continue
+        seen.add(signature)
+        errors.append(error)
+        if len(errors) >= max_errors:
+            break
+    return errors
+
+
+# ==========================================================
+# REPARACIONES DIRIGIDAS (por tipo de error del log)
+# ==========================================================
+# Comandos/entornos que la IA usa sin cargar su paquete
+PACKAGE_FOR = {
+    "\\degree": "gensymb", "\\celsius": "gensymb", "\\ohm": "gensymb", "\\micro": "gensymb",
+    "\\mathbb": "amssymb", "\\therefore": "amssymb", "\\because": "amssymb", "\\checkmark": "amssymb",
+    "\\square": "amssymb", "\\leqslant": "amssymb", "\\geqslant": "amssymb", "\\varnothing": "amssymb",
+    "\\text": "amsmath", "\\dfrac": "amsmath", "\\tfrac": "amsmath", "\\boxed": "amsmath",
+    "\\xrightarrow": "amsmath", "\\overset": "amsmath", "\\underset": "amsmath", "\\binom": "amsmath",
+    "\\SI": "siunitx", "\\si": "siunitx", "\\qty": "siunitx", "\\unit": "siunitx", "\\num": "siunitx",
+    "\\ang": "siunitx",
+    "\\cancel": "cancel", "\\mathscr": "mathrsfs", "\\color": "xcolor", "\\textcolor": "xcolor",
+    "\\includegraphics": "graphicx", "\\url": "url", "\\tikz": "tikz", "\\usetikzlibrary": "tikz",
+    "align": "amsmath", "align*": "amsmath", "gather": "amsmath", "gather*": "amsmath",
+    "cases": "amsmath", "pmatrix": "amsmath", "bmatrix": "amsmath", "vmatrix": "amsmath",
+    "multline": "amsmath", "tikzpicture": "tikz", "axis": "pgfplots", "multicols": "multicol",
+    "tabularx": "tabularx", "enumerate*": "enumitem",
+}
+
+# Claves, puntas de flecha y formas de TikZ que viven en una librería
+TIKZ_LIBRARY_FOR = {
+    "diamond": "shapes.geometric", "regular polygon": "shapes.geometric", "star": "shapes.geometric",
+    "trapezium": "shapes.geometric", "ellipse": "shapes.geometric", "isosceles triangle": "shapes.geometric",
+    "Stealth": "arrows.meta", "Latex": "arrows.meta", "Triangle": "arrows.meta", "Straight Barb": "arrows.meta",
+    "pattern": "patterns", "decoration": "decorations.pathreplacing", "decorate": "decorations.pathreplacing",
+    "name path": "intersections", "name intersections": "intersections",
+}
+
+_BEGIN_DOCUMENT = "\\begin{document}"
+_DOCUMENTCLASS = re.compile(r"\\documentclass\s*(?:\[[^\]]*\])?\s*\{[^}]*\}[^\n]*\n")
+_INCLUDEGRAPHICS = r"\\includegraphics\s*(?:\[[^\]]*\])?\s*\{\s*%s\s*\}"
+
+
+def _load_package(source, error):
+    # Justo después de \documentclass: antes de cualquier paquete o \usetikzlibrary que lo use
+    package = PACKAGE_FOR.get(error["command"] or "")
+    at = source.find(_BEGIN_DOCUMENT)
+    documentclass = _DOCUMENTCLASS.search(source, 0, max(at, 0))
+    if package is None or documentclass is None or re.search(
+            r"\\usepackage\s*(?:\[[^\]]*\])?\s*\{[^}]*\b%s\b" % re.escape(package), source[:at]):
+        return None
+    return f"{source[:documentclass.end()]}\\usepackage{{{package}}}\n{source[documentclass.end():]}"
+
+
+def _load_tikz_library(source, error):
+    # Antes de \begin{document}: después de que se cargue tikz
+    library = TIKZ_LIBRARY_FOR.get(error["command"] or "")
+    at = source.find(_BEGIN_DOCUMENT)
+    line = f"\\usetikzlibrary{{{library}}}"
+    if library is None or at < 0 or line in source[:at]:
+        return None
+    return f"{source[:at]}{line}\n{source[at:]}"
+
+
+def _placeholder_image(source, error):
+    # Imagen inventada por la IA: un recuadro con su nombre en vez de \includegraphics
+    name = error["command"] or ""
+    if not name or name.startswith("frag-"):
+        return None
+    fixed, n = re.subn(_INCLUDEGRAPHICS % re.escape(name),
+                       lambda m: "\\fbox{\\texttt{%s}}" % name.replace("_", "\\_"), source)
+    return fixed if n else None
+
+
+class Repair:
+    """Arreglo para ciertos tipos de error: fix(fuente, error) -> fuente nuevo o None."""
+    def __init__(self, name, error_types, fix, description=""):
+        self.name = name
+        self.error_types = set(error_types)
+        self.fix = fix
+        self.description = description
+
+
+REPAIRS = [
+    Repair("load_package", ("undefined_command", "undefined_environment"), _load_package,
+           description="\\usepackage del paquete que define el comando"),
+    Repair("load_tikz_library", ("unknown_key", "unknown_arrow_tip", "unknown_shape"), _load_tikz_library,
+           description="\\usetikzlibrary de la librería que define la clave/forma"),
+    Repair("placeholder_image", ("missing_file",), _placeholder_image,
+           description="\\includegraphics de un archivo inexistente -> recuadro con el nombre"),
+]
+
+
+def repair(source, errors, repairs=REPAIRS):
+    """
+    Aplica las reparaciones que correspondan a los errores del log.
+    Devuelve (fuente, [descripción de cada arreglo aplicado]).
+    """
+    applied = []
+    for error in errors:
+        for rule in repairs:
+            if error["type"] not in rule.error_types:
+                continue
+            fixed = rule.fix(source, error)
+            if fixed is not None and fixed != source:
+                source = fixed
+                applied.append({"repair": rule.name, "type": error["type"], "command": error["command"],
+                                "line": error["line"]})
+                break
+    return source, applied
@@ -0,0 +1,191 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+from collections import OrderedDict
+
+
+# ==========================================================
+# FORMATOS PRECOMPILADOS DEL PREÁMBULO (.fmt)
+# ==========================================================
+BEGIN_DOCUMENT = "\\begin{document}"
+
+
+def split_preamble(latex_code):
+    """
+    Devuelve (preámbulo, resto) partiendo en el primer \\begin{document},
+    o None si el documento no tiene la forma esperada.
+    """
+    idx = latex_code.find(BEGIN_DOCUMENT)
+    if idx < 0:
+        return None
+    preamble = latex_code[:idx]
+    if "\\documentclass" not in preamble:
+        return None
+    return preamble, latex_code[idx:]
+
+
+def preamble_hash(preamble):
+    return hashlib.sha256(preamble.strip().encode("utf-8")).hexdigest()[:24]
+
+
+class PreambleFormatCache:
+    """
+    Detecta los preámbulos que se repiten (tikz, amsmath, lmodern, tcolorbox...)
+    y, a partir de `min_uses` apariciones, los vuelca una sola vez a un .fmt
+    con mylatexformat. Los documentos con ese preámbulo se compilan después
+    con `-fmt`, saltándose la carga de paquetes.
+
+    El volcado se hace en un hilo aparte (uno a la vez por proceso): la
+    petición que llega al umbral compila normal y no paga los segundos del
+    -ini. Si el volcado falla el preámbulo queda marcado y se sigue
+    compilando de la forma normal.
+
+    El directorio es compartido entre workers: un .fmt que otro proceso ya
+    volcó se aprovecha, y uno que desapareció (lo desalojó otro proceso) es
+    un fallo de caché, no un formato roto.
+    """
+
+    def __init__(self, root, min_uses=2, max_formats=16, timeout=30):
+        self.root = root
+        self.min_uses = min_uses
+        self.max_formats = max_formats
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._uses = {}               # hash -> veces visto
+        self._ready = OrderedDict()   # hash -> ruta del .fmt (LRU)
+        self._failed = set()
+        self._dumping = set()
+
+        self.dumps = 0
+        self.dump_failures = 0
+        self.fmt_runs = 0
+        self.fallbacks = 0
+
+        os.makedirs(self.root, exist_ok=True)
+        for name in sorted(os.listdir(self.root), key=lambda n: os.path.getmtime(os.path.join(self.root, n))):
+            if name.endswith(".fmt"):
+                self._ready[name[:-4]] = os.path.join(self.root, name)
+
+    def format_for(self, latex_code):
+        """
+        Ruta del .fmt que corresponde al preámbulo del documento, o None si
+        todavía no hay (en cuyo caso se compila normal). Cuando el preámbulo
+        llega al umbral de usos se lanza el volcado en segundo plano.
+        """
+        parts = split_preamble(latex_code)
+        if parts is None:
+            return None
+        preamble = parts[0]
+        h = preamble_hash(preamble)
+        fmt_path = os.path.join(self.root, f"{h}.fmt")
+
+        with self._lock:
+            if h in self._ready:
+                if os.path.exists(fmt_path):
+                    self._ready.move_to_end(h)
+                    return fmt_path
+                del self._ready[h]
+            if h in self._failed or h in self._dumping:
+                return None
+            if os.path.exists(fmt_path):
+                # Lo volcó otro worker
+                self._add_locked(h, fmt_path)
+                return fmt_path
+            if h not in self._uses and len(self._uses) >= 10000:
+                self._uses.clear()  # acotar memoria ante preámbulos únicos
+            self._uses[h] = self._uses.get(h, 0) + 1
+            if self._uses[h] < self.min_uses or self._dumping:
+                return None
+            self._dumping.add(h)
+
+        threading.Thread(target=self._dump_in_background, args=(h, preamble),
+                         name="fmt-dump", daemon=True).start()
+        return None
+
+    def _dump_in_background(self, h, preamble):
+        fmt_path = None
+        try:
+            fmt_path = self._dump(h, preamble)
+        except Exception as e:
+            print(f"⚠️ Preamble format dump failed: {e}")
+        finally:
+            with self._lock:
+                self._dumping.discard(h)
+                if fmt_path is None:
+                    self._failed.add(h)
+                    self.dump_failures += 1
+                else:
+                    self.dumps += 1
+                    self._add_locked(h, fmt_path)
+
+    def _add_locked(self, h, fmt_path):
+        self._ready[h] = fmt_path
+        while len(self._ready) > self.max_formats:
+            _, old = self._ready.popitem(last=False)
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def _dump(self, h, preamble):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "pre.tex"), "w", encoding="utf-8") as f:
+                f.write(preamble + BEGIN_DOCUMENT + "\n\\end{document}\n")
+            try:
+                process = subprocess.run(
+                    ["pdflatex", "-ini", "-interaction=nonstopmode", f"-jobname={h}",
+                     "&pdflatex", "mylatexformat.ltx", "pre.tex"],
+                    cwd=tmp,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    timeout=self.timeout
+                )
+            except subprocess.TimeoutExpired:
+                return None
+
+            generated = os.path.join(tmp, f"{h}.fmt")
+            if process.returncode != 0 or not os.path.exists(generated):
+                return None
+
+            # Copia + os.replace: otro worker nunca ve un .fmt a medio escribir
+            fmt_path = os.path.join(self.root, f"{h}.fmt")
+            partial = f"{fmt_path}.{os.getpid()}.tmp"
+            shutil.move(generated, partial)
+            os.replace(partial, fmt_path)
+            return fmt_path
+
+    def record_run(self, fell_back):
+        with self._lock:
+            self.fmt_runs += 1
+            if fell_back:
+                self.fallbacks += 1
+
+    def forget(self, fmt_path):
+        """El .fmt desapareció (otro worker lo desalojó): se volverá a volcar."""
+        with self._lock:
+            self._ready.pop(os.path.basename(fmt_path)[:-4], None)
+
+    def mark_broken(self, fmt_path):
+        """Un .fmt que hace fallar documentos válidos (p.ej. tras actualizar TeX Live)."""
+        h = os.path.basename(fmt_path)[:-4]
+        with self._lock:
+            self._ready.pop(h, None)
+            self._failed.add(h)
+        try:
+            os.remove(fmt_path)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "formats": len(self._ready),
+                "dumps": self.dumps,
+                "dump_failures": self.dump_failures,
+                "fmt_runs": self.fmt_runs,
+                "fallbacks": self.fallbacks,
+                "tracked_preambles": len(self._uses),
+            }
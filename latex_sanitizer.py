@@ -0,0 +1,276 @@
+import re
+from collections import Counter
+
+
+# ==========================================================
+# SANITIZADOR DE LATEX (registro de reglas, una sola pasada)
+# ==========================================================
+class Rule:
+    """
+    Una corrección: uno o varios patrones regex (alternativas) + reemplazo
+    (plantilla con \\1... o función que recibe el match).
+
+    Para que la pasada única sea rápida cada patrón debe empezar por un
+    literal (así `re` puede saltar directamente a los candidatos). Las reglas
+    de inicio de línea empiezan por "\\n": el texto se procesa con un salto
+    de línea delante.
+    """
+    def __init__(self, name, patterns, replacement, description=""):
+        self.name = name
+        self.patterns = [patterns] if isinstance(patterns, str) else list(patterns)
+        self.replacement = replacement
+        self.description = description
+        self.regex = re.compile("|".join(self.patterns))
+
+    def apply(self, match):
+        if callable(self.replacement):
+            return self.replacement(match)
+        return match.expand(self.replacement)
+
+
+def _at_line_start(match):
+    start = match.string.rfind("\n", 0, match.start()) + 1
+    return not match.string[start:match.start()].strip()
+
+
+def _spacing_linebreak(match):
+    # \\[2mm] ya está bien (el match empieza en la segunda barra); con un
+    # número par de barras delante (\\\[2mm]) el \[ sí abre una ecuación
+    text, i = match.string, match.start()
+    while text[i - 1] == "\\":
+        i -= 1
+    if (match.start() - i) % 2:
+        return match.group(0)
+    # Aplicar esto al principio de una línea lo desharía line_start_display_math
+    # (en la versión secuencial el resultado neto era \[2mm] sin espacios)
+    if _at_line_start(match):
+        return "\\[" + match.group(1) + "]"
+    return "\\\\[" + match.group(1) + "]"
+
+
+def _line_start_display_math(match):
+    if match.group(2) is not None:
+        return "\n\\[" + match.group(2) + "]"
+    # El [diamond] que venga justo detrás ya no lo vería diamond_to_circle
+    return "\n\\[" + ("circle]" if match.group(1) else "")
+
+
+# El orden importa: si dos reglas pueden empezar en la misma posición gana la primera.
+RULES = [
+    # 1. Eliminar paquetes conflictivos
+    # (tcolorbox YA NO se borra: se usa en el template)
+    Rule("drop_microtype", r"\\usepackage(?:\[[^\]]*\])?\{microtype\}", "",
+         description="microtype choca con el template"),
+
+    # 2. CORRECCIÓN CRÍTICA: EL ERROR DE "MATH MODE" vs "ESPACIO VERTICAL"
+    # La IA escribe \[2mm] pensando que es espacio. LaTeX cree que es una ecuación.
+    # Buscamos \[ seguido de dígitos y unidades (mm, cm, pt, ex, em) y cerramos el corchete
+    # Reemplazamos \[2mm] por \\[2mm] (sin tocar los \\[2mm] que ya están bien)
+    Rule("spacing_linebreak", r"\\\[\s*(\d+[a-z]{2})\]", _spacing_linebreak,
+         description="\\[2mm] -> \\\\[2mm]"),
+
+    # 3. Corrección de saltos de línea mal formados al inicio
+    # (\\[ al empezar la línea era en realidad \[, salvo que sea un espaciado)
+    # Como la versión secuencial (^\s*), se come la sangría y las líneas en
+    # blanco de delante, también en un \[2mm] a principio de línea
+    Rule("line_start_display_math",
+         [r"\n\s*\\\\\[(?!\s*\d+[a-z]{2}\])(diamond\])?", r"\n\s*\\\[\s*(\d+[a-z]{2})\]"],
+         _line_start_display_math,
+         description="\\\\[ al inicio de línea -> \\["),
+
+    # 4. Corrección de formas geométricas (Diamantes -> Círculos)
+    # (la coma de "diamond," no se consume: en "diamond, diamond" cambian los dos)
+    Rule("diamond_to_circle", [", diamond", "diamond(?=,)", r"\[diamond\]"],
+         lambda m: m.group(0).replace("diamond", "circle"),
+         description="diamond -> circle en nodos TikZ"),
+
+    # 5. Desempaquetado de seguridad (Solo si la caja está duplicada o mal formada)
+    # Si ves que tienes \begin{tcolorbox} dentro de otro, añade aquí una regla.
+]
+
+
+class Sanitizer:
+    """
+    Compila todas las reglas en una única regex y las aplica en una sola
+    pasada sobre el documento. Devuelve el texto limpio y cuántas veces
+    disparó cada regla.
+
+    Cada alternativa termina con un grupo vacío "()" que identifica su regla
+    (m.lastindex). No se usan grupos con nombre alrededor de las alternativas
+    porque impedirían a `re` usar el prefijo literal para saltar.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._by_group = {}
+        alternatives = []
+        groups = 0
+        for rule in self.rules:
+            for pattern in rule.patterns:
+                groups += re.compile(pattern).groups + 1
+                self._by_group[groups] = rule
+                alternatives.append(f"{pattern}()")
+        self.regex = re.compile("|".join(alternatives))
+
+    def sanitize(self, latex_code):
+        fired = Counter()
+
+        def replace(m):
+            rule = self._by_group[m.lastindex]
+            # Re-match con la regex propia de la regla (mismos grupos \\1...)
+            inner = rule.regex.match(m.string, m.start())
+            new = rule.apply(inner)
+            if new != inner.group(0):
+                fired[rule.name] += 1
+            return new
+
+        return self.regex.sub(replace, "\n" + latex_code)[1:], fired
+
+
+DEFAULT_SANITIZER = Sanitizer(RULES)
+
+
+# ==========================================================
+# PRE-FLIGHT: rechazar documentos condenados sin lanzar pdflatex
+# ==========================================================
+# Solo se rechaza lo que falla seguro. minted (2.x, el de la imagen) da un
+# error al cargarse sin -shell-escape. pythontex, sagetex, svg o shellesc
+# compilan (con huecos o avisos) y \write18 sin shell-escape no hace nada.
+BANNED_PACKAGES = {"minted"}
+
+VERBATIM_ENVIRONMENTS = {"verbatim", "verbatim*", "lstlisting", "comment"}
+
+# Todas las alternativas empiezan por un literal (sin grupos delante) para
+# que `re` salte directamente a los candidatos
+_TOKEN = re.compile(
+    r"\\\\"                                   # salto de línea \\ (no abre \[)
+    r"|\\(?P<env>begin|end)\s*\{(?P<name>[^}]*)\}"
+    r"|\\usepackage\s*(?:\[[^\]]*\])?\s*\{(?P<pkgs>[^}]*)\}"
+    r"|\\(?P<math>[\[\]])"
+    r"|\\(?P<verb>verb\*?|lstinline|url|href)(?![a-zA-Z@])"
+    r"|\\[{}%$&#_^~ ]"                        # caracteres escapados
+    r"|[{}]"
+    r"|%[^\n]*"                               # comentarios
+)
+
+
+def _line_of(text, pos):
+    return text.count("\n", 0, pos) + 1
+
+
+def _skip_inline_verbatim(text, pos, command):
+    """
+    Posición tras el argumento literal de \\verb<d>...<d>, \\lstinline
+    o \\url (con delimitador o entre llaves; de \\href solo la URL), que
+    tiene que cerrarse en la misma línea. Si no se cierra, pdflatex falla
+    igual: se sigue justo detrás del comando.
+    """
+    line_end = text.find("\n", pos)
+    if line_end < 0:
+        line_end = len(text)
+    i = pos
+    while i < line_end and text[i] == " ":
+        i += 1
+    if command == "lstinline" and text.startswith("[", i):
+        close = text.find("]", i, line_end)
+        if close < 0:
+            return pos
+        i = close + 1
+    if i >= line_end:
+        return pos
+    if command != "verb" and command != "verb*" and text[i] == "{":
+        depth = 0
+        for j in range(i, line_end):
+            if text[j] == "{":
+                depth += 1
+            elif text[j] == "}":
+                depth -= 1
+                if not depth:
+                    return j + 1
+        # Llaves sin equilibrar dentro: vale hasta la primera }
+        close = text.find("}", i, line_end)
+        return pos if close < 0 else close + 1
+    close = text.find(text[i], i + 1, line_end)
+    return pos if close < 0 else close + 1
+
+
+def preflight(latex_code, require_document=True, banned=BANNED_PACKAGES):
+    """
+    Comprobaciones baratas que garantizan que pdflatex va a fallar: llaves
+    y entornos desbalanceados, \\[ ... \\] mal anidados y paquetes que no
+    cargan sin shell-escape. Devuelve una lista de problemas (vacía si todo bien).
+    """
+    issues = []
+
+    def issue(kind, message, pos):
+        issues.append({"type": kind, "message": message, "line": _line_of(latex_code, pos)})
+
+    if require_document:
+        for needed in ("\\documentclass", "\\begin{document}", "\\end{document}"):
+            if needed not in latex_code:
+                issues.append({"type": "structure", "message": f"Missing {needed}", "line": None})
+
+    braces = []   # posiciones de { abiertas
+    envs = []     # (nombre, posición)
+    math_open = None
+
+    pos = 0
+    while True:
+        m = _TOKEN.search(latex_code, pos)
+        if m is None:
+            break
+        pos = m.end()
+
+        token = m.group(0)
+        if token == "{" or token == "}":
+            if token == "{":
+                braces.append(m.start())
+            elif braces:
+                braces.pop()
+            else:
+                issue("brace", "Unmatched '}'", m.start())
+        elif m.group("env"):
+            name = m.group("name").strip()
+            if m.group("env") == "begin":
+                if name in VERBATIM_ENVIRONMENTS:
+                    # El contenido literal no cuenta: saltar hasta su \end
+                    end = latex_code.find(f"\\end{{{name}}}", pos)
+                    if end < 0:
+                        issue("environment", f"\\begin{{{name}}} never closed", m.start())
+                        break
+                    pos = end + len(name) + 6
+                    continue
+                envs.append((name, m.start()))
+            elif any(open_name == name for open_name, _ in envs):
+                # Lo que quede abierto por encima de este entorno no se cerró
+                while envs[-1][0] != name:
+                    open_name, open_pos = envs.pop()
+                    issue("environment", f"\\begin{{{open_name}}} closed by \\end{{{name}}}", open_pos)
+                envs.pop()
+            else:
+                issue("environment", f"\\end{{{name}}} without \\begin", m.start())
+        elif m.group("math"):
+            if m.group("math") == "[":
+                if math_open is not None:
+                    issue("display_math", "Nested \\[ (previous one never closed)", m.start())
+                math_open = m.start()
+            elif math_open is None:
+                issue("display_math", "\\] without \\[", m.start())
+            else:
+                math_open = None
+        elif m.group("pkgs") is not None:
+            for pkg in m.group("pkgs").split(","):
+                if pkg.strip() in banned:
+                    issue("banned_package", f"Package '{pkg.strip()}' is not allowed", m.start())
+        elif m.group("verb"):
+            # Como en los entornos literales: el contenido no cuenta
+            pos = _skip_inline_verbatim(latex_code, pos, m.group("verb"))
+
+    for pos in braces:
+        issue("brace", "Unclosed '{'", pos)
+    for name, pos in envs:
+        issue("environment", f"\\begin{{{name}}} never closed", pos)
+    if math_open is not None:
+        issue("display_math", "\\[ never closed", math_open)
+
+    return issues
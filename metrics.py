@@ -0,0 +1,221 @@
+import os
+import glob
+import json
+import time
+import fcntl
+import atexit
+import bisect
+import threading
+
+
+# ==========================================================
+# MÉTRICAS (formato de texto de Prometheus)
+# ==========================================================
+# Segundos: de una petición de /parse_strokes a una compilación larga
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    "ib_requests_total": ("counter", "Requests by endpoint, method and status"),
+    "ib_request_errors_total": ("counter", "Failed requests by endpoint and error class"),
+    "ib_request_duration_seconds": ("histogram", "Request latency by endpoint"),
+    "ib_stage_duration_seconds": ("histogram", "Latency of each request stage (see Server-Timing)"),
+}
+
+# Clase de error por defecto según el código HTTP (la vista puede marcar una más precisa)
+STATUS_ERRORS = {
+    400: "bad_request",
+    404: "not_found",
+    408: "timeout",
+    409: "conflict",
+    413: "too_large",
+    415: "unsupported_media_type",
+    503: "unavailable",
+}
+
+
+def error_class(status):
+    if status < 400:
+        return None
+    return STATUS_ERRORS.get(status, "client_error" if status < 500 else "server_error")
+
+
+def _labels_text(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + body + "}"
+
+
+class Metrics:
+    """
+    Contadores e histogramas en memoria. Con `snapshot_dir` (varios
+    procesos, gunicorn) un hilo de cada proceso vuelca los suyos a
+    metrics-<pid>.json cada `flush_interval` segundos si han cambiado y
+    render() suma los de todos: el scrape llega a un worker cualquiera. Lo de procesos ya terminados se
+    compacta en metrics-archive.json para que los contadores no retrocedan.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, snapshot_dir=None, flush_interval=5):
+        self.buckets = tuple(buckets)
+        self.snapshot_dir = snapshot_dir
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._counters = {}     # (nombre, labels) -> valor
+        self._histograms = {}   # (nombre, labels) -> [cuentas por bucket (+Inf al final), suma]
+        self._dirty = False
+        self._thread_pid = None
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+            # También corre en los workers de gunicorn (salen con sys.exit)
+            atexit.register(self.flush)
+
+    # ---------- Registro ----------
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._dirty = True
+
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            hist[bisect.bisect_left(self.buckets, seconds)] += 1
+            hist[-1] += seconds
+            self._dirty = True
+
+    def observe_request(self, endpoint, method, status, timer, total):
+        """Apunta una petición terminada con las etapas de su StageTimer."""
+        self.inc("ib_requests_total", (("endpoint", endpoint), ("method", method), ("status", str(status))))
+        self.observe("ib_request_duration_seconds", (("endpoint", endpoint),), total)
+        for name, seconds in timer.stages.items():
+            self.observe("ib_stage_duration_seconds", (("endpoint", endpoint), ("stage", name)), seconds)
+
+        error = timer.error or error_class(status)
+        if error:
+            self.inc("ib_request_errors_total", (("endpoint", endpoint), ("error", error)))
+        if self.snapshot_dir:
+            self._ensure_thread()
+
+    # ---------- Varios procesos ----------
+    def _ensure_thread(self):
+        # Los hilos no sobreviven a un fork: arrancarlo en cada proceso
+        if self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        threading.Thread(target=self._loop, name="metrics-flush", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self._dirty:
+                try:
+                    self.flush()
+                except OSError as e:
+                    print(f"⚠️ Metrics flush failed: {e}")
+
+    def snapshot(self):
+        with self._lock:
+            self._dirty = False
+            return {
+                "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, labels, list(hist)] for (name, labels), hist in self._histograms.items()],
+            }
+
+    def flush(self):
+        """Vuelca el estado de este proceso a snapshot_dir (escritura atómica)."""
+        if not self.snapshot_dir:
+            return
+        data = self.snapshot()
+        if not data["counters"] and not data["histograms"]:
+            return
+        path = os.path.join(self.snapshot_dir, f"metrics-{os.getpid()}.json")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _merge(total, data):
+        for name, labels, value in data["counters"]:
+            key = (name, tuple(map(tuple, labels)))
+            total["counters"][key] = total["counters"].get(key, 0) + value
+        for name, labels, hist in data["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            acc = total["histograms"].get(key)
+            total["histograms"][key] = list(hist) if acc is None else [a + b for a, b in zip(acc, hist)]
+
+    def _compact_locked(self, archive):
+        """Suma al archivo los snapshots de procesos que ya no existen y los borra."""
+        dead = []
+        for path in glob.glob(os.path.join(self.snapshot_dir, "metrics-[0-9]*.json")):
+            pid = int(os.path.basename(path)[8:-5])
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                dead.append(path)
+            except PermissionError:
+                pass
+        if not dead:
+            return
+
+        total = {"counters": {}, "histograms": {}}
+        for path in [archive] + dead:
+            try:
+                with open(path) as f:
+                    self._merge(total, json.load(f))
+            except (OSError, ValueError):
+                continue
+        tmp = archive + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"counters": [[n, l, v] for (n, l), v in total["counters"].items()],
+                       "histograms": [[n, l, h] for (n, l), h in total["histograms"].items()]}, f)
+        os.replace(tmp, archive)
+        for path in dead:
+            os.remove(path)
+
+    def collect(self):
+        """{"counters", "histograms"} de este proceso o de todos (con snapshot_dir)."""
+        total = {"counters": {}, "histograms": {}}
+        if not self.snapshot_dir:
+            self._merge(total, self.snapshot())
+            return total
+
+        self.flush()
+        archive = os.path.join(self.snapshot_dir, "metrics-archive.json")
+        with open(os.path.join(self.snapshot_dir, "compact.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._compact_locked(archive)
+            for path in glob.glob(os.path.join(self.snapshot_dir, "metrics-*.json")):
+                try:
+                    with open(path) as f:
+                        self._merge(total, json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return total
+
+    # ---------- Exposición ----------
+    def render(self):
+        data = self.collect()
+        series = {}
+        for (name, labels), value in sorted(data["counters"].items()):
+            series.setdefault(name, []).append(f"{name}{_labels_text(labels)} {value}")
+        for (name, labels), hist in sorted(data["histograms"].items()):
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for le, count in zip([*(f"{b:g}" for b in self.buckets), "+Inf"], hist[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels_text(labels, ('le', le))} {cumulative}")
+            lines.append(f"{name}_sum{_labels_text(labels)} {hist[-1]:.6f}")
+            lines.append(f"{name}_count{_labels_text(labels)} {cumulative}")
+
+        out = []
+        for name in sorted(series):
+            kind, text = HELP.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(series[name])
+        return "\n".join(out) + "\n"
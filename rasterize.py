@@ -0,0 +1,163 @@
+import os
+import re
+import glob
+import subprocess
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
+
+
+# ==========================================================
+# OPCIONES DE RASTERIZACIÓN (poppler / ghostscript)
+# ==========================================================
+class RenderOptions(BaseModel):
+    """
+    Opciones de render por petición. Todas forman parte de la clave de cache.
+    `width` (ancho objetivo en px) tiene prioridad sobre `dpi`; el SVG es
+    vectorial e ignora dpi/width/crop/gray.
+    """
+    format: Literal["png", "jpeg", "svg"] = "png"
+    dpi: int = Field(300, ge=36, le=600)
+    width: Optional[int] = Field(None, ge=16, le=4000)
+    crop: bool = False
+    gray: bool = False
+    pages: Literal["first", "all"] = "first"
+    thumbnail: Optional[int] = Field(None, ge=16, le=1024)
+
+    @property
+    def ext(self):
+        return "jpg" if self.format == "jpeg" else self.format
+
+    @property
+    def mimetype(self):
+        return {"png": "image/png", "jpeg": "image/jpeg", "svg": "image/svg+xml"}[self.format]
+
+
+DEFAULT_OPTIONS = RenderOptions()
+
+# Margen alrededor del contenido al recortar (en puntos)
+CROP_MARGIN_PT = 4
+
+
+def _run(cmd, tmp, timeout):
+    return subprocess.run(cmd, cwd=tmp, check=True, timeout=timeout,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def page_count(tmp, timeout=15):
+    out = _run(["pdfinfo", "doc.pdf"], tmp, timeout).stdout.decode("latin-1")
+    m = re.search(r"^Pages:\s+(\d+)", out, re.MULTILINE)
+    return int(m.group(1)) if m else 1
+
+
+def _page_sizes(tmp, first, last, timeout):
+    out = _run(["pdfinfo", "-f", str(first), "-l", str(last), "doc.pdf"], tmp, timeout).stdout.decode("latin-1")
+    sizes = {int(n): (float(w), float(h))
+             for n, w, h in re.findall(r"^Page\s+(\d+) size:\s+([\d.]+) x ([\d.]+)", out, re.MULTILINE)}
+    return [sizes.get(p, (612.0, 792.0)) for p in range(first, last + 1)]
+
+
+def _content_bboxes(tmp, first, last, timeout):
+    # El device bbox de ghostscript imprime la caja de tinta de cada página por stderr
+    err = _run(["gs", "-q", "-dSAFER", "-dBATCH", "-dNOPAUSE", "-sDEVICE=bbox",
+                f"-dFirstPage={first}", f"-dLastPage={last}", "doc.pdf"], tmp, timeout).stderr.decode("latin-1")
+    boxes = [tuple(map(float, m)) for m in
+             re.findall(r"%%HiResBoundingBox: ([\d.-]+) ([\d.-]+) ([\d.-]+) ([\d.-]+)", err)]
+    return boxes + [None] * (last - first + 1 - len(boxes))
+
+
+def _scale_args(options, size, bbox, box):
+    """Resolución (y recorte en px) para que una página cumpla dpi/width/crop/box."""
+    page_w, page_h = size
+    x0, y0, x1, y1 = 0.0, 0.0, page_w, page_h
+    if options.crop and bbox is not None and bbox[2] > bbox[0] and bbox[3] > bbox[1]:
+        x0 = max(0.0, bbox[0] - CROP_MARGIN_PT)
+        y0 = max(0.0, bbox[1] - CROP_MARGIN_PT)
+        x1 = min(page_w, bbox[2] + CROP_MARGIN_PT)
+        y1 = min(page_h, bbox[3] + CROP_MARGIN_PT)
+
+    if box:
+        dpi = box * 72.0 / max(x1 - x0, y1 - y0)
+    elif options.width:
+        dpi = options.width * 72.0 / (x1 - x0)
+    else:
+        dpi = options.dpi
+
+    args = ["-r", f"{dpi:.4f}"]
+    if options.crop:
+        px = lambda v: str(int(round(v * dpi / 72.0)))
+        # pdftoppm mide y desde arriba; el PDF desde abajo
+        args += ["-x", px(x0), "-y", px(page_h - y1), "-W", px(x1 - x0), "-H", px(y1 - y0)]
+    return args
+
+
+def _stdout(cmd, tmp, timeout):
+    # Una sola página: poppler la escribe por la tubería, sin archivo intermedio.
+    # Salida vacía = página no generada (igual que un archivo que no aparece)
+    out = _run(cmd, tmp, timeout).stdout
+    return [out] if out else []
+
+
+def _read_pages(tmp, root, ext):
+    # pdftoppm rellena con ceros según el total de páginas (page-01.png...)
+    paths = sorted(glob.glob(os.path.join(tmp, f"{root}-*.{ext}")),
+                   key=lambda p: int(p.rsplit("-", 1)[1].split(".")[0]))
+    pages = []
+    for path in paths:
+        with open(path, "rb") as f:
+            pages.append(f.read())
+    return pages
+
+
+def rasterize(tmp, options, first, last, timeout=15, box=None, root="page"):
+    """
+    Convierte las páginas first..last de tmp/doc.pdf y devuelve [bytes] por
+    página. Sin recorte es una sola llamada a poppler para todo el rango;
+    con recorte hace falta una por página (cada una tiene su caja).
+    Las llamadas de una sola página se leen de stdout; solo un rango de
+    varias páginas pasa por archivos. `box` fuerza un PNG que quepa en
+    box x box px (miniaturas).
+    """
+    if options.format == "svg" and not box:
+        return [page for p in range(first, last + 1)
+                for page in _stdout(["pdftocairo", "-svg", "-f", str(p), "-l", str(p), "doc.pdf", "-"], tmp, timeout)]
+
+    ext = "png" if box or options.format == "png" else "jpg"
+    cmd = ["pdftoppm", "-png" if ext == "png" else "-jpeg"]
+    if options.gray:
+        cmd.append("-gray")
+
+    if not options.crop:
+        if box:
+            cmd += ["-scale-to", str(box)]
+        elif options.width:
+            cmd += ["-scale-to-x", str(options.width), "-scale-to-y", "-1"]
+        else:
+            cmd += ["-r", str(options.dpi)]
+        if first == last:
+            return _stdout(cmd + ["-f", str(first), "-l", str(last), "-singlefile", "doc.pdf"], tmp, timeout)
+        _run(cmd + ["-f", str(first), "-l", str(last), "doc.pdf", root], tmp, timeout)
+        return _read_pages(tmp, root, ext)
+
+    sizes = _page_sizes(tmp, first, last, timeout)
+    bboxes = _content_bboxes(tmp, first, last, timeout)
+    pages = []
+    for p, size, bbox in zip(range(first, last + 1), sizes, bboxes):
+        pages += _stdout(cmd + _scale_args(options, size, bbox, box) + ["-f", str(p), "-l", str(p), "-singlefile",
+                                                                        "doc.pdf"], tmp, timeout)
+    return pages
+
+
+def build_artifacts(options, pdf_bytes, images, thumb=None):
+    """
+    Artefactos de un documento (o de un ítem de lote): doc.pdf, doc.<ext>
+    (primera página), page-N.<ext> si pages="all" y thumb.png si se pidió
+    miniatura.
+    """
+    artifacts = {"doc.pdf": pdf_bytes, f"doc.{options.ext}": images[0]}
+    if options.pages == "all":
+        for n, data in enumerate(images, 1):
+            artifacts[f"page-{n}.{options.ext}"] = data
+    if thumb is not None:
+        artifacts["thumb.png"] = thumb
+    return artifacts
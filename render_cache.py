@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+from latex_compiler import CompileError
+from request_timing import stage
+
+
+# ==========================================================
+# CACHE DE RENDERS (direccionado por contenido)
+# ==========================================================
+def make_cache_key(clean_latex, options):
+    """
+    Hash del LaTeX ya sanitizado + opciones de render. Dos peticiones con el
+    mismo documento y las mismas opciones comparten la misma entrada.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(options, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    h.update(b"\0")
+    h.update(clean_latex.encode("utf-8"))
+    return h.hexdigest()
+
+
+class _Flight:
+    """Compilación en curso que otras peticiones idénticas pueden esperar."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        self.error = None
+
+
+class RenderCache:
+    """
+    Cache en disco con límite de tamaño y desalojo LRU.
+
+    Cada entrada es un directorio <root>/<key[:2]>/<key>/ con los artefactos
+    del render (doc.pdf, doc.png, ...). El mtime de cada directorio (se
+    actualiza en cada hit) es el orden LRU; el índice en memoria es solo una
+    copia. Varios procesos (workers de gunicorn) comparten el directorio:
+    una clave que no está en el índice se busca en disco y se adopta, y cada
+    `sync_interval` segundos (o al pasarse del límite) `put` vuelve a leer el
+    disco entero, así el límite de tamaño es el de todo el directorio y no
+    el de lo que ha escrito cada proceso.
+
+    Las peticiones concurrentes con la misma clave esperan a la compilación
+    que ya está en curso (single-flight) en vez de lanzar otro pdflatex;
+    entre procesos, con un flock por clave (<key>.lock).
+    """
+
+    def __init__(self, root, max_bytes, sync_interval=10):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # key -> bytes en disco (de más viejo a más nuevo)
+        self._total_bytes = 0
+        self._inflight = {}
+        self._synced_at = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+        os.makedirs(self.root, exist_ok=True)
+        self._load_index()
+
+    # ---------- rutas ----------
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _entry(self, key):
+        d = self._entry_dir(key)
+        return {name: os.path.join(d, name) for name in os.listdir(d)}
+
+    @staticmethod
+    def _dir_size(d):
+        return sum(os.path.getsize(os.path.join(d, n)) for n in os.listdir(d))
+
+    # ---------- índice ----------
+    def _scan(self):
+        """[(mtime, clave, bytes)] de todo lo que hay en disco, de más viejo a más nuevo."""
+        found = []
+        now = time.time()
+        for shard in os.listdir(self.root):
+            shard_dir = os.path.join(self.root, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for key in os.listdir(shard_dir):
+                d = os.path.join(shard_dir, key)
+                if key.endswith(".lock"):
+                    continue
+                # Restos de escrituras interrumpidas (las recientes pueden ser de otro worker)
+                if key.endswith(".tmp"):
+                    try:
+                        if now - os.path.getmtime(d) > 3600:
+                            shutil.rmtree(d, ignore_errors=True)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    found.append((os.path.getmtime(d), key, self._dir_size(d)))
+                except OSError:
+                    continue
+        return sorted(found)
+
+    def _load_index(self):
+        found = self._scan()
+        with self._lock:
+            self._index = OrderedDict((key, size) for _, key, size in found)
+            self._total_bytes = sum(size for _, _, size in found)
+            self._evict_locked()
+        self._synced_at = time.monotonic()
+
+    def _evict_locked(self):
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            self._remove_key_lock(key)
+
+    def _remove_key_lock(self, key):
+        """
+        Borra <key>.lock solo si nadie lo tiene: con él cogido, quien esté
+        esperando en ese inode ve al despertar que ya no es el del path y
+        vuelve a abrir (_key_lock). Si está en uso se queda para la próxima.
+        """
+        path = self._entry_dir(key) + ".lock"
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except OSError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                os.remove(path)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    # ---------- API ----------
+    def get(self, key):
+        """Devuelve {nombre: ruta} si la clave está en cache, o None (cuenta hit/miss)."""
+        entry = self._lookup(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def _lookup(self, key):
+        with self._lock:
+            known = key in self._index
+            if known:
+                self._index.move_to_end(key)
+        if not known:
+            # Puede haberla escrito otro worker
+            try:
+                size = self._dir_size(self._entry_dir(key))
+            except OSError:
+                return None
+            with self._lock:
+                if key not in self._index:
+                    self._index[key] = size
+                    self._total_bytes += size
+        try:
+            os.utime(self._entry_dir(key))
+            return self._entry(key)
+        except OSError:
+            # Alguien borró el directorio por fuera: tratarlo como miss
+            with self._lock:
+                size = self._index.pop(key, 0)
+                self._total_bytes -= size
+            return None
+
+    def put(self, key, artifacts):
+        """Guarda {nombre: bytes} de forma atómica y devuelve {nombre: ruta}."""
+        final_dir = self._entry_dir(key)
+        tmp_dir = f"{final_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        size = 0
+        for name, data in artifacts.items():
+            with open(os.path.join(tmp_dir, name), "wb") as f:
+                f.write(data)
+            size += len(data)
+
+        shutil.rmtree(final_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, final_dir)
+        except OSError:
+            # Otro worker la escribió entre medias: vale la suya
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(final_dir):
+                raise
+
+        with self._lock:
+            self._total_bytes -= self._index.pop(key, 0)
+            self._index[key] = size
+            self._total_bytes += size
+            resync = self._total_bytes > self.max_bytes or \
+                time.monotonic() - self._synced_at > self.sync_interval
+        if resync:
+            self._load_index()
+
+        return self._entry(key)
+
+    def _key_lock(self, key):
+        # flock por clave: single-flight entre procesos
+        path = self._entry_dir(key) + ".lock"
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # Si el desalojo lo borró mientras esperaba, el lock es de un
+            # archivo que ya nadie más abrirá: otro proceso podría ser líder
+            try:
+                if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def get_or_render(self, key, render):
+        """
+        Devuelve (entrada, hit). En un miss ejecuta render() -> {nombre: bytes}
+        una sola vez aunque lleguen varias peticiones idénticas a la vez; las
+        demás esperan y reciben la misma entrada (o la misma excepción).
+        """
+        entry = self._lookup(key)
+        if entry is not None:
+            with self._lock:
+                self.hits += 1
+            return entry, True
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            with stage("coalesced"):
+                flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.entry, True
+
+        lock_fd = None
+        try:
+            os.makedirs(os.path.dirname(self._entry_dir(key)), exist_ok=True)
+            with stage("coalesced"):
+                lock_fd = self._key_lock(key)
+            # Mientras esperaba el lock otro worker pudo compilarla
+            entry = self._lookup(key)
+            if entry is not None:
+                with self._lock:
+                    self.coalesced += 1
+                flight.entry = entry
+                return entry, True
+
+            artifacts = render()
+            with stage("cache_write"):
+                flight.entry = self.put(key, artifacts)
+            return flight.entry, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            if lock_fd is not None:
+                os.close(lock_fd)
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self.coalesced,
+                "entries": len(self._index),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "inflight": len(self._inflight),
+            }
+
+
+# ==========================================================
+# CACHE NEGATIVA (documentos que ya fallaron)
+# ==========================================================
+class FailureCache:
+    """
+    Hash del fuente -> error de compilación, en disco para que lo vean
+    todos los workers. Reenviar el mismo documento roto falla al momento
+    sin lanzar pdflatex. Solo se guardan los errores deterministas (400: el
+    LaTeX está mal); un timeout o un fallo de poppler pueden ser de la carga.
+    `namespace` separa configuraciones que cambian el resultado (p.ej. el
+    número de intentos de reparación).
+    """
+
+    def __init__(self, root, ttl=86400, max_entries=10000, namespace=""):
+        self.root = root
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stores = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, source):
+        h = hashlib.sha256()
+        h.update(self.namespace.encode("utf-8"))
+        h.update(b"\0")
+        h.update(source.encode("utf-8"))
+        return os.path.join(self.root, h.hexdigest() + ".json")
+
+    def get(self, source):
+        """CompileError guardado para este fuente (con "cached": true) o None."""
+        path = self._path(source)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self.hits += 1
+        payload = saved["payload"]
+        return CompileError(payload.pop("error"), saved["status"], **payload, cached=True)
+
+    def put(self, source, error):
+        if error.status != 400:
+            return
+        path = self._path(source)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"status": error.status, "payload": error.payload}, f)
+        os.replace(tmp, path)
+        with self._lock:
+            self.stores += 1
+            trim = self.stores % 256 == 0
+        if trim:
+            self._trim()
+
+    def _trim(self):
+        # Caducados fuera y, si siguen sobrando, los más viejos
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                mtime = os.path.getmtime(path)
+                if now - mtime > self.ttl:
+                    os.remove(path)
+                else:
+                    entries.append((mtime, path))
+            except OSError:
+                continue
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "stores": self.stores, "ttl": self.ttl, "max_entries": self.max_entries}
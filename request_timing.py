@@ -0,0 +1,83 @@
+import time
+import contextvars
+from contextlib import contextmanager
+
+
+# ==========================================================
+# TIEMPOS POR ETAPA DE UNA PETICIÓN (Server-Timing)
+# ==========================================================
+class StageTimer:
+    """
+    Duraciones de las etapas de una petición en orden de aparición; una
+    etapa que se repite (p.ej. el segundo pdflatex tras fallar el .fmt)
+    acumula su tiempo. `info` va al log de peticiones lentas y `error`
+    es la clase de error si la vista la marca.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.info = {}
+        self.error = None
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def header(self, total):
+        """Valor del header Server-Timing (duraciones en ms)."""
+        parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items()]
+        parts.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(parts)
+
+
+# El timer de la petición en curso. CompileScheduler copia el contexto al
+# hilo de compilación, así pdflatex/poppler apuntan en el mismo timer.
+_current = contextvars.ContextVar("stage_timer", default=None)
+
+
+def start_timer():
+    """Nuevo timer para la petición actual; devuelve (timer, token para stop_timer)."""
+    timer = StageTimer()
+    return timer, _current.set(timer)
+
+
+def stop_timer(token):
+    _current.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """Mide el bloque como etapa `name` (no hace nada fuera de una petición)."""
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started)
+
+
+def record(name, seconds):
+    """Suma una duración ya medida a la etapa `name`."""
+    timer = _current.get()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+def annotate(**info):
+    """Datos de la petición para el log de lentas (hash del documento, tamaños...)."""
+    timer = _current.get()
+    if timer is not None:
+        timer.info.update(info)
+
+
+def mark_error(kind):
+    """Clase de error de la petición (por defecto sale del código HTTP)."""
+    timer = _current.get()
+    if timer is not None:
+        timer.error = kind
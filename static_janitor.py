@@ -0,0 +1,175 @@
+import os
+import time
+import heapq
+import shutil
+import hashlib
+import threading
+
+
+# ==========================================================
+# LIMPIEZA DE static/ EN SEGUNDO PLANO
+# ==========================================================
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class StaticJanitor:
+    """
+    Publica los PNG en static/ con nombre por hash de contenido (dos renders
+    idénticos comparten archivo) y los borra en segundo plano cuando caducan.
+
+    Las caducidades viven en un heap en memoria, así que una pasada solo mira
+    los archivos que realmente vencen en vez de hacer glob + stat de todo el
+    directorio en cada petición. Además se respetan un máximo de bytes y de
+    archivos: al pasarse se borran primero los que antes iban a caducar.
+
+    El mtime del archivo es la fuente de verdad: volver a publicar algo ya
+    existente solo lo "toca", y antes de borrar se comprueba el mtime, de modo
+    que varios procesos pueden compartir el mismo directorio. Cada `interval`
+    segundos (y siempre que se pasa de un límite) el heap se rehace desde el
+    disco, así los límites cuentan también lo publicado por los demás
+    procesos y se borra primero lo más viejo de todos.
+    """
+
+    def __init__(self, root, prefix="exercise_", ttl=3600, max_bytes=1 << 30, max_files=10000, interval=60):
+        self.root = root
+        self.prefix = prefix
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._heap = []     # (expira, nombre); entradas viejas se descartan al sacarlas
+        self._files = {}    # nombre -> (expira, bytes)
+        self._total_bytes = 0
+        self._wakeup = threading.Event()
+        self._thread_pid = None
+        self._scanned_at = 0.0
+
+        self.removed = 0
+
+        os.makedirs(self.root, exist_ok=True)
+        with self._lock:
+            self._rescan_locked()
+
+    def _rescan_locked(self):
+        """Rehace el heap con todo lo que hay en disco (de cualquier proceso)."""
+        self._heap = []
+        self._files = {}
+        self._total_bytes = 0
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.name.startswith(self.prefix) or entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                self._files[entry.name] = (st.st_mtime + self.ttl, st.st_size)
+                self._total_bytes += st.st_size
+                self._heap.append((st.st_mtime + self.ttl, entry.name))
+        heapq.heapify(self._heap)
+        self._scanned_at = time.time()
+
+    def _track_locked(self, name, expires_at, size):
+        old = self._files.get(name)
+        if old is not None:
+            self._total_bytes -= old[1]
+        self._files[name] = (expires_at, size)
+        self._total_bytes += size
+        heapq.heappush(self._heap, (expires_at, name))
+
+    def _ensure_thread(self):
+        # Los hilos no sobreviven a un fork: arrancarlo en cada proceso
+        if self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        threading.Thread(target=self._loop, name="static-janitor", daemon=True).start()
+
+    def publish(self, src_path, ext="png"):
+        """Enlaza/copia src_path a static/ con nombre por hash y devuelve el nombre."""
+        self._ensure_thread()
+        name = f"{self.prefix}{file_digest(src_path)[:32]}.{ext}"
+        dst = os.path.join(self.root, name)
+
+        try:
+            os.utime(dst)
+        except FileNotFoundError:
+            tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                os.link(src_path, tmp)
+            except OSError:
+                shutil.copyfile(src_path, tmp)
+            os.replace(tmp, dst)
+
+        with self._lock:
+            self._track_locked(name, time.time() + self.ttl, os.path.getsize(dst))
+            over_limit = self._total_bytes > self.max_bytes or len(self._files) > self.max_files
+        if over_limit:
+            self._wakeup.set()
+        return name
+
+    def _remove_locked(self, name):
+        _, size = self._files.pop(name)
+        self._total_bytes -= size
+        try:
+            os.remove(os.path.join(self.root, name))
+            self.removed += 1
+        except OSError:
+            pass
+
+    def sweep(self):
+        """Borra lo caducado y, si hace falta, lo más próximo a caducar. Devuelve la próxima caducidad."""
+        now = time.time()
+        with self._lock:
+            over_limit = self._total_bytes > self.max_bytes or len(self._files) > self.max_files
+            if over_limit or now - self._scanned_at >= self.interval:
+                self._rescan_locked()
+            while self._heap:
+                expires_at, name = self._heap[0]
+                current = self._files.get(name)
+                # Entrada obsoleta (se volvió a publicar o ya se borró)
+                if current is None or current[0] != expires_at:
+                    heapq.heappop(self._heap)
+                    continue
+
+                over_limit = self._total_bytes > self.max_bytes or len(self._files) > self.max_files
+                if expires_at > now and not over_limit:
+                    return expires_at
+
+                heapq.heappop(self._heap)
+                if not over_limit:
+                    # Otro proceso pudo haberlo refrescado
+                    try:
+                        mtime = os.path.getmtime(os.path.join(self.root, name))
+                    except OSError:
+                        mtime = 0
+                    if mtime + self.ttl > now:
+                        self._track_locked(name, mtime + self.ttl, current[1])
+                        continue
+                self._remove_locked(name)
+        return None
+
+    def _loop(self):
+        while True:
+            next_expiry = self.sweep()
+            timeout = self.interval
+            if next_expiry is not None:
+                timeout = min(timeout, max(0.0, next_expiry - time.time()))
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "bytes": self._total_bytes,
+                "max_files": self.max_files,
+                "max_bytes": self.max_bytes,
+                "removed": self.removed,
+            }
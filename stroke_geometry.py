@@ -0,0 +1,201 @@
+import json
+import struct
+from itertools import chain
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:  # opcional: solo hace falta para application/msgpack
+    msgpack = None
+
+
+# ==========================================================
+# TRAZOS EN ARRAYS CONTIGUOS (camino rápido de /parse_strokes)
+# ==========================================================
+class StrokeBatch:
+    """
+    Todos los trazos de una petición en arrays planos: `coords` es (N, 2)
+    (float64 desde JSON, float32 desde el formato binario) con los puntos de todos los trazos seguidos y `offsets` (n+1)
+    marca dónde empieza cada uno (los puntos del trazo i son
+    coords[offsets[i]:offsets[i+1]]). Los metadatos (groupIds, frameId...)
+    se guardan tal cual, uno por trazo.
+    """
+
+    def __init__(self, ids, coords, offsets, meta=None):
+        self.ids = ids
+        self.coords = coords
+        self.offsets = offsets
+        self.meta = meta if meta is not None else [{} for _ in ids]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def points(self, i):
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+
+# Campos de Excalidraw que se conservan por trazo (el resto se ignora)
+STROKE_META = ("strokeWidth", "strokeColor", "groupIds", "frameId", "seed")
+
+
+def decode_elements(elements):
+    """
+    Lista de elementos JSON ({"id", "points": [[x, y], ...], ...}) ->
+    StrokeBatch, sin pasar cada punto por pydantic. ValueError si el
+    formato no es válido.
+    """
+    if not isinstance(elements, list):
+        raise ValueError("'elements' must be a list")
+
+    ids, point_lists, meta = [], [], []
+    for el in elements:
+        try:
+            ids.append(str(el["id"]))
+            point_lists.append(el.get("points") or [])
+        except (TypeError, KeyError):
+            raise ValueError("Every element needs an 'id' and a 'points' list")
+        meta.append({k: el[k] for k in STROKE_META if el.get(k) is not None})
+
+    try:
+        lengths = np.fromiter(map(len, point_lists), np.int64, count=len(point_lists))
+    except TypeError:
+        raise ValueError("Every element needs an 'id' and a 'points' list")
+    offsets = np.zeros(len(point_lists) + 1, np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    total = int(offsets[-1])
+
+    try:
+        flat = np.fromiter(chain.from_iterable(chain.from_iterable(point_lists)), np.float64)
+    except (TypeError, ValueError):
+        raise ValueError("Points must be [x, y] number pairs")
+    if flat.size != 2 * total:
+        raise ValueError("Points must be [x, y] number pairs")
+
+    return StrokeBatch(ids, flat.reshape(total, 2), offsets, meta)
+
+
+# ==========================================================
+# FORMATO BINARIO COMPACTO (application/x-ib-strokes)
+# ==========================================================
+# Todo en little-endian:
+#   cabecera   "IBSK", versión u16, flags u16, n trazos u32, bytes de meta u32
+#   offsets    (n + 1) x u32, en puntos (el trazo i son los puntos offsets[i]..offsets[i+1])
+#   meta       JSON utf-8: lista de n objetos {"id", "groupIds", "frameId", ...}
+#              sin "points", rellenado con espacios hasta múltiplo de 4
+#   puntos     2 x offsets[n] float32 (x, y, x, y, ...)
+# Los puntos se leen con np.frombuffer sobre el cuerpo de la petición, sin copiarlos.
+STROKES_MIMETYPE = "application/x-ib-strokes"
+MSGPACK_MIMETYPES = ("application/msgpack", "application/x-msgpack")
+
+class UnsupportedFormat(Exception):
+    """El cuerpo está en un formato cuyo decodificador no está instalado."""
+
+
+_MAGIC = b"IBSK"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHHII")
+
+
+def encode_strokes(elements):
+    """Elementos JSON -> bytes en el formato binario (para clientes y pruebas)."""
+    meta, offsets, coords = [], [0], []
+    for el in elements:
+        meta.append({k: v for k, v in el.items() if k != "points"})
+        points = el.get("points") or []
+        offsets.append(offsets[-1] + len(points))
+        coords.extend(chain.from_iterable(points))
+
+    meta_bytes = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+    meta_bytes += b" " * (-len(meta_bytes) % 4)
+    return b"".join([
+        _HEADER.pack(_MAGIC, _VERSION, 0, len(elements), len(meta_bytes)),
+        np.asarray(offsets, "<u4").tobytes(),
+        meta_bytes,
+        np.asarray(coords, "<f4").tobytes(),
+    ])
+
+
+def decode_strokes(data):
+    """Bytes en el formato binario -> StrokeBatch (coords float32 sin copia)."""
+    if len(data) < _HEADER.size:
+        raise ValueError("Truncated stroke buffer")
+    magic, version, _, n, meta_len = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("Not an IBSK v1 stroke buffer")
+
+    pos = _HEADER.size
+    offsets_end = pos + 4 * (n + 1)
+    points_at = offsets_end + meta_len
+    if meta_len % 4 or points_at > len(data):
+        raise ValueError("Truncated stroke buffer")
+    offsets = np.frombuffer(data, "<u4", n + 1, pos).astype(np.int64)
+    if offsets[0] != 0 or np.any(np.diff(offsets) < 0):
+        raise ValueError("Stroke offsets must start at 0 and never decrease")
+
+    total = int(offsets[-1])
+    if points_at + 8 * total != len(data):
+        raise ValueError("Point buffer does not match the stroke offsets")
+
+    try:
+        meta = json.loads(bytes(data[offsets_end:points_at]))
+        ids = [str(m["id"]) for m in meta]
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Stroke metadata must be a JSON list of objects with 'id'")
+    if len(ids) != n:
+        raise ValueError("Stroke metadata does not match the stroke count")
+
+    coords = np.frombuffer(data, "<f4", 2 * total, points_at).reshape(total, 2)
+    meta = [{k: m[k] for k in STROKE_META if m.get(k) is not None} for m in meta]
+    return StrokeBatch(ids, coords, offsets, meta)
+
+
+def decode_msgpack(data):
+    """MessagePack con la misma forma que el JSON ({"elements": [...]})."""
+    if msgpack is None:
+        raise UnsupportedFormat("MessagePack support is not installed")
+    try:
+        payload = msgpack.unpackb(data, raw=False)
+    except Exception:
+        raise ValueError("Invalid MessagePack body")
+    if isinstance(payload, list):
+        payload = payload[0] if payload else {}
+    if not isinstance(payload, dict):
+        raise ValueError("MessagePack body must be a map with 'elements'")
+    return decode_elements(payload.get("elements"))
+
+
+def compute_bboxes(batch):
+    """
+    Cajas [minx, miny, maxx, maxy] de todos los trazos de una vez. Devuelve
+    (índices de los trazos con puntos, array (k, 4)); los trazos vacíos no
+    tienen caja.
+    """
+    lengths = np.diff(batch.offsets)
+    nonempty = np.flatnonzero(lengths)
+    if nonempty.size == 0:
+        return nonempty, np.zeros((0, 4))
+
+    # Los trazos vacíos no ocupan sitio en coords: cada segmento de reduceat
+    # termina justo donde empieza el siguiente trazo con puntos
+    starts = batch.offsets[nonempty]
+    mins = np.minimum.reduceat(batch.coords, starts, axis=0)
+    maxs = np.maximum.reduceat(batch.coords, starts, axis=0)
+    return nonempty, np.hstack([mins, maxs])
+
+
+def symbols_json(batch, include_points=False, simplified=None):
+    """
+    Lista de símbolos {"id", "bbox"[, "points"]} lista para jsonify. Las
+    cajas salen siempre de los puntos originales; si se pasa `simplified`
+    (mismos trazos, menos puntos) se devuelven esos puntos.
+    """
+    idxs, bboxes = compute_bboxes(batch)
+    source = simplified if simplified is not None else batch
+    symbols = []
+    for i, bbox in zip(idxs.tolist(), bboxes.tolist()):
+        symbol = {"id": batch.ids[i], "bbox": bbox}
+        if include_points:
+            symbol["points"] = source.points(i).tolist()
+        symbols.append(symbol)
+    return symbols
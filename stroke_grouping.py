@@ -0,0 +1,298 @@
+from typing import Optional
+
+import numpy as np
+from pydantic import BaseModel, Field
+
+from stroke_geometry import StrokeBatch, compute_bboxes
+
+
+class GeometryOptions(BaseModel):
+    """
+    Etapa de geometría opcional de /parse_strokes. Sin `gap`/`line_gap`
+    se usan proporciones del tamaño típico de trazo; `simplify` es la
+    tolerancia de RDP en unidades del lienzo.
+    """
+    group: bool = False
+    gap: Optional[float] = Field(None, ge=0)
+    line_gap: Optional[float] = Field(None, ge=0)
+    simplify: Optional[float] = Field(None, gt=0)
+
+
+# ==========================================================
+# ÍNDICE ESPACIAL (rejilla uniforme sobre las cajas)
+# ==========================================================
+# La celda nunca es menor que el lienzo / MAX_GRID_SIDE (con trazos casi
+# todos puntos la mediana es 0), y una caja que toque más de
+# MAX_CELLS_PER_BOX celdas se compara directamente con todas
+MAX_GRID_SIDE = 1024
+MAX_CELLS_PER_BOX = 64
+
+
+def proximity_pairs(bboxes, gap, cell=None):
+    """
+    Pares (i, j), i < j, de cajas a distancia <= gap. Cada caja se amplía
+    gap/2 por lado y se apunta en las celdas de la rejilla que toca: dos
+    cajas cercanas comparten al menos una celda, así que solo se comparan
+    las que caen juntas (casi lineal si las celdas no están saturadas).
+    """
+    n = len(bboxes)
+    if n < 2:
+        return np.zeros((0, 2), np.int64)
+
+    half = gap / 2.0
+    grown = bboxes + np.array([-half, -half, half, half])
+    if cell is None:
+        # Celda del tamaño típico de un trazo: pocas cajas por celda y pocas celdas por caja
+        sizes = np.maximum(grown[:, 2] - grown[:, 0], grown[:, 3] - grown[:, 1])
+        cell = max(float(np.median(sizes)), gap)
+    extent = max(grown[:, 2].max() - grown[:, 0].min(), grown[:, 3].max() - grown[:, 1].min())
+    cell = max(cell, float(extent) / MAX_GRID_SIDE, 1e-6)
+
+    c = np.floor(grown / cell).astype(np.int64)
+    nx = c[:, 2] - c[:, 0] + 1
+    ny = c[:, 3] - c[:, 1] + 1
+    counts = nx * ny
+    big = np.flatnonzero(counts > MAX_CELLS_PER_BOX)
+    counts[big] = 0
+
+    chunks = []
+    for i in big.tolist():
+        others = np.delete(np.arange(n), i)
+        chunks.append(np.stack([np.full(n - 1, i), others], axis=1))
+
+    # Una fila (caja, celda) por cada celda que toca cada caja
+    owner = np.repeat(np.arange(n), counts)
+    if len(owner):
+        k = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = c[owner, 0] + k % nx[owner]
+        cy = c[owner, 1] + k // nx[owner]
+        key = (cx - cx.min()) * (int(cy.max() - cy.min()) + 1) + (cy - cy.min())
+
+        order = np.argsort(key, kind="stable")
+        key, owner = key[order], owner[order]
+        bounds = np.flatnonzero(np.diff(key)) + 1
+        starts = np.concatenate([[0], bounds])
+        ends = np.concatenate([bounds, [len(key)]])
+
+        triu = {}
+        for s, e in zip(starts.tolist(), ends.tolist()):
+            size = e - s
+            if size < 2:
+                continue
+            if size not in triu:
+                triu[size] = np.triu_indices(size, 1)
+            a, b = triu[size]
+            members = owner[s:e]
+            chunks.append(np.stack([members[a], members[b]], axis=1))
+    if not chunks:
+        return np.zeros((0, 2), np.int64)
+
+    pairs = np.concatenate(chunks)
+    pairs.sort(axis=1)
+    # La misma pareja puede compartir varias celdas
+    pairs = np.unique(pairs[:, 0] * n + pairs[:, 1])
+    pairs = np.stack([pairs // n, pairs % n], axis=1)
+
+    bi, bj = bboxes[pairs[:, 0]], bboxes[pairs[:, 1]]
+    dx = np.maximum(0.0, np.maximum(bi[:, 0], bj[:, 0]) - np.minimum(bi[:, 2], bj[:, 2]))
+    dy = np.maximum(0.0, np.maximum(bi[:, 1], bj[:, 1]) - np.minimum(bi[:, 3], bj[:, 3]))
+    return pairs[np.hypot(dx, dy) <= gap]
+
+
+class _UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        ri, rj = self.find(i), self.find(j)
+        if ri != rj:
+            self.parent[max(ri, rj)] = min(ri, rj)
+
+
+# ==========================================================
+# AGRUPACIÓN: trazos -> símbolos -> líneas -> filas
+# ==========================================================
+# Por defecto las distancias se miden en tamaños de trazo típicos (mediana
+# del lado mayor de las cajas), así funcionan igual a cualquier zoom.
+DEFAULT_GAP_RATIO = 0.2
+DEFAULT_LINE_GAP_RATIO = 1.5
+ROW_TOLERANCE_RATIO = 0.6
+
+
+def _union_bbox(boxes):
+    return [float(boxes[:, 0].min()), float(boxes[:, 1].min()),
+            float(boxes[:, 2].max()), float(boxes[:, 3].max())]
+
+
+def _median_size(boxes):
+    return float(np.median(np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])))
+
+
+def cluster_strokes(batch, idxs, bboxes, gap):
+    """
+    Une en símbolos los trazos a distancia <= gap o del mismo grupo de
+    Excalidraw (groupIds[0], el más interno). Trazos de frames distintos
+    nunca se unen. Devuelve listas de posiciones dentro de idxs.
+    """
+    n = len(idxs)
+    frames = [batch.meta[i].get("frameId") for i in idxs.tolist()]
+    uf = _UnionFind(n)
+
+    for a, b in proximity_pairs(bboxes, gap).tolist():
+        if frames[a] == frames[b]:
+            uf.union(a, b)
+
+    first_in_group = {}
+    for pos, i in enumerate(idxs.tolist()):
+        group_ids = batch.meta[i].get("groupIds")
+        if group_ids:
+            uf.union(pos, first_in_group.setdefault(group_ids[0], pos))
+
+    clusters = {}
+    for pos in range(n):
+        clusters.setdefault(uf.find(pos), []).append(pos)
+    return list(clusters.values())
+
+
+def _rows(boxes, tolerance):
+    """Bandas horizontales: índices agrupados por centro vertical, de arriba abajo."""
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    rows = []
+    mean = None
+    for k in np.argsort(cy, kind="stable").tolist():
+        if rows and cy[k] - mean <= tolerance:
+            rows[-1].append(k)
+            mean += (cy[k] - mean) / len(rows[-1])
+        else:
+            rows.append([k])
+            mean = cy[k]
+    return rows
+
+
+def _lines(boxes, row, line_gap):
+    """Parte una fila en líneas donde el hueco horizontal supera line_gap."""
+    row = sorted(row, key=lambda k: boxes[k, 0])
+    lines = [[row[0]]]
+    right = boxes[row[0], 2]
+    for k in row[1:]:
+        if boxes[k, 0] - right > line_gap:
+            lines.append([k])
+            right = boxes[k, 2]
+        else:
+            lines[-1].append(k)
+            right = max(right, boxes[k, 2])
+    return lines
+
+
+def group_strokes(batch, gap=None, line_gap=None):
+    """
+    Agrupa los trazos con puntos en símbolos, líneas y filas. Devuelve
+    {"groups", "lines", "rows"} listo para jsonify; los símbolos van en
+    orden de lectura (por frame, filas de arriba abajo, izquierda a derecha).
+    """
+    idxs, bboxes = compute_bboxes(batch)
+    if len(idxs) == 0:
+        return {"groups": [], "lines": [], "rows": []}
+
+    stroke_size = _median_size(bboxes)
+    if gap is None:
+        gap = DEFAULT_GAP_RATIO * stroke_size
+    clusters = cluster_strokes(batch, idxs, bboxes, gap)
+
+    cluster_boxes = np.array([_union_bbox(bboxes[c]) for c in clusters])
+    cluster_frames = [batch.meta[idxs[c[0]]].get("frameId") for c in clusters]
+    if line_gap is None:
+        line_gap = DEFAULT_LINE_GAP_RATIO * _median_size(cluster_boxes)
+
+    by_frame = {}
+    for k, frame in enumerate(cluster_frames):
+        by_frame.setdefault(frame, []).append(k)
+
+    groups, lines, rows = [], [], []
+    # Frames en orden de aparición (None = fuera de cualquier frame)
+    for frame, members in by_frame.items():
+        members = np.array(members)
+        boxes = cluster_boxes[members]
+        tolerance = ROW_TOLERANCE_RATIO * float(np.median(boxes[:, 3] - boxes[:, 1]))
+
+        for row in _rows(boxes, tolerance):
+            row_lines = []
+            for line in _lines(boxes, row, line_gap):
+                line_groups = []
+                for k in line:
+                    cluster = clusters[members[k]]
+                    group = {
+                        "id": f"g{len(groups)}",
+                        "strokes": [batch.ids[idxs[pos]] for pos in cluster],
+                        "bbox": cluster_boxes[members[k]].tolist(),
+                    }
+                    if frame is not None:
+                        group["frameId"] = frame
+                    line_groups.append(group["id"])
+                    groups.append(group)
+                row_lines.append(len(lines))
+                lines.append({"groups": line_groups, "bbox": _union_bbox(boxes[line])})
+
+            row_info = {"lines": row_lines, "bbox": _union_bbox(boxes[row])}
+            if frame is not None:
+                row_info["frameId"] = frame
+            rows.append(row_info)
+
+    return {"groups": groups, "lines": lines, "rows": rows}
+
+
+# ==========================================================
+# SIMPLIFICACIÓN (Ramer–Douglas–Peucker)
+# ==========================================================
+def simplify(batch, epsilon):
+    """
+    StrokeBatch con cada trazo simplificado por RDP con tolerancia epsilon.
+    Se procesan a la vez todos los segmentos pendientes de todos los
+    trazos (una iteración por nivel de profundidad), sin bucles por trazo.
+    """
+    lengths = np.diff(batch.offsets)
+    firsts, lasts = batch.offsets[:-1], batch.offsets[1:] - 1
+    keep = np.zeros(len(batch.coords), bool)
+    keep[firsts[lengths > 0]] = True
+    keep[lasts[lengths > 0]] = True
+
+    coords = batch.coords
+    a, b = firsts[lengths > 2], lasts[lengths > 2]
+    while len(a):
+        # Puntos interiores de cada segmento (a, b), todos seguidos
+        inner = b - a - 1
+        seg = np.repeat(np.arange(len(a)), inner)
+        starts = np.cumsum(inner) - inner
+        idx = np.arange(int(inner.sum())) - starts[seg] + a[seg] + 1
+
+        pa, pb, p = coords[a][seg], coords[b][seg], coords[idx]
+        dx, dy = pb[:, 0] - pa[:, 0], pb[:, 1] - pa[:, 1]
+        norm = np.hypot(dx, dy)
+        cross = np.abs(dx * (p[:, 1] - pa[:, 1]) - dy * (p[:, 0] - pa[:, 0]))
+        # Segmento degenerado (extremos iguales): distancia al punto
+        dist = np.where(norm > 0, cross / np.where(norm > 0, norm, 1),
+                        np.hypot(p[:, 0] - pa[:, 0], p[:, 1] - pa[:, 1]))
+
+        # Punto más lejano de cada segmento (el primero si hay empate)
+        farthest = np.maximum.reduceat(dist, starts)
+        hits = np.flatnonzero(dist == farthest[seg])
+        mid = idx[hits[np.unique(seg[hits], return_index=True)[1]]]
+
+        split = farthest > epsilon
+        mid, a, b = mid[split], a[split], b[split]
+        keep[mid] = True
+        a, b = np.concatenate([a, mid]), np.concatenate([mid, b])
+        pending = b - a >= 2
+        a, b = a[pending], b[pending]
+
+    # Offsets nuevos = puntos conservados antes del inicio de cada trazo
+    kept_before = np.concatenate([[0], np.cumsum(keep)])
+    offsets = kept_before[batch.offsets]
+    return StrokeBatch(batch.ids, coords[keep], offsets, batch.meta)
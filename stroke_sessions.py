@@ -0,0 +1,368 @@
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from stroke_geometry import compute_bboxes, decode_elements
+
+
+# ==========================================================
+# SESIONES DE TRAZOS (el cliente manda solo los cambios)
+# ==========================================================
+class SessionFull(Exception):
+    """La sesión superaría el máximo de puntos guardados."""
+
+
+class SessionCorrupt(Exception):
+    """El log de la sesión en disco no se puede leer (la sesión se descarta)."""
+
+
+class StrokeSession:
+    """
+    Estado de un lienzo: por id de trazo, sus puntos, metadatos y caja.
+    Cada delta solo decodifica y mide los trazos que cambian, así que el
+    coste por trazo no crece con el tamaño del dibujo.
+    """
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.created_at = time.time()
+        self.touched_at = self.created_at
+        self.version = 0
+        self.strokes = {}   # id -> (puntos (k, 2), meta, bbox o None si no tiene puntos)
+        self.points = 0
+        self.count = 0      # trazos con símbolo (con puntos)
+        self.lock = threading.Lock()
+        # Hasta dónde se ha leído el log en disco (ver SessionStore)
+        self.log_inode = None
+        self.log_offset = 0
+        self._log = None
+
+    def reset(self):
+        self.strokes = {}
+        self.points = 0
+        self.count = 0
+
+    def apply(self, elements, removed, max_points):
+        """
+        Aplica un delta (elementos añadidos/cambiados completos + ids
+        borrados) y devuelve (ids con símbolo nuevo o actualizado, ids cuyo
+        símbolo desaparece). Todo o nada: si el delta no es válido no cambia
+        nada.
+        """
+        if not isinstance(removed, list):
+            raise ValueError("'removed' must be a list of ids")
+        batch = decode_elements(elements)
+        idxs, bboxes = compute_bboxes(batch)
+        bbox_of = dict(zip(idxs.tolist(), bboxes.tolist()))
+        removed = [str(r) for r in removed]
+
+        # Último valor de cada id dentro del delta
+        incoming = {}
+        for i, stroke_id in enumerate(batch.ids):
+            incoming[stroke_id] = i
+        gone = set(removed) - set(incoming)
+
+        points = self.points
+        for stroke_id in set(incoming) | gone:
+            if stroke_id in self.strokes:
+                points -= len(self.strokes[stroke_id][0])
+        points += sum(len(batch.points(i)) for i in incoming.values())
+        if points > max_points:
+            raise SessionFull(f"Session would hold {points} points (max {max_points})")
+
+        updated, dropped = [], []
+        for stroke_id, i in incoming.items():
+            bbox = bbox_of.get(i)
+            old = self.strokes.get(stroke_id)
+            had_symbol = old is not None and old[2] is not None
+            self.strokes[stroke_id] = (batch.points(i).copy(), batch.meta[i], bbox)
+            if bbox is not None:
+                updated.append(stroke_id)
+                self.count += not had_symbol
+            elif had_symbol:
+                dropped.append(stroke_id)
+                self.count -= 1
+        for stroke_id in gone:
+            old = self.strokes.pop(stroke_id, None)
+            if old is not None and old[2] is not None:
+                dropped.append(stroke_id)
+                self.count -= 1
+
+        self.points = points
+        self.version += 1
+        return updated, dropped
+
+    def symbol(self, stroke_id, include_points=False):
+        points, _, bbox = self.strokes[stroke_id]
+        symbol = {"id": stroke_id, "bbox": bbox}
+        if include_points:
+            symbol["points"] = points.tolist()
+        return symbol
+
+    def elements(self):
+        """El estado como elementos JSON (lo que haría falta para recrearlo)."""
+        return [{"id": stroke_id, "points": points.tolist(), **meta}
+                for stroke_id, (points, meta, _) in self.strokes.items()]
+
+    def symbols(self, include_points=False):
+        return [self.symbol(stroke_id, include_points)
+                for stroke_id, (_, _, bbox) in self.strokes.items() if bbox is not None]
+
+
+_SESSION_ID = re.compile(r"[0-9a-f]{32}")
+
+
+class SessionStore:
+    """
+    Sesiones con TTL desde el último uso y un máximo de sesiones (al pasarse
+    se descarta la menos usada recientemente) y de puntos por sesión.
+
+    Con `root` (varios workers de gunicorn) cada sesión es además un log en
+    disco, <root>/<id>.log, con una línea JSON por versión (el delta tal
+    cual llegó). El worker que atiende una petición, con el log bloqueado
+    (flock), lee las líneas que le faltan, aplica el delta y añade su línea;
+    así cualquier worker puede seguir cualquier sesión sin decodificar más
+    que los cambios. Pasados `compact_bytes` el log se reescribe como una
+    sola línea con el estado completo. El TTL es el mtime del log.
+    """
+
+    def __init__(self, ttl=900, max_sessions=1000, max_points=500000, root=None, compact_bytes=4 << 20):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_points = max_points
+        self.root = root
+        self.compact_bytes = compact_bytes
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()   # id -> StrokeSession (de menos a más reciente)
+        self._creates = 0
+
+        self.expired = 0
+        self.evicted = 0
+        if root:
+            os.makedirs(root, exist_ok=True)
+
+    def _purge_locked(self):
+        now = time.time()
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.touched_at < self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            self.expired += 1
+
+    def _remember_locked(self, session):
+        while len(self._sessions) >= self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+        self._sessions[session.id] = session
+
+    def create(self, elements=()):
+        """Nueva sesión con los elementos iniciales (solo se guarda si son válidos)."""
+        elements = list(elements)
+        session = StrokeSession(uuid.uuid4().hex)
+        session.apply(elements, [], self.max_points)
+        if self.root:
+            with open(self._log_path(session.id), "xb") as f:
+                self._append(session, f, elements, [])
+        with self._lock:
+            self._purge_locked()
+            self._remember_locked(session)
+            self._creates += 1
+            sweep = self.root and self._creates % 64 == 0
+        if sweep:
+            self._sweep_disk()
+        return session
+
+    def get(self, session_id):
+        """La sesión (sin ponerla al día con el disco: eso lo hace locked())."""
+        if self.root and not _SESSION_ID.fullmatch(session_id):
+            return None
+        with self._lock:
+            self._purge_locked()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.touched_at = time.time()
+                self._sessions.move_to_end(session_id)
+        if not self.root:
+            return session
+
+        # En disco manda el log: puede haberla creado, borrado o caducado otro worker
+        path = self._log_path(session_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._sessions.pop(session_id, None)
+            return None
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(session_id)
+                if session is None:
+                    session = StrokeSession(session_id)
+                    self._remember_locked(session)
+        return session
+
+    @contextmanager
+    def locked(self, session_id):
+        """
+        La sesión bloqueada y al día (o None si no existe). Dentro, los
+        cambios se hacen con apply() para que queden en el log.
+        """
+        session = self.get(session_id)
+        if session is None:
+            yield None
+            return
+        with session.lock:
+            if not self.root:
+                yield session
+                return
+            log = self._open_log(session_id)
+            if log is None:
+                with self._lock:
+                    self._sessions.pop(session_id, None)
+                yield None
+                return
+            with log:
+                try:
+                    self._catch_up(session, log)
+                except SessionCorrupt:
+                    # Con el log bloqueado: nadie más lo está leyendo ni escribiendo
+                    os.remove(self._log_path(session_id))
+                    with self._lock:
+                        self._sessions.pop(session_id, None)
+                    raise
+                session._log = log
+                try:
+                    yield session
+                finally:
+                    session._log = None
+
+    def apply(self, session, elements, removed):
+        """Aplica un delta a una sesión obtenida con locked() y lo añade al log."""
+        updated, dropped = session.apply(elements, removed, self.max_points)
+        if self.root:
+            self._append(session, session._log, elements, removed)
+            if session._log.tell() > self.compact_bytes:
+                self._compact(session)
+        return updated, dropped
+
+    def delete(self, session_id):
+        with self._lock:
+            found = self._sessions.pop(session_id, None) is not None
+        if self.root and _SESSION_ID.fullmatch(session_id):
+            try:
+                os.remove(self._log_path(session_id))
+                found = True
+            except OSError:
+                pass
+        return found
+
+    # ---------- Log en disco ----------
+    def _log_path(self, session_id):
+        return os.path.join(self.root, f"{session_id}.log")
+
+    def _open_log(self, session_id):
+        """Log abierto y bloqueado; None si ya no existe."""
+        path = self._log_path(session_id)
+        while True:
+            try:
+                log = open(path, "r+b")
+            except FileNotFoundError:
+                return None
+            fcntl.flock(log, fcntl.LOCK_EX)
+            # Si se compactó mientras esperaba, el lock es del archivo viejo
+            try:
+                if os.stat(path).st_ino == os.fstat(log.fileno()).st_ino:
+                    return log
+            except FileNotFoundError:
+                log.close()
+                return None
+            log.close()
+
+    def _catch_up(self, session, log):
+        inode = os.fstat(log.fileno()).st_ino
+        if inode != session.log_inode:
+            session.log_inode, session.log_offset = inode, 0
+        log.seek(session.log_offset)
+        for line in log:
+            if not line.endswith(b"\n"):
+                # Línea a medias (el worker murió escribiéndola): con el flock
+                # nadie está escribiendo, así que se corta y se sigue sin ella
+                log.truncate(session.log_offset)
+                break
+            try:
+                entry = json.loads(line)
+                if entry["v"] <= session.version:
+                    session.log_offset += len(line)
+                    continue
+                if entry.get("snapshot"):
+                    session.reset()
+                # Ya se validó al escribirlo: sin tope de puntos
+                session.apply(entry["elements"], entry["removed"], float("inf"))
+            except (ValueError, KeyError, TypeError) as e:
+                raise SessionCorrupt(f"Session log is corrupt: {e}")
+            session.log_offset += len(line)
+            session.version = entry["v"]
+
+    def _append(self, session, log, elements, removed, snapshot=False):
+        line = {"v": session.version, "elements": elements, "removed": removed}
+        if snapshot:
+            line["snapshot"] = True
+        data = (json.dumps(line, separators=(",", ":")) + "\n").encode("utf-8")
+        log.seek(0, os.SEEK_END)
+        log.write(data)
+        log.flush()
+        session.log_inode = os.fstat(log.fileno()).st_ino
+        session.log_offset = log.tell()
+
+    def _compact(self, session):
+        path = self._log_path(session.id)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            self._append(session, f, session.elements(), [], snapshot=True)
+        # rename conserva el inode: log_inode/log_offset ya apuntan al nuevo
+        os.replace(tmp, path)
+
+    def _sweep_disk(self):
+        """Borra los logs caducados y, si sobran, los menos usados."""
+        now = time.time()
+        logs = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                mtime = os.path.getmtime(path)
+                if now - mtime > self.ttl or (name.endswith(".tmp") and now - mtime > 60):
+                    os.remove(path)
+                elif name.endswith(".log"):
+                    logs.append((mtime, path))
+            except OSError:
+                continue
+        logs.sort()
+        for _, path in logs[:max(0, len(logs) - self.max_sessions)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            self._purge_locked()
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "points": sum(s.points for s in self._sessions.values()),
+                "max_points_per_session": self.max_points,
+                "ttl": self.ttl,
+                "shared_dir": self.root,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,106 @@
+import os
+import re
+import base64
+import hashlib
+import threading
+
+
+# ==========================================================
+# SUBIDAS A static/ (en trozos, con nombre por hash de contenido)
+# ==========================================================
+CHUNK_SIZE = 64 * 1024
+
+# Trozos de base64 de un múltiplo de 4 caracteres: cada uno se decodifica solo
+B64_CHUNK = CHUNK_SIZE // 3 * 4
+
+# Extensión por los primeros bytes: solo tipos que el navegador no ejecuta.
+# Todo lo demás (HTML, SVG con <script>...) se guarda como .bin, que static/
+# sirve como application/octet-stream; el nombre del cliente no se usa.
+SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"%PDF-", "pdf"),
+)
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def sniff_extension(head):
+    for magic, ext in SIGNATURES:
+        if head.startswith(magic):
+            return ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return "bin"
+
+
+def stream_chunks(stream, chunk_size=CHUNK_SIZE):
+    """Trozos de un archivo o de request.stream sin leerlo entero."""
+    return iter(lambda: stream.read(chunk_size), b"")
+
+
+def b64_chunks(text):
+    """
+    Trozos decodificados de un base64, con o sin prefijo data-URL
+    ("data:image/png;base64,..."). Lanza binascii.Error si no es base64.
+    """
+    start = text.find(",") + 1
+    # Con saltos de línea los trozos no caerían en múltiplos de 4
+    if re.search(r"\s", text):
+        text, start = re.sub(r"\s+", "", text[start:]), 0
+    for i in range(start, len(text), B64_CHUNK):
+        yield base64.b64decode(text[i:i + B64_CHUNK], validate=True)
+
+
+class UploadStore:
+    """
+    Guarda subidas en `root` como <prefix><sha256>.<ext>: se escriben en
+    trozos a un temporal mientras se calcula el hash y se renombran al
+    final, así la misma imagen subida dos veces es un solo archivo (y la
+    misma URL, que el cliente o un CDN pueden cachear). Como mucho
+    `max_bytes` por archivo.
+    """
+
+    def __init__(self, root, max_bytes, prefix="upload_"):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+
+    def save(self, chunks):
+        """
+        Devuelve (nombre, bytes, ya existía). Lanza UploadTooLarge al pasarse
+        de max_bytes y ValueError si no llega nada.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        tmp = os.path.join(self.root, f".{self.prefix}{os.getpid()}.{threading.get_ident()}.tmp")
+        digest = hashlib.sha256()
+        size = 0
+        head = b""
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadTooLarge(f"Upload exceeds {self.max_bytes} bytes")
+                    if len(head) < 64:
+                        head += chunk[:64]
+                    digest.update(chunk)
+                    f.write(chunk)
+            if not size:
+                raise ValueError("Empty upload")
+
+            name = f"{self.prefix}{digest.hexdigest()[:32]}.{sniff_extension(head)}"
+            dst = os.path.join(self.root, name)
+            if os.path.exists(dst):
+                os.remove(tmp)
+                return name, size, True
+            os.replace(tmp, dst)
+            return name, size, False
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
@@ -0,0 +1,213 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+
+# ==========================================================
+# ÍNDICE VECTORIAL EN DISCO (numpy + mmap)
+# ==========================================================
+# Una colección exportada es un directorio con:
+#   vectors.npy            (n, dim) float32 normalizados (producto = coseno)
+#   ids.json, documents.json
+#   meta_<campo>.npy       columnas de metadatos (códigos int32; -1 = sin valor)
+#   vocab.json             {campo: [valores]} para los campos categóricos
+#   ivf_*.npy              (opcional) centroides y listas invertidas
+#   manifest.json
+# Todo se abre con mmap_mode="r": varios procesos que cargan el mismo
+# directorio comparten las páginas del page cache sin copiar la matriz.
+CATEGORICAL_FIELDS = ("topic", "archetype")
+NUMERIC_FIELDS = ("difficulty",)
+
+# Por debajo de esto la fuerza bruta es más rápida que IVF
+IVF_MIN_ROWS = 50000
+
+
+def _normalize(x):
+    x = np.asarray(x, np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.where(norms > 0, norms, 1)
+
+
+def _kmeans(vectors, nlist, iterations=10, seed=0):
+    """k-means esférico (coseno) sencillo para los centroides de IVF."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = vectors[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids = _normalize(centroids)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+def export_collection(collection, out_dir, page_size=1000, nlist=None):
+    """
+    Vuelca una colección de Chroma (embeddings + documentos + metadatos) a
+    out_dir de forma atómica. Con muchas filas construye además un IVF.
+    """
+    ids, documents, metadatas, vectors = [], [], [], []
+    offset = 0
+    while True:
+        page = collection.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        ids.extend(page["ids"])
+        documents.extend(page.get("documents") or [None] * len(page["ids"]))
+        metadatas.extend(page.get("metadatas") or [None] * len(page["ids"]))
+        vectors.append(np.asarray(page["embeddings"], np.float32))
+        offset += len(page["ids"])
+    if not ids:
+        raise ValueError("Collection is empty")
+
+    tmp_dir = out_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    matrix = _normalize(np.concatenate(vectors))
+    np.save(os.path.join(tmp_dir, "vectors.npy"), matrix)
+
+    metadatas = [m or {} for m in metadatas]
+    vocab = {}
+    for field in CATEGORICAL_FIELDS:
+        values = sorted({str(m[field]) for m in metadatas if m.get(field) is not None})
+        vocab[field] = values
+        code = {v: i for i, v in enumerate(values)}
+        column = [code[str(m[field])] if m.get(field) is not None else -1 for m in metadatas]
+        np.save(os.path.join(tmp_dir, f"meta_{field}.npy"), np.array(column, np.int32))
+    for field in NUMERIC_FIELDS:
+        column = [int(m[field]) if m.get(field) is not None else -1 for m in metadatas]
+        np.save(os.path.join(tmp_dir, f"meta_{field}.npy"), np.array(column, np.int32))
+
+    if nlist is None:
+        nlist = int(np.sqrt(len(ids))) if len(ids) >= IVF_MIN_ROWS else 0
+    if nlist:
+        centroids, assign = _kmeans(matrix, nlist)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.zeros(nlist + 1, np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=offsets[1:])
+        np.save(os.path.join(tmp_dir, "ivf_centroids.npy"), centroids)
+        np.save(os.path.join(tmp_dir, "ivf_order.npy"), order.astype(np.int64))
+        np.save(os.path.join(tmp_dir, "ivf_offsets.npy"), offsets)
+
+    for name, data in (("ids.json", ids), ("documents.json", documents), ("vocab.json", vocab),
+                       ("manifest.json", {"collection": getattr(collection, "name", None), "count": len(ids),
+                                          "dim": int(matrix.shape[1]), "ivf_lists": nlist})):
+        with open(os.path.join(tmp_dir, name), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.rename(tmp_dir, out_dir)
+
+
+class VectorIndex:
+    """
+    Búsqueda top-k por coseno sobre un directorio exportado. Los filtros de
+    metadatos se resuelven antes de puntuar (máscara booleana sobre las
+    columnas), así que solo se comparan las filas candidatas.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, "manifest.json"), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        with open(os.path.join(root, "ids.json"), encoding="utf-8") as f:
+            self.ids = json.load(f)
+        with open(os.path.join(root, "documents.json"), encoding="utf-8") as f:
+            self.documents = json.load(f)
+        with open(os.path.join(root, "vocab.json"), encoding="utf-8") as f:
+            self.vocab = json.load(f)
+
+        self.vectors = np.load(os.path.join(root, "vectors.npy"), mmap_mode="r")
+        self.columns = {field: np.load(os.path.join(root, f"meta_{field}.npy"), mmap_mode="r")
+                        for field in CATEGORICAL_FIELDS + NUMERIC_FIELDS}
+
+        self.ivf = None
+        if self.manifest.get("ivf_lists"):
+            self.ivf = tuple(np.load(os.path.join(root, f"ivf_{name}.npy"), mmap_mode="r")
+                             for name in ("centroids", "order", "offsets"))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def mask(self, filters):
+        """
+        Máscara de filas que cumplen {campo: valor}. En topic/archetype un
+        valor encaja si es igual o es el prefijo seguido de espacio ("2.6"
+        encaja con "2.6 Modelling..."); se admite una lista de valores.
+        En difficulty: número exacto, lista, o {"min", "max"}. None = todo.
+        """
+        if not filters:
+            return None
+        mask = np.ones(len(self.ids), bool)
+        for field, wanted in filters.items():
+            if wanted is None:
+                continue
+            if field in CATEGORICAL_FIELDS:
+                wanted = [str(w) for w in (wanted if isinstance(wanted, list) else [wanted])]
+                codes = [i for i, value in enumerate(self.vocab[field])
+                         if any(value == w or value.startswith(w + " ") for w in wanted)]
+                mask &= np.isin(self.columns[field], codes)
+            elif field in NUMERIC_FIELDS:
+                column = self.columns[field]
+                if isinstance(wanted, dict):
+                    if wanted.get("min") is not None:
+                        mask &= column >= int(wanted["min"])
+                    if wanted.get("max") is not None:
+                        mask &= column <= int(wanted["max"])
+                else:
+                    mask &= np.isin(column, [int(w) for w in (wanted if isinstance(wanted, list) else [wanted])])
+            else:
+                raise ValueError(f"Unknown filter '{field}'")
+        return mask
+
+    def _candidates(self, queries, nprobe):
+        """Filas de las nprobe listas IVF más cercanas a alguna de las consultas."""
+        centroids, order, offsets = self.ivf
+        probes = np.argsort(-(queries @ centroids.T), axis=1)[:, :nprobe]
+        rows = [order[offsets[c]:offsets[c + 1]] for c in np.unique(probes)]
+        return np.sort(np.concatenate(rows)) if rows else np.zeros(0, np.int64)
+
+    def search(self, queries, k, mask=None, nprobe=8):
+        """
+        Top-k para un lote de consultas (m, dim). Devuelve por consulta una
+        lista de (fila, puntuación) ordenada de mayor a menor.
+        """
+        queries = _normalize(np.atleast_2d(queries))
+        if queries.shape[1] != self.dim:
+            raise ValueError(f"Query dimension {queries.shape[1]} does not match index dimension {self.dim}")
+
+        rows = None
+        if self.ivf is not None:
+            rows = self._candidates(queries, nprobe)
+            if mask is not None:
+                rows = rows[mask[rows]]
+        elif mask is not None:
+            rows = np.flatnonzero(mask)
+
+        if rows is None:
+            scores = queries @ self.vectors.T
+            rows = np.arange(len(self.ids))
+        else:
+            scores = queries @ self.vectors[rows].T
+
+        k = min(k, len(rows))
+        if k == 0:
+            return [[] for _ in queries]
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for q in range(len(queries)):
+            best = top[q][np.argsort(-scores[q, top[q]])]
+            results.append([(int(rows[j]), float(scores[q, j])) for j in best])
+        return results
+
+    def stats(self):
+        return {"count": len(self.ids), "dim": self.dim, "ivf_lists": self.manifest.get("ivf_lists", 0),
+                "collection": self.manifest.get("collection"), "path": self.root}
@@ -0,0 +1,131 @@
+import os
+import atexit
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+# ==========================================================
+# DIRECTORIOS DE TRABAJO DE LAS COMPILACIONES (tmpfs, reciclados)
+# ==========================================================
+def default_root():
+    """/dev/shm si se puede escribir (RAM: aux/log/pdf/png sin tocar disco); si no, el temp del sistema."""
+    shm = "/dev/shm"
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        return shm
+    return tempfile.gettempdir()
+
+
+def _empty(path):
+    # Solo lo que dejó la compilación: doc.*, pre.fmt, enlaces a fragmentos...
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+
+class WorkspacePool:
+    """
+    Directorios de trabajo para pdflatex/poppler creados de antemano y
+    reutilizados: al devolverse se vacían en vez de borrar el directorio y
+    crear otro. Cada proceso tiene los suyos en <root>/ib_workspaces/<pid>
+    (los de procesos muertos se borran: en tmpfs ocupan RAM). Si en `root`
+    quedan menos de `min_free_bytes` libres (el /dev/shm de Docker es de
+    64 MB salvo --shm-size) se usa un directorio temporal normal.
+    """
+
+    def __init__(self, root=None, size=4, min_free_bytes=16 * 1024 * 1024):
+        self.base = root or default_root()
+        self.root = os.path.join(self.base, "ib_workspaces")
+        self.size = size
+        self.min_free_bytes = min_free_bytes
+        self._lock = threading.Lock()
+        self._free = []
+        self._pid = None
+        self.acquired = 0
+        self.reused = 0
+        self.fallbacks = 0
+        atexit.register(self._cleanup)
+
+    # ---------- Por proceso ----------
+    def _process_dir(self):
+        """Directorio de este proceso; tras un fork (workers de gunicorn) se crean los suyos."""
+        path = os.path.join(self.root, str(os.getpid()))
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            os.makedirs(path, exist_ok=True)
+            self._sweep()
+            self._free = [tempfile.mkdtemp(dir=path) for _ in range(self.size)]
+        return path
+
+    def _sweep(self):
+        for name in os.listdir(self.root):
+            if not name.isdigit() or int(name) == os.getpid():
+                continue
+            try:
+                os.kill(int(name), 0)
+            except ProcessLookupError:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            except PermissionError:
+                pass
+
+    def _cleanup(self):
+        # atexit se hereda en el fork: cada proceso borra solo lo suyo
+        if self._pid == os.getpid():
+            shutil.rmtree(os.path.join(self.root, str(self._pid)), ignore_errors=True)
+
+    def _has_room(self):
+        try:
+            st = os.statvfs(self.base)
+        except OSError:
+            return False
+        return st.f_bavail * st.f_frsize >= self.min_free_bytes
+
+    # ---------- Uso ----------
+    @contextmanager
+    def acquire(self):
+        """Directorio vacío para una compilación; se vacía y vuelve al pool al salir."""
+        if not self._has_room():
+            self.fallbacks += 1
+            with tempfile.TemporaryDirectory() as tmp:
+                yield tmp
+            return
+
+        with self._lock:
+            parent = self._process_dir()
+            path = self._free.pop() if self._free else None
+            self.acquired += 1
+            if path is not None:
+                self.reused += 1
+        if path is None:
+            path = tempfile.mkdtemp(dir=parent)
+        try:
+            yield path
+        finally:
+            self._release(path)
+
+    def _release(self, path):
+        try:
+            _empty(path)
+        except OSError:
+            shutil.rmtree(path, ignore_errors=True)
+            return
+        with self._lock:
+            if self._pid == os.getpid() and len(self._free) < self.size:
+                self._free.append(path)
+                return
+        shutil.rmtree(path, ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "root": self.root,
+                "size": self.size,
+                "free": len(self._free) if self._pid == os.getpid() else self.size,
+                "acquired": self.acquired,
+                "reused": self.reused,
+                "fallbacks": self.fallbacks,
+            }